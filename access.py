@@ -0,0 +1,148 @@
+from typing import Dict, Optional, Set, Tuple
+from fastapi import HTTPException
+from sqlalchemy import and_, select, union
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import TTLCache
+from database import AsyncSessionLocal
+import models
+
+OWNER_ACCESS_LEVEL = 3
+ACCESS_CACHE_TTL = 300  # seconds
+MEMBERSHIP_CACHE_TTL = 3600  # seconds, join/create/remove keep it current in between
+
+# (user_id, server_id) -> (owner_id, member access_level or None if not a member)
+access_cache = TTLCache(maxsize=50000, ttl=ACCESS_CACHE_TTL)
+
+
+class AccessInfo:
+    """What a user is allowed to do on one server."""
+
+    def __init__(self, user_id: int, server_id: int, owner_id: int, member_level: Optional[int]):
+        self.user_id = user_id
+        self.server_id = server_id
+        self.owner_id = owner_id
+        self.member_level = member_level
+
+    @property
+    def is_owner(self) -> bool:
+        return self.owner_id == self.user_id
+
+    @property
+    def is_member(self) -> bool:
+        return self.member_level is not None
+
+    @property
+    def has_access(self) -> bool:
+        return self.is_member or self.is_owner
+
+    @property
+    def access_level(self) -> Optional[int]:
+        # membership wins over ownership, same as the old per-route checks
+        if self.is_member:
+            return self.member_level or 0
+        if self.is_owner:
+            return OWNER_ACCESS_LEVEL
+        return None
+
+    @property
+    def is_admin(self) -> bool:
+        """Server owner or a member with access_level > 0."""
+        return self.is_owner or (self.member_level or 0) > 0
+
+
+class ServerAccess:
+    """
+    Resolves (user, server) -> AccessInfo with a single Server/ServerMember join.
+    Results are memoized for the lifetime of the request and shared between
+    requests through access_cache until invalidate() is called.
+    """
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+        self._memo: Dict[Tuple[int, int], Optional[AccessInfo]] = {}
+
+    async def get(self, user_id: int, server_id: int) -> Optional[AccessInfo]:
+        """Returns None if the server does not exist."""
+        key = (user_id, server_id)
+        if key in self._memo:
+            return self._memo[key]
+
+        cached = access_cache.get(key)
+        if cached is None:
+            row = (await self.db.execute(
+                select(models.Server.owner_id, models.ServerMember.user_id, models.ServerMember.access_level)
+                .outerjoin(models.ServerMember, and_(
+                    models.ServerMember.server_id == models.Server.id,
+                    models.ServerMember.user_id == user_id
+                ))
+                .where(models.Server.id == server_id)
+            )).first()
+            if row is None:
+                # missing servers are not cached, the id may be created later
+                self._memo[key] = None
+                return None
+            owner_id, member_user_id, member_level = row
+            if member_user_id is not None and member_level is None:
+                member_level = 0
+            cached = (owner_id, member_level if member_user_id is not None else None)
+            access_cache.set(key, cached)
+
+        info = AccessInfo(user_id, server_id, cached[0], cached[1])
+        self._memo[key] = info
+        return info
+
+    async def require(self, user_id: int, server_id: int, admin: bool = False, detail: str = "Not authorized") -> AccessInfo:
+        """Raise 404 if the server is missing, 403 if the user lacks access (or admin rights when admin=True)."""
+        info = await self.get(user_id, server_id)
+        if info is None:
+            raise HTTPException(status_code=404, detail="Server not found")
+        if not info.has_access or (admin and not info.is_admin):
+            raise HTTPException(status_code=403, detail=detail)
+        return info
+
+    @staticmethod
+    def invalidate(user_id: Optional[int] = None, server_id: Optional[int] = None):
+        """Drop cached access for a user, a server, or one (user, server) pair."""
+        if user_id is not None and server_id is not None:
+            access_cache.pop((user_id, server_id))
+        else:
+            access_cache.pop_where(lambda key, _: (user_id is None or key[0] == user_id) and (server_id is None or key[1] == server_id))
+
+
+class MembershipIndex:
+    """
+    In-memory user_id -> {server_id} index (servers the user is a member or owner of),
+    warmed lazily from the database and kept current by join/create/remove.
+    """
+
+    def __init__(self, maxsize: int = 50000, ttl: float = MEMBERSHIP_CACHE_TTL):
+        self._servers = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def servers_for(self, user_id: int) -> Set[int]:
+        """Returns a copy, safe to iterate across awaits."""
+        servers = self._servers.get(user_id)
+        if servers is None:
+            async with AsyncSessionLocal() as db:
+                rows = await db.scalars(union(
+                    select(models.ServerMember.server_id).where(models.ServerMember.user_id == user_id),
+                    select(models.Server.id).where(models.Server.owner_id == user_id)
+                ))
+                servers = set(rows.all())
+            self._servers.set(user_id, servers)
+        return set(servers)
+
+    def add(self, user_id: int, server_id: int):
+        # only update warm entries, a cold one will be loaded with the new server anyway
+        servers = self._servers.get(user_id)
+        if servers is not None:
+            servers.add(server_id)
+
+    def invalidate(self, user_id: int):
+        self._servers.pop(user_id)
+
+    def clear(self):
+        self._servers.clear()
+
+
+membership_index = MembershipIndex()
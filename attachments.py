@@ -0,0 +1,285 @@
+# Attachment ingestion and storage for messages and assignments
+#
+# Attachments are content addressed: a file is stored once under the SHA-256 of
+# its content (BLOB_DIR/ab/cd/abcd...), however many messages it is posted in.
+# The attachment_blobs Mongo collection lists, per blob, the messages that
+# reference it ("collection:message_id"), and a blob is deleted when its last
+# message goes away. A blob file is moved aside before its document is deleted
+# (_collect), so an upload of the same content racing with the deletion either
+# keeps the file or writes it again.
+#
+# Uploads are read in fixed-size chunks and hashed while they are written to a
+# temporary file, in the default thread pool so the event loop keeps serving
+# sockets; the file is then renamed to its blob path, or dropped if that content
+# is already stored. Several attachments are stored concurrently.
+#
+# Multipart bodies are spooled by Starlette before a route runs, so the size
+# limit is also enforced on the raw request body (AttachmentBodyLimit): bodies
+# announcing more than MAX_ATTACHMENT_BODY_SIZE are refused before anything is
+# read, and the others are cut off once they exceed it.
+import asyncio
+import hashlib
+import os
+import re
+import uuid
+from datetime import datetime
+from typing import Iterable, List, Optional
+from urllib.parse import quote
+from fastapi import HTTPException, UploadFile
+from fastapi.params import File
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from starlette.routing import Match
+
+UPLOAD_DIR = os.path.join(os.path.dirname(__file__), "uploads")  # legacy {uuid}_{filename} uploads
+BLOB_DIR = os.path.join(UPLOAD_DIR, "blobs")
+TMP_DIR = os.path.join(UPLOAD_DIR, "tmp")
+BASE_URL = "http://lamzaone.go.ro:8000"
+
+BLOB_COLLECTION = "attachment_blobs"  # {_id: sha256, size, created_at, refs: ["collection:message_id"]}
+
+ATTACHMENT_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+MAX_ATTACHMENT_SIZE = int(os.getenv("MAX_ATTACHMENT_SIZE", str(500 * 1024 * 1024)))  # bytes
+# whole multipart body of a message, larger submissions go through /api/uploads
+MAX_ATTACHMENT_BODY_SIZE = int(os.getenv("MAX_ATTACHMENT_BODY_SIZE", str(MAX_ATTACHMENT_SIZE + 1024 * 1024)))  # bytes
+
+DIGEST = re.compile(r"^[0-9a-f]{64}$")
+ATTACHMENT_URL = re.compile(r"/api/attachments/([0-9a-f]{64})/")
+
+
+def blob_path(digest: str) -> str:
+    return os.path.join(BLOB_DIR, digest[:2], digest[2:4], digest)
+
+
+def attachment_owner(collection_name: str, message_id) -> str:
+    """Reference key of a message document in attachment_blobs."""
+    return f"{collection_name}:{message_id}"
+
+
+def attachment_digests(urls: Iterable[str]) -> List[str]:
+    """Digests of the content-addressed attachments among `urls` (legacy /uploads URLs are skipped)."""
+    return [match.group(1) for match in map(ATTACHMENT_URL.search, urls) if match]
+
+
+class StoredAttachment:
+    def __init__(self, digest: str, filename: str, size: int):
+        self.digest = digest
+        self.filename = filename
+        self.size = size
+
+    @property
+    def path(self) -> str:
+        return blob_path(self.digest)
+
+    @property
+    def url(self) -> str:
+        return f"{BASE_URL}/api/attachments/{self.digest}/{quote(self.filename)}"
+
+
+def too_large_error(filename: str) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"Attachment {filename} exceeds the {MAX_ATTACHMENT_SIZE // (1024 * 1024)} MB limit")
+
+
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _write_chunk(out, digest, chunk: bytes):
+    digest.update(chunk)
+    out.write(chunk)
+
+
+async def _spool_upload(upload: UploadFile, filename: str):
+    """
+    Copy an upload to a temporary file in TMP_DIR, hashing it on the way.
+    Returns (sha256, size, temporary path); the caller moves or removes the file.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    partial_path = os.path.join(TMP_DIR, f"{uuid.uuid4().hex}.part")
+    out = await asyncio.to_thread(open, partial_path, "wb")
+    try:
+        while chunk := await upload.read(ATTACHMENT_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_ATTACHMENT_SIZE:
+                raise too_large_error(filename)
+            await asyncio.to_thread(_write_chunk, out, digest, chunk)
+        await asyncio.to_thread(out.close)
+    except BaseException:
+        await asyncio.to_thread(out.close)
+        await asyncio.to_thread(remove_file, partial_path)
+        raise
+    return digest.hexdigest(), size, partial_path
+
+
+def _place_blob(partial_path: str, path: str):
+    """Move a fully written file to its blob path, the file only appears under that name once complete."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(partial_path, path)
+
+
+def _takes_files(dependant) -> bool:
+    return (
+        any(isinstance(param.field_info, File) for param in dependant.body_params)
+        or any(_takes_files(dependency) for dependency in dependant.dependencies)
+    )
+
+
+def upload_routes(routes) -> List[APIRoute]:
+    """The routes taking File()/UploadFile parameters (multipart uploads)."""
+    return [route for route in routes if isinstance(route, APIRoute) and _takes_files(route.dependant)]
+
+
+class AttachmentBodyLimit:
+    """
+    ASGI middleware refusing request bodies over `max_size` on the routes taking
+    file uploads, before Starlette spools them: 413 straight away when
+    Content-Length is too large, otherwise once the received body grows past the limit.
+    """
+
+    def __init__(self, app, max_size: int = MAX_ATTACHMENT_BODY_SIZE):
+        self.app = app
+        self.max_size = max_size
+        self._routes = None  # found on the first request, once every route is registered
+
+    def _limited(self, scope) -> bool:
+        if self._routes is None:
+            self._routes = upload_routes(scope["app"].routes)
+        return any(route.matches(scope)[0] == Match.FULL for route in self._routes)
+
+    def _error(self) -> HTTPException:
+        return HTTPException(status_code=413, detail=f"Request body exceeds the {self.max_size // (1024 * 1024)} MB limit")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._limited(scope):
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_size:
+            error = self._error()
+            response = JSONResponse({"detail": error.detail}, status_code=error.status_code, headers={"Connection": "close"})
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_size:
+                    # raised from the form parsing of the route, FastAPI answers with a 413
+                    raise self._error()
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+class AttachmentStore:
+    def __init__(self, db):
+        self.blobs = db[BLOB_COLLECTION]
+
+    async def ensure_indexes(self):
+        await self.blobs.create_index("refs")
+
+    async def _reference(self, digest: str, size: int, owner: str):
+        await self.blobs.update_one(
+            {"_id": digest},
+            {"$addToSet": {"refs": owner}, "$setOnInsert": {"size": size, "created_at": datetime.now()}},
+            upsert=True
+        )
+
+    async def save_upload(self, upload: UploadFile, owner: str) -> StoredAttachment:
+        filename = os.path.basename(upload.filename or "attachment")
+        if upload.size is not None and upload.size > MAX_ATTACHMENT_SIZE:
+            raise too_large_error(filename)
+
+        digest, size, partial_path = await _spool_upload(upload, filename)
+        try:
+            # reference first: a concurrent _collect() then either restores the file or has
+            # already moved it away, in which case it is written again below
+            await self._reference(digest, size, owner)
+            path = blob_path(digest)
+            if await asyncio.to_thread(os.path.exists, path):
+                await asyncio.to_thread(remove_file, partial_path)
+            else:
+                try:
+                    await asyncio.to_thread(_place_blob, partial_path, path)
+                except BaseException:
+                    await self.release(owner, [digest])
+                    raise
+        except BaseException:
+            await asyncio.to_thread(remove_file, partial_path)
+            raise
+        return StoredAttachment(digest, filename, size)
+
+    async def adopt(self, path: str, digest: str, size: int, owner: str):
+        """Take over a fully written file whose content hash is already known (resumable uploads)."""
+        await self._reference(digest, size, owner)
+        target = blob_path(digest)
+        if await asyncio.to_thread(os.path.exists, target):
+            await asyncio.to_thread(remove_file, path)
+        else:
+            await asyncio.to_thread(_place_blob, path, target)
+
+    async def share(self, digest: str, owner: str):
+        """Add a reference of `owner` to a stored blob, e.g. a message a finished upload is attached to."""
+        await self.blobs.update_one({"_id": digest}, {"$addToSet": {"refs": owner}})
+
+    async def save(self, uploads: List[UploadFile], owner: str) -> List[StoredAttachment]:
+        """Store every upload concurrently for the message `owner`, nothing is kept if one of them fails."""
+        results = await asyncio.gather(*(self.save_upload(upload, owner) for upload in uploads), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            await self.release(owner, [result.digest for result in results if isinstance(result, StoredAttachment)])
+            raise errors[0]
+        return results
+
+    async def release(self, owner: str, digests: Optional[Iterable[str]] = None):
+        """Drop the references of `owner` (to `digests`, or to every blob), deleting blobs nothing references anymore."""
+        query = {"refs": owner}
+        if digests is not None:
+            query["_id"] = {"$in": list(digests)}
+        await self._release(query, {"$pull": {"refs": owner}})
+
+    async def release_collection(self, collection_name: str):
+        """Drop the references of every message of a collection, call it when the collection is dropped."""
+        prefix = {"$regex": f"^{re.escape(attachment_owner(collection_name, ''))}"}
+        await self._release({"refs": prefix}, {"$pull": {"refs": prefix}})
+
+    async def _release(self, query: dict, pull: dict):
+        released = await self.blobs.distinct("_id", query)
+        if not released:
+            return
+        await self.blobs.update_many({"_id": {"$in": released}}, pull)
+        unreferenced = await self.blobs.distinct("_id", {"_id": {"$in": released}, "refs": {"$size": 0}})
+        for digest in unreferenced:
+            await self._collect(digest)
+
+    async def _collect(self, digest: str):
+        """
+        Delete an unreferenced blob. The file is moved aside first and the document is
+        only deleted if nothing referenced the blob in the meantime, otherwise the
+        file is moved back (a concurrent save may have written the same content again).
+        """
+        path = blob_path(digest)
+        aside = os.path.join(TMP_DIR, f"{digest}.{uuid.uuid4().hex}.collect")
+        try:
+            await asyncio.to_thread(os.replace, path, aside)
+        except FileNotFoundError:
+            aside = None
+        keep = True
+        try:
+            result = await self.blobs.delete_one({"_id": digest, "refs": {"$size": 0}})
+            # not deleted: referenced again, or already deleted by a concurrent _collect of the blob
+            keep = not result.deleted_count and await self.blobs.count_documents({"_id": digest}, limit=1) > 0
+        finally:
+            if aside is not None and keep:
+                # same content, so replacing a file written again meanwhile is harmless
+                await asyncio.to_thread(os.replace, aside, path)
+            elif aside is not None:
+                await asyncio.to_thread(remove_file, aside)
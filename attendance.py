@@ -0,0 +1,171 @@
+# Attendance weeks, seeding and totals
+#
+# Every student gets an "absent" row per week, so adding a week (or a student)
+# writes one row per (student, week). Rows are inserted as a single multi-row
+# INSERT (executemany) instead of one ORM object per row.
+#
+# The per-student totals shown in the week view are counted with one grouped
+# query per server and cached (AttendanceTotals), the full users x weeks matrix
+# is pivoted in SQL (attendance_matrix).
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import SmallInteger, and_, case, func, select, type_coerce
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import TTLCache
+import models
+
+ABSENT = "absent"
+# Statuses that count towards a student's attendance total
+ATTENDED = ("present", "excused")
+# Status codes as stored in the database, also used by the attendance matrix
+STATUS_CODES = models.ATTENDANCE_STATUS_CODES
+
+# Rows per INSERT statement, keeps statements well under the bind parameter limit
+SEED_BATCH_SIZE = 5000
+# A semester rarely has more than ~20 weeks, bulk creation is capped well above that
+MAX_WEEKS_PER_REQUEST = 52
+TOTALS_CACHE_TTL = 60  # seconds
+MATRIX_PAGE_SIZE = 500  # users per attendance matrix page
+MAX_MATRIX_PAGE_SIZE = 5000
+
+
+def absent_rows(server_id: int, user_ids: Iterable[int], week_ids: Iterable[int], date: Optional[datetime] = None) -> List[Dict]:
+    """"absent" attendance rows for every (user, week) pair."""
+    date = date or datetime.now()
+    week_ids = list(week_ids)
+    return [
+        {"user_id": user_id, "server_id": server_id, "date": date, "status": ABSENT, "week_id": week_id}
+        for user_id in user_ids
+        for week_id in week_ids
+    ]
+
+
+def seed_statements(rows: List[Dict]):
+    """(statement, params) pairs inserting `rows`, run them with `db.execute(*pair)` in the caller's transaction."""
+    # rows kept from an earlier membership (user left and rejoined) win over the seeded ones
+    statement = insert(models.Attendance).on_conflict_do_nothing()
+    return [(statement, rows[start:start + SEED_BATCH_SIZE]) for start in range(0, len(rows), SEED_BATCH_SIZE)]
+
+
+async def create_weeks(db: AsyncSession, server_id: int, count: int) -> Tuple[List[int], List[int]]:
+    """
+    Appends `count` weeks to a server and seeds "absent" attendance for every
+    student (access_level 0) in them. Nothing is committed, the caller owns the
+    transaction. Returns (new week numbers, student ids).
+    """
+    existing_weeks = await db.scalar(select(func.count()).select_from(models.ServerWeek).filter_by(server_id=server_id))
+    week_numbers = list(range(existing_weeks + 1, existing_weeks + count + 1))
+    week_ids = (await db.scalars(
+        insert(models.ServerWeek).returning(models.ServerWeek.id),
+        [{"server_id": server_id, "week_number": week_number} for week_number in week_numbers]
+    )).all()
+
+    student_ids = (await db.scalars(
+        select(models.ServerMember.user_id).filter_by(server_id=server_id, access_level=0)
+    )).all()
+    for statement, rows in seed_statements(absent_rows(server_id, student_ids, week_ids)):
+        await db.execute(statement, rows)
+    return week_numbers, student_ids
+
+
+def totals_query(server_id: int):
+    return (
+        select(models.Attendance.user_id, func.count())
+        .where(models.Attendance.server_id == server_id, models.Attendance.status.in_(ATTENDED))
+        .group_by(models.Attendance.user_id)
+    )
+
+
+def indexed_queries(server_id: int, week_id: int, user_id: int) -> Dict[str, tuple]:
+    """The hot attendance queries, as name -> (query, indexes it may be planned with)."""
+    return {
+        "week view (server_id, week_id)": (
+            select(models.Attendance).filter_by(server_id=server_id, week_id=week_id), ("ix_attendance_server_week",)),
+        "user attendance (server_id, user_id)": (
+            select(models.Attendance).filter_by(server_id=server_id, user_id=user_id), ("ix_attendance_server_user",)),
+        # only server_id is matched, either server-prefixed index serves it
+        "attendance totals": (totals_query(server_id), ("ix_attendance_server_user", "ix_attendance_server_week")),
+        "seeding conflict check (user_id, week_id)": (
+            select(models.Attendance.id).filter_by(user_id=user_id, week_id=week_id), ("uq_attendance_user_week",)),
+    }
+
+
+async def load_totals(db: AsyncSession, server_id: int) -> Dict[int, int]:
+    """user_id -> number of attended weeks ("present" or "excused") on a server, one grouped query."""
+    rows = await db.execute(totals_query(server_id))
+    return dict(rows.all())
+
+
+class AttendanceTotals:
+    """
+    Cached attended-weeks totals per server. Every committed attendance change
+    drops the server entry (invalidate), the next read counts again. main.py
+    sends invalidations to every worker through the websocket backplane.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = TOTALS_CACHE_TTL):
+        self._servers = TTLCache(maxsize=maxsize, ttl=ttl)
+        # bumped by invalidate(), a count that started before an invalidation is not cached
+        self._generation = 0
+
+    async def get(self, db: AsyncSession, server_id: int) -> Dict[int, int]:
+        totals = self._servers.get(server_id)
+        if totals is None:
+            generation = self._generation
+            totals = await load_totals(db, server_id)
+            if generation == self._generation:
+                self._servers.set(server_id, totals)
+        return totals
+
+    def invalidate(self, server_id: int):
+        """Call after committing a change to the server's attendance."""
+        self._generation += 1
+        self._servers.pop(server_id)
+
+    def clear(self):
+        self._generation += 1
+        self._servers.clear()
+
+
+attendance_totals = AttendanceTotals()
+
+
+async def attendance_matrix(db: AsyncSession, server_id: int, after_user_id: int = 0, limit: int = MATRIX_PAGE_SIZE) -> Dict:
+    """
+    Users x weeks status codes (STATUS_CODES, 0 when there is no record), pivoted
+    in SQL with one conditional aggregate per week. Users are paged by id:
+    pass the returned `next_after_user_id` to get the next page.
+    """
+    weeks = (await db.execute(
+        select(models.ServerWeek.id, models.ServerWeek.week_number)
+        .where(models.ServerWeek.server_id == server_id)
+        .order_by(models.ServerWeek.week_number)
+    )).all()
+
+    status_code = type_coerce(models.Attendance.status, SmallInteger)  # the stored code
+    week_columns = [
+        func.max(case((models.Attendance.week_id == week_id, status_code), else_=0)).label(f"week_{week_id}")
+        for week_id, week_number in weeks
+    ]
+    rows = (await db.execute(
+        select(models.ServerMember.user_id, *week_columns)
+        .outerjoin(models.Attendance, and_(
+            models.Attendance.server_id == models.ServerMember.server_id,
+            models.Attendance.user_id == models.ServerMember.user_id
+        ))
+        .where(models.ServerMember.server_id == server_id, models.ServerMember.user_id > after_user_id)
+        .group_by(models.ServerMember.user_id)
+        .order_by(models.ServerMember.user_id)
+        .limit(limit)
+    )).all()
+
+    return {
+        "status_codes": STATUS_CODES,
+        "week_numbers": [week_number for _, week_number in weeks],
+        "user_ids": [row[0] for row in rows],
+        "statuses": [list(row[1:]) for row in rows],  # one row per user, one code per week
+        "next_after_user_id": rows[-1][0] if len(rows) == limit else None,
+    }
@@ -0,0 +1,148 @@
+# Attendance export (/api/server/{server_id}/attendance/export)
+#
+# Rows are read through a server-side cursor (AsyncSession.stream + yield_per)
+# and written out one partition at a time, so memory stays flat however much
+# history a server has. The exporters open their own session: the request's
+# session is closed before a StreamingResponse body is sent.
+import csv
+import importlib.util
+import io
+from typing import AsyncIterator, Iterable, List, Sequence
+
+from sqlalchemy import select
+
+from database import AsyncSessionLocal
+import models
+
+EXPORT_CHUNK_SIZE = 1000  # rows fetched (and written) per partition
+
+# format -> (media type, file name)
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "attendance.csv"),
+    "wide": ("text/csv", "attendance_wide.csv"),  # one row per user, one column per week
+    "parquet": ("application/vnd.apache.parquet", "attendance.parquet"),
+}
+
+
+def parquet_available() -> bool:
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def _csv_chunk(rows: Iterable[Sequence]) -> str:
+    output = io.StringIO()
+    csv.writer(output).writerows(rows)
+    return output.getvalue()
+
+
+def _long_rows(server_id: int):
+    return (
+        select(models.Attendance.user_id, models.ServerWeek.week_number, models.Attendance.date, models.Attendance.status)
+        .outerjoin(models.ServerWeek, models.ServerWeek.id == models.Attendance.week_id)
+        .where(models.Attendance.server_id == server_id)
+        .order_by(models.Attendance.id)
+        .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+    )
+
+
+async def stream_csv(server_id: int) -> AsyncIterator[str]:
+    """One line per attendance record."""
+    yield _csv_chunk([["User ID", "Week Number", "Date", "Status"]])
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(_long_rows(server_id))
+        async for rows in result.partitions():
+            yield _csv_chunk(rows)
+
+
+async def stream_wide_csv(server_id: int) -> AsyncIterator[str]:
+    """One line per user with the status of every week, rows arrive sorted by user so only one user is held at a time."""
+    async with AsyncSessionLocal() as db:
+        week_numbers = (await db.scalars(
+            select(models.ServerWeek.week_number)
+            .where(models.ServerWeek.server_id == server_id)
+            .order_by(models.ServerWeek.week_number)
+        )).all()
+        yield _csv_chunk([["User ID", "Name"] + [f"Week {week_number}" for week_number in week_numbers]])
+
+        def line(user_id: int, name: str, statuses: dict) -> List:
+            return [user_id, name] + [statuses.get(week_number, "") for week_number in week_numbers]
+
+        result = await db.stream(
+            select(models.Attendance.user_id, models.User.name, models.ServerWeek.week_number, models.Attendance.status)
+            .join(models.ServerWeek, models.ServerWeek.id == models.Attendance.week_id)
+            .join(models.User, models.User.id == models.Attendance.user_id)
+            .where(models.Attendance.server_id == server_id)
+            .order_by(models.Attendance.user_id)
+            .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+        )
+        current, statuses = None, {}
+        async for rows in result.partitions():
+            lines = []
+            for user_id, name, week_number, status in rows:
+                if current is not None and current[0] != user_id:
+                    lines.append(line(*current, statuses))
+                    statuses = {}
+                current = (user_id, name)
+                statuses[week_number] = status
+            if lines:
+                yield _csv_chunk(lines)
+        if current is not None:
+            yield _csv_chunk([line(*current, statuses)])
+
+
+class _ChunkSink:
+    """Write-only file object collecting what ParquetWriter writes until it is drained."""
+
+    closed = False
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.position = 0
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+async def stream_parquet(server_id: int) -> AsyncIterator[bytes]:
+    """Same columns as the CSV export, each partition becomes a Parquet row group (needs pyarrow)."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("user_id", pa.int64()),
+        ("week_number", pa.int64()),
+        ("date", pa.timestamp("us")),
+        ("status", pa.string()),
+    ])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+    try:
+        async with AsyncSessionLocal() as db:
+            result = await db.stream(_long_rows(server_id))
+            async for rows in result.partitions():
+                columns = list(zip(*rows))
+                writer.write_table(pa.table({field.name: list(column) for field, column in zip(schema, columns)}, schema=schema))
+                yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+EXPORTERS = {
+    "csv": stream_csv,
+    "wide": stream_wide_csv,
+    "parquet": stream_parquet,
+}
@@ -0,0 +1,109 @@
+# Broadcast backplane for WebSocketManager
+#
+# Every broadcast_* call is published as an event (channel, key, message). Each
+# worker process delivers events to the sockets it holds locally, so broadcasts
+# reach clients connected to any uvicorn worker. Cache invalidations travel on
+# the same backplane (CACHE_CHANNEL) so per-process caches stay coherent.
+import asyncio
+import json
+import logging
+import os
+import uuid
+from typing import Awaitable, Callable, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL")  # e.g. redis://127.0.0.1:6379/0, unset = single worker
+REDIS_CHANNEL = os.getenv("REDIS_WS_CHANNEL", "universe:ws")
+
+CACHE_CHANNEL = "cache"  # message: {"cache": name, **keys}
+ALL_CACHES = "*"  # delivered locally after a reconnect, invalidations may have been missed
+
+Message = Union[str, dict]
+DeliverCallback = Callable[[str, Optional[int], Message], Awaitable[None]]
+
+
+class InMemoryBackplane:
+    """Single process: publishing delivers straight to the local sockets."""
+
+    def __init__(self):
+        self._deliver: Optional[DeliverCallback] = None
+
+    async def start(self, deliver: DeliverCallback):
+        self._deliver = deliver
+
+    async def stop(self):
+        self._deliver = None
+
+    async def publish(self, channel: str, key: Optional[int], message: Message):
+        if self._deliver:
+            await self._deliver(channel, key, message)
+
+
+class RedisBackplane:
+    """
+    Redis pub/sub: events are delivered locally right away and published for the
+    other workers. Events published by this worker are ignored when they come back.
+    """
+
+    def __init__(self, url: str, channel: str = REDIS_CHANNEL):
+        self.url = url
+        self.channel = channel
+        self.origin = uuid.uuid4().hex
+        self.redis = None
+        self._deliver: Optional[DeliverCallback] = None
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self, deliver: DeliverCallback):
+        import redis.asyncio as aioredis
+
+        self._deliver = deliver
+        self.redis = aioredis.from_url(self.url, decode_responses=True)
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener:
+            self._listener.cancel()
+            self._listener = None
+        if self.redis:
+            await self.redis.aclose()
+            self.redis = None
+
+    async def publish(self, channel: str, key: Optional[int], message: Message):
+        await self._deliver(channel, key, message)
+        event = json.dumps({"origin": self.origin, "channel": channel, "key": key, "message": message})
+        try:
+            await self.redis.publish(self.channel, event)
+        except Exception as e:
+            # local clients already got it, other workers miss this one event
+            logger.error(f"Failed to publish websocket event to redis: {e}")
+
+    async def _listen(self):
+        reconnecting = False
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                if reconnecting:
+                    await self._deliver(CACHE_CHANNEL, None, {"cache": ALL_CACHES})
+                async for item in pubsub.listen():
+                    if item.get("type") != "message":
+                        continue
+                    event = json.loads(item["data"])
+                    if event.get("origin") == self.origin:
+                        continue
+                    await self._deliver(event["channel"], event["key"], event["message"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Redis backplane listener error, reconnecting: {e}")
+            finally:
+                await pubsub.aclose()
+            reconnecting = True
+            await asyncio.sleep(1)
+
+
+def create_backplane():
+    if REDIS_URL:
+        return RedisBackplane(REDIS_URL)
+    return InMemoryBackplane()
@@ -17,6 +17,18 @@ class User(BaseModel):
     class Config:
         from_attributes=True
 
+# Minimal profile kept in the token cache by get_current_user
+class AuthUser(BaseModel):
+    id: int
+    email: Optional[str] = None
+    name: Optional[str] = None
+    nickname: Optional[str] = None
+    picture: Optional[str] = None
+    token_expiry: datetime
+
+    class Config:
+        from_attributes = True
+
 class UserIn(BaseModel):
     id_token: str
     access_token: str
@@ -118,6 +130,17 @@ class MessageResponse(BaseModel):
 class MessagesRetrieve(BaseModel):
     room_id: int
 
+class MessagesPageRetrieve(BaseModel):
+    room_id: int
+    before: Optional[str] = None    # message id (ObjectId) or ISO timestamp, returns older messages
+    after: Optional[str] = None     # message id (ObjectId) or ISO timestamp, returns newer messages
+    limit: int = Field(50, ge=1, le=100)
+
+class MessagesPage(BaseModel):
+    messages: List[MessageResponse]     # oldest first
+    next_before: Optional[str] = None   # cursor for the previous (older) page, None if there is none
+    next_after: Optional[str] = None    # cursor for the next (newer) page, None if this is the latest
+
 
 
 class Assignment(BaseModel):
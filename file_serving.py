@@ -0,0 +1,136 @@
+# Conditional and ranged file responses for images, uploads and attachments
+#
+# Every response carries a strong ETag: the content hash for content-addressed
+# files, mtime+size otherwise. Files that never change under their URL are also
+# marked immutable. Matching
+# If-None-Match requests get a 304, and a single "bytes=" Range is answered with
+# a 206 so video attachments can be seeked without downloading them in full.
+import asyncio
+import mimetypes
+import os
+import re
+from typing import Optional
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+RANGE_CHUNK_SIZE = 256 * 1024
+
+BYTE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def is_within(path: str, directory: str) -> bool:
+    return os.path.realpath(path).startswith(os.path.realpath(directory) + os.sep)
+
+
+def safe_join(directory: str, name: str) -> Optional[str]:
+    """`name` inside `directory`, None if it would escape it."""
+    path = os.path.realpath(os.path.join(directory, name))
+    return path if is_within(path, directory) else None
+
+
+def _stat(path: str) -> Optional[os.stat_result]:
+    try:
+        result = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return result if os.path.isfile(path) else None
+
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+def _byte_range(header: str, size: int):
+    """(start, end) inclusive for a single satisfiable range, None to send the whole file, False if unsatisfiable."""
+    match = BYTE_RANGE.match(header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None  # multiple or malformed ranges, the full body is a valid answer
+    start, end = match.groups()
+    if start == "":
+        # suffix range: the last N bytes
+        length = int(end)
+        if length == 0:
+            return False
+        return max(0, size - length), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def _read_range(path: str, start: int, end: int):
+    with open(path, "rb") as source:
+        source.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = source.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+async def _iterate_range(path: str, start: int, end: int):
+    chunks = _read_range(path, start, end)
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        chunks.close()
+
+
+async def file_response(
+    request: Request,
+    path: str,
+    etag: Optional[str] = None,
+    cache_control: str = "no-cache",
+    filename: Optional[str] = None,
+    not_found: str = "File not found",
+) -> Response:
+    """
+    Serve `path` honouring If-None-Match, Range and If-Range. `etag` is the
+    content hash when known. IMMUTABLE_CACHE_CONTROL is only correct for files
+    that never change under their URL.
+    """
+    stat = await asyncio.to_thread(_stat, path)
+    if stat is None:
+        raise HTTPException(status_code=404, detail=not_found)
+
+    etag = f'"{etag}"' if etag else f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Accept-Ranges": "bytes"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    media_type = mimetypes.guess_type(filename or path)[0] or "application/octet-stream"
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() == etag):
+        byte_range = _byte_range(range_header, stat.st_size)
+        if byte_range is False:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{stat.st_size}"})
+        if byte_range:
+            start, end = byte_range
+            headers.update({
+                "Content-Range": f"bytes {start}-{end}/{stat.st_size}",
+                "Content-Length": str(end - start + 1),
+            })
+            return StreamingResponse(_iterate_range(path, start, end), status_code=206, media_type=media_type, headers=headers)
+
+    return FileResponse(
+        path,
+        stat_result=stat,
+        media_type=media_type,
+        headers=headers,
+        filename=filename,
+        content_disposition_type="inline",
+    )
@@ -0,0 +1,132 @@
+# Profile pictures and their resized derivatives (/api/images/{image_name}?size=64)
+#
+# Derivatives are square WebP thumbnails in THUMBNAIL_SIZES, rendered with Pillow
+# in a process pool (resizing is CPU bound and would block the event loop) and
+# cached on disk next to the originals. They are generated when a picture is
+# saved and, for older pictures, on first request; a derivative older than its
+# original is rendered again.
+import asyncio
+import importlib.util
+import logging
+import mimetypes
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+IMAGE_DIR = "user_images"  # Directory to store user images
+DERIVATIVE_DIR = os.path.join(IMAGE_DIR, "derived")
+THUMBNAIL_SIZES = (32, 64, 128)
+WEBP_QUALITY = 80
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+mimetypes.add_type("image/webp", ".webp")
+
+
+def thumbnails_available() -> bool:
+    return importlib.util.find_spec("PIL") is not None
+
+
+def derivative_path(source: str, size: int) -> str:
+    return os.path.join(DERIVATIVE_DIR, f"{os.path.basename(source)}.{size}.webp")
+
+
+def render_derivative(source: str, target: str, size: int) -> str:
+    """Runs in a worker process."""
+    from PIL import Image, ImageOps
+
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        thumbnail = ImageOps.fit(image.convert("RGBA"), (size, size), Image.LANCZOS)
+    partial_path = f"{target}.{os.getpid()}.part"
+    thumbnail.save(partial_path, "WEBP", quality=WEBP_QUALITY)
+    os.replace(partial_path, target)
+    return target
+
+
+def _is_fresh(source: str, target: str) -> bool:
+    try:
+        return os.stat(target).st_mtime >= os.stat(source).st_mtime
+    except FileNotFoundError:
+        return False
+
+
+class ImageDerivatives:
+    """
+    Renders derivatives in a lazily started process pool, one render per file at a
+    time. A pool that broke (a worker died) is replaced on the next render.
+    """
+
+    def __init__(self, workers: int = IMAGE_WORKERS):
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending: Dict[str, Future] = {}
+        # pregenerate() is called from sync routes, which run in the thread pool
+        self._lock = threading.Lock()
+
+    def _discard_executor(self, executor: ProcessPoolExecutor):
+        """The next render starts a new pool. Call without the lock: cancelled futures run _done."""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, source: str, size: int) -> Future:
+        target = derivative_path(source, size)
+        with self._lock:
+            future = self._pending.get(target)
+            if future is not None:
+                return future
+            if self._executor is None:
+                os.makedirs(DERIVATIVE_DIR, exist_ok=True)
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            executor = self._executor
+            try:
+                future = executor.submit(render_derivative, source, target, size)
+            except BrokenProcessPool:
+                future = None
+            else:
+                self._pending[target] = future
+        if future is None:
+            self._discard_executor(executor)
+            raise BrokenProcessPool("Image worker pool is broken")
+        # outside the lock: the callback runs right away if the future is already done
+        future.add_done_callback(lambda done: self._done(target, done, executor))
+        return future
+
+    def _done(self, target: str, future: Future, executor: ProcessPoolExecutor):
+        with self._lock:
+            if self._pending.get(target) is future:
+                del self._pending[target]
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            self._discard_executor(executor)
+
+    def pregenerate(self, source: str):
+        """Queue every size of a newly saved picture, without waiting for them (missing ones are rendered on request)."""
+        if not thumbnails_available():
+            return
+        for size in THUMBNAIL_SIZES:
+            try:
+                self._submit(source, size)
+            except Exception as e:
+                logger.error(f"Failed to queue {size}px derivative of {source}: {e}")
+                return
+
+    async def get(self, source: str, size: int) -> str:
+        """Path of the `size` derivative of `source`, rendering it first if needed."""
+        target = derivative_path(source, size)
+        if await asyncio.to_thread(_is_fresh, source, target):
+            return target
+        return await asyncio.wrap_future(self._submit(source, size))
+
+    def shutdown(self):
+        executor = self._executor
+        if executor is not None:
+            self._discard_executor(executor)
+
+
+image_derivatives = ImageDerivatives()
@@ -1,26 +1,43 @@
 import base64
 from urllib.parse import unquote
-import uuid
-from zoneinfo import ZoneInfo
 from fastapi import FastAPI, File, HTTPException, Depends, Body, Request, UploadFile, WebSocket, WebSocketDisconnect, Header
-from fastapi.staticfiles import StaticFiles
 import jwt as pyjwt  # Ensure PyJWT is installed: pip install PyJWT
 from pydantic import BaseModel, Field
-from typing import Annotated, List, Dict, Optional, Set
-from sqlalchemy.orm import Session
+from typing import Annotated, List, Dict, Literal, Optional
+from sqlalchemy import delete, select, update
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
 import requests
+from anyio import from_thread
 from datetime import datetime, timedelta, timezone
-from database import engine, SessionLocal
+from database import engine, SessionLocal, AsyncSessionLocal
 import secrets
+import asyncio
 import json
 import models
 from fastapi.middleware.cors import CORSMiddleware
 import logging
 import os
-from fastapi.responses import FileResponse
 from motor.motor_asyncio import AsyncIOMotorClient  # MongoDB async client
 from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 from basemodels import *
+from cache import TTLCache
+from access import ServerAccess, membership_index
+from websocket import WebSocketManager
+from backplane import REDIS_URL, create_backplane
+from mongo_collections import MongoCollections, room_collection_name
+from overview import OverviewSnapshots, build_user_overview, server_overview_entry
+from attendance import (
+    MATRIX_PAGE_SIZE, MAX_MATRIX_PAGE_SIZE, MAX_WEEKS_PER_REQUEST,
+    absent_rows, attendance_matrix, attendance_totals, create_weeks, seed_statements,
+)
+from attendance_export import EXPORT_FORMATS, EXPORTERS, parquet_available
+from attachments import BLOB_DIR, DIGEST, TMP_DIR, UPLOAD_DIR, AttachmentBodyLimit, AttachmentStore, attachment_digests, attachment_owner, blob_path
+from uploads import ResumableUploads
+from file_serving import IMMUTABLE_CACHE_CONTROL, file_response, is_within, safe_join
+from images import IMAGE_DIR, THUMBNAIL_SIZES, image_derivatives, thumbnails_available
 models.Base.metadata.create_all(bind=engine)
 
 app = FastAPI()
@@ -39,6 +56,13 @@ def get_db():
 
 db_dependency = Annotated[Session, Depends(get_db)]
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async_db_dependency = Annotated[AsyncSession, Depends(get_async_db)]
+
 def get_db():
     db = SessionLocal()
     try:
@@ -48,142 +72,12 @@ def get_db():
 
 
 
-# WebSocket Connections Manager
-class WebSocketManager:
-    def __init__(self):
-        self.main_connections: List[WebSocket] = []
-        self.server_connections: Dict[int, List[WebSocket]] = {}
-        self.textroom_connections: Dict[int, List[WebSocket]] = {}
-        self.audiovideo_connections: Dict[int, Dict[int, WebSocket]] = {}  # room_id -> {user_id: WebSocket}
-        self.audiovideo_voice_users: Dict[int, Set[int]] = {}
-        self.audiovideo_sharingscreen_users: Dict[int, Set[int]] = {}
-        self.audiovideo_camera_users: Dict[int, Set[int]] = {}
-
-
-
-    # --- MAIN SOCKET ---
-    async def connect_main(self, websocket: WebSocket):
-        await websocket.accept()
-        self.main_connections.append(websocket)
-
-    def disconnect_main(self, websocket: WebSocket):
-        self.main_connections.remove(websocket)
-
-    async def broadcast_main(self, message: str):
-        for connection in self.main_connections:
-            await connection.send_text(message)
-
-    # --- SERVER SOCKET ---
-    async def connect_server(self, websocket: WebSocket, server_id: int):
-        await websocket.accept()
-        if server_id not in self.server_connections:
-            self.server_connections[server_id] = []
-        self.server_connections[server_id].append(websocket)
-
-    def disconnect_server(self, websocket: WebSocket, server_id: int):
-        if server_id in self.server_connections:
-            self.server_connections[server_id].remove(websocket)
-
-    async def broadcast_server(self, server_id: int, message: str):
-        if server_id in self.server_connections:
-            for connection in self.server_connections[server_id]:
-                await connection.send_text(message)
-
-    # --- TEXT ROOM SOCKET ---
-    async def connect_textroom(self, websocket: WebSocket, room_id: int):
-        await websocket.accept()
-        if room_id not in self.textroom_connections:
-            self.textroom_connections[room_id] = []
-        self.textroom_connections[room_id].append(websocket)
-
-    def disconnect_textroom(self, websocket: WebSocket, room_id: int):
-        if room_id in self.textroom_connections:
-            self.textroom_connections[room_id].remove(websocket)
-            if not self.textroom_connections[room_id]:
-                del self.textroom_connections[room_id]
-
-    async def broadcast_textroom(self, room_id: int, message: str):
-        if room_id in self.textroom_connections:
-            for connection in self.textroom_connections[room_id]:
-                await connection.send_text(message)
-
-    ########### AUDIO/VIDEO ROOM WEB SOCKET (SIGNALING) ###########
-
-
-    async def connect_audiovideo(self, websocket: WebSocket, room_id: int, user_id: int):
-
-        websocket.user_id = user_id
-        await websocket.accept()
-        # Add the connection even if the user hasn't joined voice
-        self.audiovideo_connections.setdefault(room_id, []).append(websocket)
-        self.audiovideo_voice_users.setdefault(room_id, set())
-        self.audiovideo_camera_users.setdefault(room_id, set())
-        self.audiovideo_sharingscreen_users.setdefault(room_id, set())
-
-        # Notify all (including sender) about the user joining (optional: skip if not "connected")
-        await self.broadcast_audiovideo(
-            room_id,
-            json.dumps({"type": "user-joined", "user_id": user_id}),
-        )
-
-    def disconnect_audiovideo(self, websocket: WebSocket, room_id: int, user_id: int):
-        if room_id in self.audiovideo_connections:
-            if websocket in self.audiovideo_connections[room_id]:
-                self.audiovideo_connections[room_id].remove(websocket)
-            if room_id in self.audiovideo_voice_users:
-                self.audiovideo_voice_users[room_id].discard(user_id)
-            if not self.audiovideo_connections[room_id]:
-                del self.audiovideo_connections[room_id]
-                del self.audiovideo_voice_users[room_id]
-
-    async def broadcast_audiovideo(self, room_id: int, message: str):
-        if room_id in self.audiovideo_connections:
-            disconnected = []
-            for ws in self.audiovideo_connections[room_id]:
-                try:
-                    await ws.send_text(message)
-                except RuntimeError:
-                    disconnected.append(ws)
-                except Exception as e:
-                    print(f"Failed to send to websocket: {e}")
-                    disconnected.append(ws)
-
-            for ws in disconnected:
-                self.audiovideo_connections[room_id].remove(ws)
-
-
-    async def relay_webrtc_signal(self, room_id: int, to_user_id: int, message: dict):
-        try:
-            if room_id in self.connect_audiovideo_connections:
-                user_map = self.connect_audiovideo_connections[room_id]
-                if to_user_id in user_map:
-                    await user_map[to_user_id].send_json(message)
-        except Exception as e:
-            print(f"Relay error: {e}")
-
-    async def broadcastConnections(self,update_message:str, user_id: int, servers: List[int], friends: List[int] = None):
-        # Broadcast to friends on the main server
-        try:
-            if friends:
-                for connection in self.main_connections:
-                    if connection.user_id in friends:
-                        await connection.send_text(f"{user_id}: {update_message}")
-
-            # Broadcast to users in the same servers
-            for server_id in servers:
-                if server_id in self.server_connections:
-                    for connection in self.server_connections[server_id]:
-                        await connection.send_text(f"{user_id}: {update_message}")
-        except Exception as e:
-            print(f"Error broadcasting connections: {e}")
-            pass
-
 @app.websocket("/api/ws/main/{user_id}")
-async def websocket_main_endpoint(websocket: WebSocket, user_id: int, db: db_dependency):
+async def websocket_main_endpoint(websocket: WebSocket, user_id: int):
     """Handle WebSocket connections for the main server."""
     websocket.user_id = user_id
     await websocket_manager.connect_main(websocket)         # Conect to socket
-    await broadcast_status(user_id,"online", db)            # Broadcast status to all servers
+    await broadcast_status(user_id,"online")            # Broadcast status to all servers
     try:
         while True:
             data = await websocket.receive_text()
@@ -191,23 +85,20 @@ async def websocket_main_endpoint(websocket: WebSocket, user_id: int, db: db_dep
             await websocket_manager.broadcast_main(f"Main Server Update for User {user_id}: {data}")
     except WebSocketDisconnect:
         try:
-            await broadcast_status(user_id,"offline", db)       # Broadcast status to all servers
+            await broadcast_status(user_id,"offline")       # Broadcast status to all servers
         except Exception as e:
             pass
         websocket_manager.disconnect_main(websocket)        # Disconnect from socket
 
     except Exception as e:
         try:
-            await broadcast_status(user_id,"offline", db)       # Broadcast status to all servers
+            await broadcast_status(user_id,"offline")       # Broadcast status to all servers
         except Exception as e:
             pass
         websocket_manager.disconnect_main(websocket)
 
-async def broadcast_status(user_id,status:str, db: db_dependency):
-    servers = db.query(models.ServerMember).filter(models.ServerMember.user_id == user_id).all()       # Get all servers of user
-    servers_owner = db.query(models.Server).filter(models.Server.owner_id == user_id).all()            # Get all servers owned by user
-    servers = [server.server_id for server in servers]                                                 # Get all server ids from memberships
-    servers.extend([server.id for server in servers_owner])                                            # Extend server ids with owned servers
+async def broadcast_status(user_id,status:str):
+    servers = await membership_index.servers_for(user_id)       # Servers the user is a member or owner of (no DB access once warm)
 
     #TODO: Add friends
     friends = None
@@ -257,17 +148,17 @@ async def websocket_audiovideo_endpoint(websocket: WebSocket, room_id: int, user
             msg = json.loads(raw)
             payload = msg.get("message")
             if "joined_call" in payload:
-                websocket_manager.audiovideo_voice_users[room_id].add(user_id)
+                websocket_manager.set_room_state("voice", room_id, user_id, True)
             if "left_call" in payload:
-                websocket_manager.audiovideo_voice_users[room_id].discard(user_id)
+                websocket_manager.set_room_state("voice", room_id, user_id, False)
             if "started_sharing_screen" in payload:
-                websocket_manager.audiovideo_sharingscreen_users[room_id].add(user_id)
+                websocket_manager.set_room_state("sharingscreen", room_id, user_id, True)
             if "stopped_sharing_screen" in payload:
-                websocket_manager.audiovideo_sharingscreen_users[room_id].discard(user_id)
+                websocket_manager.set_room_state("sharingscreen", room_id, user_id, False)
             if "camera_on" in payload:
-                websocket_manager.audiovideo_camera_users[room_id].add(user_id)
+                websocket_manager.set_room_state("camera", room_id, user_id, True)
             if "camera_off" in payload:
-                websocket_manager.audiovideo_camera_users[room_id].discard(user_id)
+                websocket_manager.set_room_state("camera", room_id, user_id, False)
 
 
             # 2) signal (offer/answer/candidate) → broadcast to all (you’ll filter client-side if needed)
@@ -275,12 +166,8 @@ async def websocket_audiovideo_endpoint(websocket: WebSocket, room_id: int, user
 
     except WebSocketDisconnect:
         # 3) on disconnect → broadcast user-left to everyone        
-        if user_id in websocket_manager.audiovideo_voice_users[room_id]:
-            websocket_manager.audiovideo_voice_users[room_id].discard(user_id)
-        if user_id in websocket_manager.audiovideo_sharingscreen_users[room_id]:
-            websocket_manager.audiovideo_sharingscreen_users[room_id].discard(user_id)
-        if user_id in websocket_manager.audiovideo_camera_users[room_id]:
-            websocket_manager.audiovideo_camera_users[room_id].discard(user_id)
+        for state in ("voice", "sharingscreen", "camera"):
+            websocket_manager.set_room_state(state, room_id, user_id, False)
         await websocket_manager.broadcast_audiovideo(room_id, f"user_left_call:${user_id}")
 
 
@@ -293,16 +180,14 @@ async def get_users_connected_server(server_id: int, db: db_dependency) -> List[
     server_rooms = db.query(models.ServerRoom).filter(models.ServerRoom.server_id == server_id).all()
     for server_room in server_rooms:
         if server_room.type == "audio":
-            connected_users.extend(websocket_manager.audiovideo_voice_users.get(server_room.id, []))
+            connected_users.extend(websocket_manager.room_users("voice", server_room.id))
             # return connected_users
     
-    server_members = db.query(models.ServerMember).filter(models.ServerMember.server_id == server_id).all()
-    for server_member in server_members:
-        if any(conn.user_id == server_member.user_id for conn in websocket_manager.main_connections):
-            connected_users.append(server_member.user_id)
-    owner_id = db.query(models.Server).filter(models.Server.id == server_id).first().owner_id
-    if any(conn.user_id == owner_id for conn in websocket_manager.main_connections):
-        connected_users.append(owner_id)
+    member_ids = {user_id for (user_id,) in db.query(models.ServerMember.user_id).filter(models.ServerMember.server_id == server_id)}
+    owner_id = db.query(models.Server.owner_id).filter(models.Server.id == server_id).scalar()
+    if owner_id is not None:
+        member_ids.add(owner_id)
+    connected_users.extend(member_ids & websocket_manager.online_user_ids())
 
     return connected_users
 
@@ -317,7 +202,23 @@ async def get_server_users(server_id: int, db: db_dependency):
 
 
 
-websocket_manager = WebSocketManager()
+websocket_manager = WebSocketManager(create_backplane())
+
+@app.on_event("startup")
+async def start_websocket_backplane():
+    await websocket_manager.start()
+
+@app.on_event("shutdown")
+async def stop_websocket_backplane():
+    await websocket_manager.stop()
+
+@app.on_event("shutdown")
+def stop_image_workers():
+    image_derivatives.shutdown()
+
+
+# the bodies of the routes taking attachments (UploadFile) are size-checked before being parsed
+app.add_middleware(AttachmentBodyLimit)
 
 app.add_middleware(
     CORSMiddleware,
@@ -332,10 +233,23 @@ app.add_middleware(
 MONGO_DATABASE_URL = "mongodb://127.0.0.1:27017"
 mongo_client = AsyncIOMotorClient(MONGO_DATABASE_URL)
 mongo_db = mongo_client.uniVerse
+mongo_collections = MongoCollections(mongo_db)
+overview_snapshots = OverviewSnapshots(mongo_db, mongo_collections)
+attachment_store = AttachmentStore(mongo_db)
+resumable_uploads = ResumableUploads(mongo_db, attachment_store)
+
+@app.on_event("startup")
+async def backfill_mongo_indexes():
+    await overview_snapshots.ensure_indexes()
+    await attachment_store.ensure_indexes()
+    await resumable_uploads.ensure_indexes()
+    # runs in the background, startup should not wait for every existing collection
+    asyncio.create_task(mongo_collections.backfill_indexes())
+    asyncio.create_task(resumable_uploads.run_cleanup())
 
 
 
-IMAGE_DIR = "user_images"  # Directory to store user images
+IMAGE_MAX_AGE = 3600  # seconds browsers may reuse a picture without revalidating
 os.makedirs(IMAGE_DIR, exist_ok=True)
 
 
@@ -355,44 +269,107 @@ def save_image_to_filesystem(image_url: str, filename: str) -> str:
         file_path = os.path.join(IMAGE_DIR, filename)
         with open(file_path, "wb") as f:
             f.write(response.content)
+        image_derivatives.pregenerate(file_path)
         return file_path
     else:
         logging.error(f"Failed to fetch image from URL: {image_url}")
         raise HTTPException(status_code=400, detail="Failed to retrieve user picture")
 
-def get_current_user(db: db_dependency, Authorization: str = Header(...)):
-    try:
-        if not Authorization:
-            logger.error("Authorization header missing")
-            raise HTTPException(status_code=401, detail="Authorization header missing")
-        if not Authorization.startswith("Bearer "):
-            logger.error("Invalid Authorization header format")
-            raise HTTPException(status_code=401, detail="Invalid Authorization header")
-        token = Authorization.replace("Bearer ", "")
-        if not token:
-            logger.error("Token is empty")
-            raise HTTPException(status_code=401, detail="Invalid token")
-        user = db.query(models.User).filter(models.User.token == token).first()
-        if not user:
-            logger.error(f"No user found for token: {token}")
+# token -> AuthUser, so repeated requests with the same bearer token skip the user lookup.
+# With several workers a rotated token is dropped on the others through the backplane; if
+# that publish fails it keeps resolving there until the entry expires, so entries live shorter.
+TOKEN_CACHE_TTL = 15 if REDIS_URL else 300  # seconds
+token_cache = TTLCache(maxsize=10000, ttl=TOKEN_CACHE_TTL)
+
+async def invalidate_token(token: Optional[str]):
+    """Drop a token from the auth cache of every worker (call after rotating a user's token)."""
+    if token:
+        await websocket_manager.invalidate_cache("token", token=token)
+
+# Per-process caches, invalidated on every worker through the websocket backplane.
+# An event without keys (backplane reconnected) drops the whole cache.
+def drop_cached_token(event: dict):
+    if "token" in event:
+        token_cache.pop(event["token"])
+    else:
+        token_cache.clear()
+
+def drop_cached_membership(event: dict):
+    if "user_id" not in event:
+        membership_index.clear()
+    elif event.get("joined_server_id") is not None:
+        membership_index.add(event["user_id"], event["joined_server_id"])
+    else:
+        membership_index.invalidate(event["user_id"])
+
+def drop_cached_attendance_totals(event: dict):
+    if "server_id" in event:
+        attendance_totals.invalidate(event["server_id"])
+    else:
+        attendance_totals.clear()
+
+websocket_manager.on_cache_event("token", drop_cached_token)
+websocket_manager.on_cache_event("access", lambda event: ServerAccess.invalidate(event.get("user_id"), event.get("server_id")))
+websocket_manager.on_cache_event("membership", drop_cached_membership)
+websocket_manager.on_cache_event("attendance_totals", drop_cached_attendance_totals)
+
+async def authenticate_token(token: Optional[str], db: AsyncSession) -> AuthUser:
+    if not token:
+        logger.error("Token is empty")
+        raise HTTPException(status_code=401, detail="Invalid token")
+    user = token_cache.get(token)
+    if user is None:
+        db_user = await db.scalar(select(models.User).where(models.User.token == token))
+        if not db_user:
+            logger.error("No user found for token")
             raise HTTPException(status_code=401, detail="Invalid token")
-        if user.token_expiry < datetime.now(tz=timezone.utc):
-            logger.error(f"Token expired for user: {user.id}")
-            raise HTTPException(status_code=401, detail="Token expired")
-        return user
-    except Exception as e:
-        logger.error(f"Error in get_current_user: {str(e)}")
-        raise HTTPException(status_code=401, detail=f"Unauthorized: {str(e)}")
+        user = AuthUser.model_validate(db_user)
+        token_cache.set(token, user)
+    if user.token_expiry < datetime.now():
+        token_cache.pop(token)
+        logger.error(f"Token expired for user: {user.id}")
+        raise HTTPException(status_code=401, detail="Token expired")
+    return user
+
+async def get_current_user(db: async_db_dependency, Authorization: Optional[str] = Header(None)) -> AuthUser:
+    if not Authorization:
+        logger.error("Authorization header missing")
+        raise HTTPException(status_code=401, detail="Authorization header missing")
+    if not Authorization.startswith("Bearer "):
+        logger.error("Invalid Authorization header format")
+        raise HTTPException(status_code=401, detail="Invalid Authorization header")
+    token = Authorization.replace("Bearer ", "")
+    return await authenticate_token(token, db)
+
+
+current_user_dependency = Annotated[AuthUser, Depends(get_current_user)]
+
+def get_server_access(db: async_db_dependency) -> ServerAccess:
+    return ServerAccess(db)
+
+
+server_access_dependency = Annotated[ServerAccess, Depends(get_server_access)]
 
 # Get user profile picture from the filesystem
 @app.get("/api/images/{image_name}")
-async def serve_image(image_name: str):
-    """Endpoint to serve user images."""
+async def serve_image(image_name: str, request: Request, size: Optional[int] = None):
+    """Endpoint to serve user images, `size` (32/64/128) returns a square WebP thumbnail."""
     image_name = unquote(image_name)    # Decode the image name from url
-    file_path = os.path.join(IMAGE_DIR, image_name)
-    if not os.path.exists(file_path):
+    file_path = safe_join(IMAGE_DIR, image_name)
+    if not file_path:
         raise HTTPException(status_code=404, detail="Image not found")
-    return FileResponse(file_path)
+    if size is not None and size not in THUMBNAIL_SIZES:
+        raise HTTPException(status_code=400, detail=f"size must be one of {', '.join(map(str, THUMBNAIL_SIZES))}")
+    if size is not None and thumbnails_available():
+        try:
+            file_path = await image_derivatives.get(file_path, size)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Image not found")
+        except Exception as e:
+            # an image Pillow cannot read is still served as is
+            logger.error(f"Failed to render {size}px derivative of {image_name}: {e}")
+    # pictures can be replaced under the same name, so clients revalidate after IMAGE_MAX_AGE
+    return await file_response(request, file_path, cache_control=f"public, max-age={IMAGE_MAX_AGE}", not_found="Image not found")
 
 
 # Google authentication
@@ -446,13 +423,16 @@ def google_auth(token_request: UserIn, db: db_dependency):
             refresh_token_expiry=datetime.now() + timedelta(days=7)
         )
         db.add(db_user)
+        old_token = None
     else:
+        old_token = db_user.token
         db_user.token = token_request.id_token
         db_user.token_expiry = datetime.now() + timedelta(days=1)
         db_user.refresh_token_expiry = datetime.now() + timedelta(days=7)
 
     db.commit()
     db.refresh(db_user)
+    from_thread.run(invalidate_token, old_token)    # old token must not keep resolving from the auth cache
 
     # Create the user response
     db_user_data = {
@@ -477,10 +457,12 @@ def refresh_tokens(token_request: TokenRequest, db: db_dependency):
     if db_user.refresh_token_expiry < datetime.now():
         raise HTTPException(status_code=400, detail="Refresh token expired")
 
+    old_token = db_user.token
     db_user.token = generate_token()
     db_user.token_expiry = datetime.now() + timedelta(days=1)
     db.commit()
     db.refresh(db_user)
+    from_thread.run(invalidate_token, old_token)    # old token must not keep resolving from the auth cache
     
     # Convert binary picture to base64 string for the response
     user_response = User(
@@ -582,6 +564,7 @@ async def create_server(server: ServerCreate, db: db_dependency):
     db.add(db_server)
     db.commit()
     db.refresh(db_server)
+    await websocket_manager.invalidate_cache("membership", user_id=db_server.owner_id, joined_server_id=db_server.id)
 
     # Create the first week for the server
     first_week = models.ServerWeek(
@@ -589,20 +572,12 @@ async def create_server(server: ServerCreate, db: db_dependency):
         week_number=1
     )
     db.add(first_week)
-    db.commit()
-    db.refresh(first_week)
+    db.flush()
 
     # Add "absent" attendance for each member with access_level 0
-    members = db.query(models.ServerMember).filter_by(server_id=db_server.id, access_level=0).all()
-    for member in members:
-        attendance = models.Attendance(
-            user_id=member.user_id,
-            server_id=db_server.id,
-            date=datetime.now(),
-            status="absent",
-            week=first_week
-        )
-        db.add(attendance)
+    student_ids = [user_id for user_id, in db.query(models.ServerMember.user_id).filter_by(server_id=db_server.id, access_level=0)]
+    for statement, rows in seed_statements(absent_rows(db_server.id, student_ids, [first_week.id])):
+        db.execute(statement, rows)
     db.commit()
 
     return db_server
@@ -636,6 +611,7 @@ async def edit_server(server_id: int, server_name: str, server_description: str,
     db_server.description = server_description
     db.commit()
     db.refresh(db_server)
+    await overview_snapshots.invalidate(server_id=server_id)
     
     # broadcast "server_updated" to all members
     await websocket_manager.broadcast_server(server_id, "server_updated")
@@ -650,44 +626,19 @@ class ServerWithAccessLevel(Server):
     access_level: int
 
 @app.post("/api/server", response_model=ServerWithAccessLevel)
-def get_server(server_info: GetServer, db: db_dependency, Authorization: Optional[str] = Header(None)):
-    # extract user from token
-    token = Authorization.split(" ")[1] if Authorization else None
-    if not token:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    db_user = db.query(models.User).filter(models.User.token == token).first()
-    if not db_user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+async def get_server(server_info: GetServer, db: async_db_dependency, db_user: current_user_dependency, access: server_access_dependency):
     user_id = db_user.id
 
     try:
-        db_server = db.query(models.Server).filter(models.Server.id == server_info.server_id).first()
+        db_server = await db.scalar(select(models.Server).where(models.Server.id == server_info.server_id))
         if not db_server:
             raise HTTPException(status_code=404, detail="Server not found")
-        
-        is_member = db.query(models.ServerMember).filter(
-            models.ServerMember.user_id == user_id,
-            models.ServerMember.server_id == server_info.server_id
-        ).first()
 
-        is_owner = db.query(models.Server).filter(
-            models.Server.id == server_info.server_id,
-            models.Server.owner_id == user_id
-        ).first()
-        
-        # get access level
-        access_level = 0
-        if is_member:
-            access_level = is_member.access_level
-        elif is_owner:
-            access_level = 3
-        # If the user is not a member, raise an exception
-        if not is_member and not is_owner:
-            raise HTTPException(status_code=403, detail="User is not a member of the server")
+        # get access level (members first, then owner), raises 403 if the user has none
+        server_access = await access.require(user_id, db_server.id, detail="User is not a member of the server")
         
         # add weeks to the server
-        weeks = db.query(models.ServerWeek).filter(models.ServerWeek.server_id == db_server.id).all()
-        db_server.weeks = [week for week in weeks]  # Convert to list of ServerWeek objects
+        weeks = (await db.scalars(select(models.ServerWeek).where(models.ServerWeek.server_id == db_server.id))).all()
         # Create the response model with access level
         server_response = ServerWithAccessLevel(
             id=db_server.id,
@@ -696,8 +647,8 @@ def get_server(server_info: GetServer, db: db_dependency, Authorization: Optiona
             owner_id=db_server.owner_id,
             invite_code=db_server.invite_code,
             created_at=db_server.created_at,
-            weeks=db_server.weeks,  # Include the weeks in the response
-            access_level=access_level  # Add access level to the response
+            weeks=weeks,  # Include the weeks in the response
+            access_level=server_access.access_level  # Add access level to the response
         )
         
         # Return the server details if checks pass
@@ -708,14 +659,7 @@ def get_server(server_info: GetServer, db: db_dependency, Authorization: Optiona
 
 
 @app.get("/api/server/{server_id}/room/{room_id}", response_model=ServerRoom)
-def get_room(server_id: int, room_id: int, db: db_dependency, authorization: Optional[str] = Header(None)):
-    # extract user from token
-    token = authorization.split(" ")[1] if authorization else None
-    if not token:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    db_user = db.query(models.User).filter(models.User.token == token).first()
-    if not db_user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+def get_room(server_id: int, room_id: int, db: db_dependency, db_user: current_user_dependency):
     user_id = db_user.id
     db_room = db.query(models.ServerRoom).filter(models.ServerRoom.id == room_id).first()
     if not db_room:
@@ -737,15 +681,8 @@ def get_room(server_id: int, room_id: int, db: db_dependency, authorization: Opt
 class JoinServer(BaseModel):
     invite_code: str
 @app.post("/api/server/join", response_model=Server)
-async def join_server(server_info: JoinServer, db: db_dependency, Authorization: Optional[str] = Header(None)):
+async def join_server(server_info: JoinServer, db: db_dependency, db_user: current_user_dependency):
     try:
-        # extract user from token
-        token = Authorization.split(" ")[1] if Authorization else None
-        if not token:
-            raise HTTPException(status_code=401, detail="Unauthorized")
-        db_user = db.query(models.User).filter(models.User.token == token).first()
-        if not db_user:
-            raise HTTPException(status_code=401, detail="Unauthorized")
         user_id = db_user.id
         # Check if the invite code is provided
         if not server_info.invite_code:
@@ -777,19 +714,15 @@ async def join_server(server_info: JoinServer, db: db_dependency, Authorization:
         db.add(db_member)
 
         # initialize all the attendance to absent for all weeks
-        weeks = db.query(models.ServerWeek).filter(models.ServerWeek.server_id == db_server.id).all()
-        for week in weeks:
-            attendance = models.Attendance(
-                user_id=user_id,
-                server_id=db_server.id,                
-                date=datetime.now(),
-                status="absent",
-                week_id=week.id  # Use week.id instead of the entire week object
-            )
-            db.add(attendance)
+        week_ids = [week_id for week_id, in db.query(models.ServerWeek.id).filter(models.ServerWeek.server_id == db_server.id)]
+        for statement, rows in seed_statements(absent_rows(db_server.id, [user_id], week_ids)):
+            db.execute(statement, rows)
 
 
         db.commit()
+        await websocket_manager.invalidate_cache("access", user_id=user_id, server_id=db_server.id)
+        await websocket_manager.invalidate_cache("membership", user_id=user_id, joined_server_id=db_server.id)
+        await overview_snapshots.invalidate(server_id=db_server.id)
 
         await websocket_manager.broadcast_server(server_id=db_server.id, message=f"{db_user.id}: joined")
 
@@ -849,6 +782,7 @@ async def create_room(server_id: int, room_name: str, room_type: str, db: db_dep
     db.add(db_room)
     db.commit()
     db.refresh(db_room)
+    await overview_snapshots.invalidate(server_id=server_id)
 
     await websocket_manager.broadcast_server(server_id, "rooms_updated")
     return db_room
@@ -862,9 +796,10 @@ async def delete_room(server_id: int, room_id: int, db: db_dependency):
     db.delete(db_room)
     db.commit()
 
-    # delete from mongoDB aswell
-    collection_name = f"server_{server_id}_room_{room_id}"
-    mongo_db.drop_collection(collection_name)
+    # delete from mongoDB aswell, the messages' attachments go with them
+    await attachment_store.release_collection(room_collection_name(server_id, room_id))
+    await mongo_collections.drop(server_id, "room", room_id)
+    await overview_snapshots.invalidate(server_id=server_id)
 
     await websocket_manager.broadcast_server(server_id, "rooms_updated")
     await websocket_manager.broadcast_textroom(room_id, "room_deleted")
@@ -887,18 +822,15 @@ class AccessIn(BaseModel):
     server_id: int
 
 @app.post("/api/server/access", response_model=int)
-async def check_access(access_info: AccessIn, db: db_dependency):
-    user = db.query(models.User).filter(models.User.token == access_info.token).first()
-    if not user:
+async def check_access(access_info: AccessIn, db: async_db_dependency, access: server_access_dependency):
+    user_id = await db.scalar(select(models.User.id).where(models.User.token == access_info.token))
+    if not user_id:
         raise HTTPException(status_code=404, detail="User not found")
     
     #get "access_level"
-    member = db.query(models.ServerMember).filter(models.ServerMember.user_id == user.id, models.ServerMember.server_id == access_info.server_id).first()
-    if (member):
-        return member.access_level if member.access_level else 0
-    server_owner = db.query(models.Server).filter(models.Server.id == access_info.server_id).first().owner_id
-    if user.id == server_owner:
-        return 3
+    server_access = await access.get(user_id, access_info.server_id)
+    if server_access and server_access.has_access:
+        return server_access.access_level
     else:
         raise HTTPException(status_code=404, detail="User not found in server")
 
@@ -1004,17 +936,16 @@ class CategoryResponse(BaseModel):
 
 # Endpoint to get categories and rooms for a server
 @app.get("/api/server/{server_id}/categories", response_model=List[CategoryResponse])
-def get_categories_and_rooms(server_id: int, db: Session = Depends(get_db)):
+async def get_categories_and_rooms(server_id: int, db: async_db_dependency):
     # Retrieve all categories for the given server
-    categories = (
-        db.query(models.RoomCategory)
-        .filter(models.RoomCategory.server_id == server_id)
+    categories = (await db.scalars(
+        select(models.RoomCategory)
+        .where(models.RoomCategory.server_id == server_id)
         .order_by(models.RoomCategory.position)
-        .all()
-    )
+    )).all()
     
     # Retrieve all rooms and group them by their category
-    rooms = db.query(models.ServerRoom).filter(models.ServerRoom.server_id == server_id).all()
+    rooms = (await db.scalars(select(models.ServerRoom).where(models.ServerRoom.server_id == server_id))).all()
     room_map = {}
     for room in rooms:
         if room.category_id not in room_map:
@@ -1053,14 +984,58 @@ def get_categories_and_rooms(server_id: int, db: Session = Depends(get_db)):
 
 @app.get("/api/room/{room_id}/users")
 def get_voice_users(room_id: int):
-    users = list(websocket_manager.audiovideo_voice_users.get(room_id, []))
+    users = list(websocket_manager.room_users("voice", room_id))
     return {"userIds": users}
 
 
 # mount upload folder
-UPLOAD_DIR = os.path.join(os.path.dirname(__file__), "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+os.makedirs(TMP_DIR, exist_ok=True)
+
+# legacy {uuid}_{filename} uploads, the names are unique so they never change
+@app.api_route("/uploads/{file_path:path}", methods=["GET", "HEAD"])
+async def serve_upload(file_path: str, request: Request):
+    path = safe_join(UPLOAD_DIR, file_path)
+    # unfinished uploads live in TMP_DIR, blobs are served by /api/attachments
+    if not path or is_within(path, TMP_DIR) or is_within(path, BLOB_DIR):
+        raise HTTPException(status_code=404, detail="Not Found")
+    return await file_response(request, path, cache_control=IMMUTABLE_CACHE_CONTROL, not_found="Not Found")
+
+# content-addressed attachments (see attachments.py), the file name only sets the download name
+@app.get("/api/attachments/{digest}/{filename}")
+async def serve_attachment(digest: str, filename: str, request: Request):
+    if not DIGEST.match(digest):
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    return await file_response(
+        request,
+        blob_path(digest),
+        etag=digest,
+        cache_control=IMMUTABLE_CACHE_CONTROL,
+        filename=filename,
+        not_found="Attachment not found"
+    )
+
+
+# resumable uploads for large files (see uploads.py)
+class UploadInitRequest(BaseModel):
+    filename: str
+    size: int = Field(..., ge=1)
+
+@app.post("/api/uploads")
+async def init_upload(request: UploadInitRequest, user: current_user_dependency):
+    return await resumable_uploads.create(user.id, request.filename, request.size)
+
+@app.get("/api/uploads/{upload_id}")
+async def get_upload_status(upload_id: str, user: current_user_dependency):
+    return await resumable_uploads.status(upload_id, user.id)
+
+@app.put("/api/uploads/{upload_id}/chunks/{index}")
+async def put_upload_chunk(upload_id: str, index: int, request: Request, user: current_user_dependency):
+    return await resumable_uploads.put_chunk(upload_id, user.id, index, request.stream())
+
+@app.post("/api/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, user: current_user_dependency):
+    return await resumable_uploads.complete(upload_id, user.id)
 
 
 # @app.post("/api/upload")
@@ -1086,7 +1061,7 @@ from fastapi import Form, File, UploadFile, Depends
 from typing import List, Optional
 
 @app.post("/api/message", response_model=MessageResponse)
-async def store_message(db: db_dependency,
+async def store_message(db: async_db_dependency,
     message: str = Form(...),
     
     user_token: str = Form(...),
@@ -1096,32 +1071,26 @@ async def store_message(db: db_dependency,
     attachments: List[UploadFile] = File(default=[]),      # <— accept files here
 ) -> MessageResponse:
     # Get user from token
-    db_user = db.query(models.User).filter(models.User.token == user_token).first()
-    if not db_user:
-        raise HTTPException(status_code=400, detail="Invalid user token")
-
-    if db_user.token_expiry < datetime.now():
-        raise HTTPException(status_code=400, detail="Token expired")
+    db_user = await authenticate_token(user_token, db)
 
     # Check room & membership (unchanged)…
-    server_room = db.query(models.ServerRoom).filter(models.ServerRoom.id == room_id).first()
+    server_room = await db.scalar(select(models.ServerRoom).where(models.ServerRoom.id == room_id))
     if not server_room:
         raise HTTPException(status_code=404, detail="Room not found")
-    server = db.query(models.Server).filter(models.Server.id == server_room.server_id).first()
+    server = await db.scalar(select(models.Server).where(models.Server.id == server_room.server_id))
     # …membership checks as before…
 
+    collection = await mongo_collections.room(server.id, room_id)
+    message_id = ObjectId()
+
     # Save uploaded files to disk and collect URLs
     file_urls: List[str] = []
-    for upload in attachments:
-        # ext = upload.filename.split(".")[-1]
-        name = f"{uuid.uuid4().hex}_{upload.filename}"
-        dest = os.path.join(UPLOAD_DIR, name)
-        with open(dest, "wb") as out:
-            out.write(await upload.read())
-        file_urls.append(f"http://lamzaone.go.ro:8000/uploads/{name}")
+    for stored in await attachment_store.save(attachments, attachment_owner(collection.name, message_id)):
+        file_urls.append(stored.url)
 
     # Prepare message_data (include attachments URLs)
     message_data = {
+        "_id": message_id,
         "message": message,
         "user_id": db_user.id,
         "room_id": room_id,
@@ -1132,8 +1101,11 @@ async def store_message(db: db_dependency,
     }
 
     # Insert into Mongo, broadcast, and return (unchanged)…
-    collection = mongo_db[f"server_{server.id}_room_{room_id}"]
-    result = await collection.insert_one(message_data)
+    try:
+        result = await collection.insert_one(message_data)
+    except Exception:
+        await attachment_store.release(attachment_owner(collection.name, message_id))
+        raise
     await websocket_manager.broadcast_textroom(room_id, "new_message")
 
     return MessageResponse(
@@ -1148,47 +1120,20 @@ async def store_message(db: db_dependency,
     )
 
 @app.post("/api/messages/", response_model=List[MessageResponse])
-async def get_messages(request: MessagesRetrieve, db: db_dependency, authorization: Optional[str] = Header(None)):
-    # Extract token from Authorization header
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-
-    token = authorization.replace("Bearer ", "")
-
-    # Verify the user token
-    db_user = db.query(models.User).filter(models.User.token == token).first()
-    if not db_user:
-        raise HTTPException(status_code=400, detail="Invalid token")
-
-    if db_user.token_expiry < datetime.now():
-        raise HTTPException(status_code=400, detail="Token expired")
-
+async def get_messages(request: MessagesRetrieve, db: async_db_dependency, db_user: current_user_dependency, access: server_access_dependency):
     # Get the server from the room ID
-    room = db.query(models.ServerRoom).filter(models.ServerRoom.id == request.room_id).first()
-    if not room:
+    server_id = await db.scalar(select(models.ServerRoom.server_id).where(models.ServerRoom.id == request.room_id))
+    if not server_id:
         raise HTTPException(status_code=404, detail="Room not found")
 
-    server = db.query(models.Server).filter(models.Server.id == room.server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-
     # Check if the user is a member of the server or the server owner
-    server_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == db_user.id, 
-        models.ServerMember.server_id == server.id
-    ).first()
-    server_owner = db.query(models.Server).filter(
-        models.Server.id == server.id, 
-        models.Server.owner_id == db_user.id
-    ).first()
-    if not server_member and not server_owner:
-        raise HTTPException(status_code=403, detail="User is not part of the server")
+    await access.require(db_user.id, server_id, detail="User is not part of the server")
 
-    # Generate the collection name based on server and room ID
-    collection_name = f"server_{server.id}_room_{request.room_id}"
+    # Get the collection for this server and room (indexes are created on first use)
+    collection = await mongo_collections.room(server_id, request.room_id)
 
     # Retrieve the last 100 messages from the specific collection in MongoDB
-    messages = await mongo_db[collection_name].find({}).sort("timestamp", -1).limit(100).to_list(length=100)
+    messages = await collection.find({}).sort("timestamp", -1).limit(100).to_list(length=100)
 
     # Reverse the order of the messages
     messages.reverse()
@@ -1199,32 +1144,86 @@ async def get_messages(request: MessagesRetrieve, db: db_dependency, authorizati
 
     return messages
 
+async def parse_message_cursor(collection, cursor: str):
+    """Returns the (timestamp, _id) bound for a cursor, _id is None for timestamp cursors."""
+    if ObjectId.is_valid(cursor):
+        message = await collection.find_one({"_id": ObjectId(cursor)}, {"timestamp": 1})
+        if not message:
+            raise HTTPException(status_code=404, detail="Cursor message not found")
+        return message["timestamp"], message["_id"]
+    try:
+        return datetime.fromisoformat(cursor), None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def message_range(op: str, timestamp: datetime, message_id: Optional[ObjectId]) -> dict:
+    # ties on timestamp are broken by _id so pages never overlap
+    if message_id is None:
+        return {"timestamp": {op: timestamp}}
+    return {"$or": [
+        {"timestamp": {op: timestamp}},
+        {"timestamp": timestamp, "_id": {op: message_id}},
+    ]}
+
+@app.post("/api/messages/page", response_model=MessagesPage)
+async def get_messages_page(request: MessagesPageRetrieve, db: async_db_dependency, db_user: current_user_dependency, access: server_access_dependency):
+    if request.before and request.after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+
+    server_id = await db.scalar(select(models.ServerRoom.server_id).where(models.ServerRoom.id == request.room_id))
+    if not server_id:
+        raise HTTPException(status_code=404, detail="Room not found")
+
+    await access.require(db_user.id, server_id, detail="User is not part of the server")
+
+    collection = await mongo_collections.room(server_id, request.room_id)
+
+    # Walk the index away from the cursor and fetch one extra document to know if more exist
+    if request.after:
+        query = message_range("$gt", *await parse_message_cursor(collection, request.after))
+        direction = 1
+    elif request.before:
+        query = message_range("$lt", *await parse_message_cursor(collection, request.before))
+        direction = -1
+    else:
+        query = {}
+        direction = -1
+
+    messages = await collection.find(query).sort([("timestamp", direction), ("_id", direction)]).limit(request.limit + 1).to_list(length=request.limit + 1)
+    has_more = len(messages) > request.limit
+    messages = messages[:request.limit]
+    if direction == -1:
+        messages.reverse()
+
+    for message in messages:
+        message['_id'] = str(message['_id'])
+
+    # an empty page keeps the incoming cursor, so the client can still page from it
+    oldest = messages[0]['_id'] if messages else request.after
+    newest = messages[-1]['_id'] if messages else request.before
+    if request.after:
+        # everything up to the cursor is older, so there is always a previous page
+        next_before, next_after = oldest, (newest if has_more else None)
+    else:
+        next_before, next_after = (oldest if has_more else None), (newest if request.before else None)
+
+    return MessagesPage(messages=messages, next_before=next_before, next_after=next_after)
+
 @app.put("/api/message/edit", response_model=MessageResponse)
 async def edit_message(
     db: db_dependency,
+    db_user: current_user_dependency,
     message_id: str = Form(...),
     room_id: int = Form(...),
     message: str = Form(...),
     attachments: List[UploadFile] = File(default=[]),  # Accept files here
-    Authorization: Optional[str] = Header(None),
 ):
-    # Extract token from Authorization header
-    if not Authorization or not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = Authorization.replace("Bearer ", "")
-    # Verify the user token
-    db_user = db.query(models.User).filter(models.User.token == token).first()
-    if not db_user:
-        raise HTTPException(status_code=400, detail="Invalid token")
-    if db_user.token_expiry < datetime.now():
-        raise HTTPException(status_code=400, detail="Token expired")
     # Get the message from MongoDB
     server_room = db.query(models.ServerRoom).filter(models.ServerRoom.id == room_id).first()
     if not server_room:
         raise HTTPException(status_code=404, detail="Room not found")
 
-    collection_name = f"server_{server_room.server_id}_room_{server_room.id}"
-    collection = mongo_db[collection_name]
+    collection = await mongo_collections.room(server_room.server_id, server_room.id)
     message_data = await collection.find_one({"_id": ObjectId(message_id)})
 
     # check if user can edit the message
@@ -1241,12 +1240,8 @@ async def edit_message(
 
     # Save uploaded files to disk and collect URLs
     file_urls: List[str] = []
-    for upload in attachments:
-        name = f"{uuid.uuid4().hex}_{upload.filename}"
-        dest = os.path.join(UPLOAD_DIR, name)
-        with open(dest, "wb") as out:
-            out.write(await upload.read())
-        file_urls.append(f"http://lamzaone.go.ro:8000/uploads/{name}")
+    for stored in await attachment_store.save(attachments, attachment_owner(collection.name, message_id)):
+        file_urls.append(stored.url)
 
     # Add attachments URLs to the message data
     message_data["attachments"].extend(file_urls)
@@ -1274,24 +1269,20 @@ async def edit_message(
 
 
 @app.post("/api/assignment", response_model=AssignmentResponse)
-async def store_message(db: db_dependency,
+async def store_message(db: async_db_dependency,
     message: str = Form(...),
     user_token: str = Form(...),
     room_id: int = Form(...),
     is_private: bool = Form(...),
     reply_to: Optional[str] = Form(None),
     attachments: List[UploadFile] = File(default=[]),      # <— accept files here
+    upload_ids: List[str] = Form(default=[]),  # completed resumable uploads (/api/uploads)
 ) -> AssignmentResponse:
     # Get user from token
-    db_user = db.query(models.User).filter(models.User.token == user_token).first()
-    if not db_user:
-        raise HTTPException(status_code=400, detail="Invalid user token")
-
-    if db_user.token_expiry < datetime.now():
-        raise HTTPException(status_code=400, detail="Token expired")
+    db_user = await authenticate_token(user_token, db)
 
     # Check room & membership (unchanged)…
-    server_room = db.query(models.ServerRoom).filter(models.ServerRoom.id == room_id).first()
+    server_room = await db.scalar(select(models.ServerRoom).where(models.ServerRoom.id == room_id))
     if not server_room:
         raise HTTPException(status_code=404, detail="Room not found")
     # if datetime(server_room.name.split(" ")[1]) < datetime.now():
@@ -1299,34 +1290,39 @@ async def store_message(db: db_dependency,
     # if timedelta(days=1) < datetime.now() - datetime(server_room.name.split(" ")[2]):
     #     raise HTTPException(status_code=400, detail="Assignment expired")
 
-    server = db.query(models.Server).filter(models.Server.id == server_room.server_id).first()
+    server = await db.scalar(select(models.Server).where(models.Server.id == server_room.server_id))
     # …membership checks as before…
 
-    # Save uploaded files to disk and collect URLs
-    file_urls: List[str] = []
-    for upload in attachments:
-        # ext = upload.filename.split(".")[-1]
-        name = f"{uuid.uuid4().hex}_{upload.filename}"
-        dest = os.path.join(UPLOAD_DIR, name)
-        with open(dest, "wb") as out:
-            out.write(await upload.read())
-        file_urls.append(f"http://lamzaone.go.ro:8000/uploads/{name}")
+    collection = await mongo_collections.assignments(server.id, room_id)
+    message_id = ObjectId()
+    owner = attachment_owner(collection.name, message_id)
 
-    # Prepare message_data (include attachments URLs)
-    message_data = {
-        "message": message,
-        "user_id": db_user.id,
-        "room_id": room_id,
-        "is_private": is_private,
-        "reply_to": reply_to,
-        "attachments": file_urls,
-        "grade": None,  # Assignments start with no grade
-        "timestamp": datetime.now(),
-    }
+    # Save uploaded files to disk first (nothing is kept if one of them fails)
+    saved = await attachment_store.save(attachments, owner)
+    try:
+        # completed resumable uploads are only consumed once the message is stored
+        attached = await resumable_uploads.attach(upload_ids, db_user.id, owner)
+
+        # Prepare message_data (include attachments URLs)
+        message_data = {
+            "_id": message_id,
+            "message": message,
+            "user_id": db_user.id,
+            "room_id": room_id,
+            "is_private": is_private,
+            "reply_to": reply_to,
+            "attachments": [stored.url for stored in attached + saved],
+            "grade": None,  # Assignments start with no grade
+            "timestamp": datetime.now(),
+        }
 
-    # Insert into Mongo, broadcast, and return (unchanged)…
-    collection = mongo_db[f"server_{server.id}_assignments_{room_id}"]
-    result = await collection.insert_one(message_data)
+        # Insert into Mongo, broadcast, and return (unchanged)…
+        result = await collection.insert_one(message_data)
+    except Exception:
+        await attachment_store.release(owner)
+        raise
+    await resumable_uploads.consume(upload_ids)
+    await overview_snapshots.submissions_changed(db, server.id, [(room_id, None, message_data)])
 
     
     await websocket_manager.broadcast_textroom(room_id, "new_message")
@@ -1344,69 +1340,39 @@ async def store_message(db: db_dependency,
     )
 
 @app.post("/api/assignments/", response_model=List[AssignmentResponse])
-async def get_messages(request: AssignmentsRetrieve, db: db_dependency, authorization: Optional[str] = Header(None)):
-    # Extract token from Authorization header
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-
-    token = authorization.replace("Bearer ", "")
-
-    # Verify the user token
-    db_user = db.query(models.User).filter(models.User.token == token).first()
-    if not db_user:
-        raise HTTPException(status_code=400, detail="Invalid token")
-
-    if db_user.token_expiry < datetime.now():
-        raise HTTPException(status_code=400, detail="Token expired")
-
+async def get_messages(request: AssignmentsRetrieve, db: async_db_dependency, db_user: current_user_dependency, access: server_access_dependency):
     # Get the server from the room ID
-    room = db.query(models.ServerRoom).filter(models.ServerRoom.id == request.room_id).first()
-    if not room:
+    server_id = await db.scalar(select(models.ServerRoom.server_id).where(models.ServerRoom.id == request.room_id))
+    if not server_id:
         raise HTTPException(status_code=404, detail="Room not found")
 
-    server = db.query(models.Server).filter(models.Server.id == room.server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-
     # Check if the user is a member of the server or the server owner
-    server_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == db_user.id, 
-        models.ServerMember.server_id == server.id
-    ).first()
-    server_owner = db.query(models.Server).filter(
-        models.Server.id == server.id, 
-        models.Server.owner_id == db_user.id
-    ).first()
-    if not server_member and not server_owner:
-        raise HTTPException(status_code=403, detail="User is not part of the server")
+    server_access = await access.require(db_user.id, server_id, detail="User is not part of the server")
 
-    # Generate the collection name based on server and room ID
-    collection_name = f"server_{server.id}_assignments_{request.room_id}"
+    # Get the collection for this server and room (indexes are created on first use)
+    collection = await mongo_collections.assignments(server_id, request.room_id)
 
     # Retrieve the last 100 messages from the specific collection in MongoDB
-    # messages = await mongo_db[collection_name].find({}).sort("timestamp", -1).limit(100).to_list(length=100)
+    # messages = await collection.find({}).sort("timestamp", -1).limit(100).to_list(length=100)
     #check if db_user is server owner or level 2
-    if server_owner or (server_member and server_member.access_level > 0):
-        messages = await mongo_db[collection_name].find({}).sort("timestamp", -1).to_list(length=1000)
+    if server_access.is_admin:
+        messages = await collection.find({}).sort("timestamp", -1).to_list(length=1000)
     else:
-        messages = await mongo_db[collection_name].find({"user_id": db_user.id}).sort("timestamp", -1).to_list(length=1000)
+        messages = await collection.find({"user_id": db_user.id}).sort("timestamp", -1).to_list(length=1000)
         # Add messages from server owner or users with access_level > 0 that don't have a "reply_to" field
-        elevated_user_ids = [
-            member.user_id for member in db.query(models.ServerMember)
-            .filter(
-                models.ServerMember.server_id == server.id,
-                models.ServerMember.access_level > 0
-            ).all()
-        ]
+        elevated_user_ids = (await db.scalars(select(models.ServerMember.user_id).where(
+            models.ServerMember.server_id == server_id,
+            models.ServerMember.access_level > 0
+        ))).all()
 
         user_message_ids = [str(msg["_id"]) for msg in messages if msg["user_id"] == db_user.id]
 
         messages.extend(
-            await mongo_db[collection_name].find({
+            await collection.find({
                 "$and": [
                     {
                         "user_id": {
-                            "$in": [server.owner_id] + elevated_user_ids
+                            "$in": [server_access.owner_id] + list(elevated_user_ids)
                         }
                     },
                     {
@@ -1420,7 +1386,7 @@ async def get_messages(request: AssignmentsRetrieve, db: db_dependency, authoriz
         )
 
 
-    # messages = await mongo_db[collection_name].find({}).sort("timestamp", -1).to_list(length=1000)
+    # messages = await collection.find({}).sort("timestamp", -1).to_list(length=1000)
     messages = sorted(messages, key=lambda msg: msg["timestamp"])
 
     for message in messages:
@@ -1433,47 +1399,27 @@ class GradeAssignment(BaseModel):
     grade: float
 
 @app.put("/api/assignment/grade", response_model=AssignmentResponse)
-async def grade_assignment(grade_assignment: GradeAssignment, db: db_dependency, authorization: Optional[str] = Header(None)):
-    # Extract token from Authorization header
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = authorization.replace("Bearer ", "")
-    # Verify the user token
-    db_user = db.query(models.User).filter(models.User.token == token).first()
-    if not db_user:
-        raise HTTPException(status_code=400, detail="Invalid token")
-    if db_user.token_expiry < datetime.now():
-        raise HTTPException(status_code=400, detail="Token expired")
-    # Check if the user is a server owner or has access level > 0
+async def grade_assignment(grade_assignment: GradeAssignment, db: async_db_dependency, db_user: current_user_dependency, access: server_access_dependency):
     # Get the server from the room ID
-    server_room = db.query(models.ServerRoom).filter(models.ServerRoom.id == grade_assignment.room_id).first()
-    if not server_room:
+    server_id = await db.scalar(select(models.ServerRoom.server_id).where(models.ServerRoom.id == grade_assignment.room_id))
+    if not server_id:
         raise HTTPException(status_code=404, detail="Room not found")
 
-    server = db.query(models.Server).filter(models.Server.id == server_room.server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-
     # Check if the user is a server member with access level > 0 or the server owner
-    server_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == db_user.id,
-        models.ServerMember.server_id == server.id,
-        models.ServerMember.access_level > 0
-    ).first()
-
-    if not server_member and server.owner_id != db_user.id:
-        raise HTTPException(status_code=403, detail="User is not authorized to grade assignments")
+    await access.require(db_user.id, server_id, admin=True, detail="User is not authorized to grade assignments")
     # Get the assignment from MongoDB
-    collection_name = f"server_{server.id}_assignments_{grade_assignment.room_id}"
-    assignment = await mongo_db[collection_name].find_one({"_id": ObjectId(grade_assignment.assignment_id)})
+    collection = await mongo_collections.assignments(server_id, grade_assignment.room_id)
+    assignment = await collection.find_one({"_id": ObjectId(grade_assignment.assignment_id)})
     if not assignment:
         raise HTTPException(status_code=404, detail="Assignment not found")
     # Update the assignment grade
+    before = dict(assignment)
     assignment["grade"] = grade_assignment.grade
-    await mongo_db[collection_name].update_one(
+    await collection.update_one(
         {"_id": ObjectId(grade_assignment.assignment_id)},
         {"$set": {"grade": grade_assignment.grade}}
     )
+    await overview_snapshots.submissions_changed(db, server_id, [(grade_assignment.room_id, before, assignment)])
     # Convert the assignment to the response model
     assignment_response = AssignmentResponse(
         id=grade_assignment.assignment_id,
@@ -1493,30 +1439,20 @@ async def grade_assignment(grade_assignment: GradeAssignment, db: db_dependency,
 @app.put("/api/assignment/edit", response_model=AssignmentResponse)
 async def edit_assignment(
     db: db_dependency,
+    db_user: current_user_dependency,
     assignment_id: str = Form(...),
     room_id: int = Form(...),
     message: str = Form(...),
-    attachments: List[UploadFile] = File(default=[]),
-    authorization: Optional[str] = Header(None)
+    attachments: List[UploadFile] = File(default=[])
 ):
-    # Extract token from Authorization header
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = authorization.replace("Bearer ", "")
 
-    # Verify the user token
-    db_user = db.query(models.User).filter(models.User.token == token).first()
-    if not db_user:
-        raise HTTPException(status_code=400, detail="Invalid token")
-    if db_user.token_expiry < datetime.now():
-        raise HTTPException(status_code=400, detail="Token expired")
 
     # Retrieve the server ID from the room
     server_room = db.query(models.ServerRoom).filter(models.ServerRoom.id == room_id).first()
     if not server_room:
         raise HTTPException(status_code=404, detail="Room not found")
-    collection_name = f"server_{server_room.server_id}_assignments_{room_id}"
-    assignment = await mongo_db[collection_name].find_one({"_id": ObjectId(assignment_id)})
+    collection = await mongo_collections.assignments(server_room.server_id, room_id)
+    assignment = await collection.find_one({"_id": ObjectId(assignment_id)})
     if not assignment:
         raise HTTPException(status_code=404, detail="Assignment not found")
     if assignment["user_id"] != db_user.id:
@@ -1524,18 +1460,18 @@ async def edit_assignment(
 
     # Save uploaded files to disk and collect URLs
     file_urls: List[str] = []
-    for upload in attachments:
-        name = f"{uuid.uuid4().hex}_{upload.filename}"
-        dest = os.path.join(UPLOAD_DIR, name)
-        with open(dest, "wb") as out:
-            out.write(await upload.read())
-        file_urls.append(f"http://lamzaone.go.ro:8000/uploads/{name}")
+    owner = attachment_owner(collection.name, assignment_id)
+    for stored in await attachment_store.save(attachments, owner):
+        file_urls.append(stored.url)
 
     # Update the assignment message and attachments
-    await mongo_db[collection_name].update_one(
+    await collection.update_one(
         {"_id": ObjectId(assignment_id)},
         {"$set": {"message": message, "attachments": file_urls}}
     )
+    # the previous attachments are replaced, release the ones that are not attached anymore
+    kept = set(attachment_digests(file_urls))
+    await attachment_store.release(owner, [digest for digest in attachment_digests(assignment.get("attachments", [])) if digest not in kept])
 
     # Prepare the response
     assignment_response = AssignmentResponse(
@@ -1564,42 +1500,24 @@ class AttendanceCreateRequest(BaseModel):
     week: int
 class AttendanceEditRequest(BaseModel):
     attendance_id: int
-    status: str  # e.g., "present", "absent", "excused"
+    status: Literal["present", "absent", "excused"]
 
 @app.put("/api/server/{server_id}/attendance/edit", response_model=AttendanceCreateRequest)
-async def edit_attendance(server_id: int, attendance_edit: AttendanceEditRequest, db: db_dependency, Authorization: Optional[str] = Header(None)):
-    # Extract token from Authorization header
-    if not Authorization or not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = Authorization.replace("Bearer ", "")
-    # Verify the user token
-    admin = db.query(models.User).filter(models.User.token == token).first()
-    if not admin:
-        raise HTTPException(status_code=400, detail="Invalid user token")
-    if admin.token_expiry < datetime.now():
-        raise HTTPException(status_code=400, detail="Token expired")
-    # Check if the user is server owner or has access level > 0
-    server = db.query(models.Server).filter(models.Server.id == server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-    server_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == admin.id,
-        models.ServerMember.server_id == server.id,
-        models.ServerMember.access_level > 0
-    ).first()
-    if not server_member and server.owner_id != admin.id:
-        raise HTTPException(status_code=403, detail="User is not authorized to edit attendance records")
+async def edit_attendance(server_id: int, attendance_edit: AttendanceEditRequest, db: async_db_dependency, admin: current_user_dependency, access: server_access_dependency):
+    await access.require(admin.id, server_id, admin=True, detail="User is not authorized to edit attendance records")
     # Find the attendance record
-    db_attendance = db.query(models.Attendance).filter(
+    db_attendance = await db.scalar(select(models.Attendance).options(selectinload(models.Attendance.week)).where(
         models.Attendance.id == attendance_edit.attendance_id,
         models.Attendance.server_id == server_id
-    ).first()
+    ))
     if not db_attendance:
         raise HTTPException(status_code=404, detail="Attendance record not found")
     # Update the attendance record
     db_attendance.status = attendance_edit.status
-    db.commit()
-    db.refresh(db_attendance)
+    await db.commit()
+    await db.refresh(db_attendance)
+    await websocket_manager.invalidate_cache("attendance_totals", server_id=server_id)
+    await overview_snapshots.refresh_attendance(db, server_id, [db_attendance.user_id])
     # Broadcast the attendance record update
     await websocket_manager.broadcast_server(server_id, "attendance_updated")
 
@@ -1607,154 +1525,95 @@ async def edit_attendance(server_id: int, attendance_edit: AttendanceEditRequest
         user_id=db_attendance.user_id,
         date=db_attendance.date,
         status=db_attendance.status,
-        week=db_attendance.week
+        week=db_attendance.week.week_number if db_attendance.week else 0
     )
     
 
 
 # delete last week endpoint
 @app.delete("/api/server/{server_id}/weeks/delete")
-async def delete_last_week(server_id: int, db: db_dependency, Authorization: Optional[str] = Header(None)):
-    # Token validation
-    if not Authorization or not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = Authorization.replace("Bearer ", "")
-    admin = db.query(models.User).filter(models.User.token == token).first()
-    if not admin or admin.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-    # Authorization check
-    server = db.query(models.Server).filter(models.Server.id == server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-    server_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == admin.id,
-        models.ServerMember.server_id == server.id,
-        models.ServerMember.access_level > 0
-    ).first()
-    if not server_member and server.owner_id != admin.id:
-        raise HTTPException(status_code=403, detail="Not authorized")
+async def delete_last_week(server_id: int, db: async_db_dependency, admin: current_user_dependency, access: server_access_dependency):
+    await access.require(admin.id, server_id, admin=True, detail="Not authorized")
     # Fetch the last week
-    last_week = db.query(models.ServerWeek).filter_by(server_id=server_id).order_by(models.ServerWeek.week_number.desc()).first()
+    last_week = await db.scalar(select(models.ServerWeek).filter_by(server_id=server_id).order_by(models.ServerWeek.week_number.desc()))
     if not last_week:
         raise HTTPException(status_code=404, detail="No weeks found for this server")
     # Delete the last week
-    db.query(models.ServerWeek).filter_by(id=last_week.id).delete()
-    db.commit()
+    await db.execute(delete(models.ServerWeek).filter_by(id=last_week.id))
+    await db.commit()
     # Delete all attendance records for the last week
-    db.query(models.Attendance).filter_by(week_id=last_week.id).delete()
-    db.commit()
+    await db.execute(delete(models.Attendance).filter_by(week_id=last_week.id))
+    await db.commit()
+    await websocket_manager.invalidate_cache("attendance_totals", server_id=server_id)
+    await overview_snapshots.refresh_attendance(db, server_id)
     # Broadcast the week deletion
     await websocket_manager.broadcast_server(server_id, "week_deleted")
     return {"message": f"Week {last_week.week_number} deleted successfully."}
 
 
 @app.post("/api/server/{server_id}/weeks/create")
-async def create_week(server_id: int, db: db_dependency, Authorization: Optional[str] = Header(None)):
-    # Token validation
-    if not Authorization or not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = Authorization.replace("Bearer ", "")
-    admin = db.query(models.User).filter(models.User.token == token).first()
-    if not admin or admin.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-
-    # Authorization check
-    server = db.query(models.Server).filter(models.Server.id == server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-    server_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == admin.id,
-        models.ServerMember.server_id == server.id,
-        models.ServerMember.access_level > 0
-    ).first()
-    if not server_member and server.owner_id != admin.id:
-        raise HTTPException(status_code=403, detail="Not authorized")
-
-    # get number of weeks already created for this server
-    existing_weeks = db.query(models.ServerWeek).filter_by(server_id=server_id).count()
-    # Create the week
-    new_week = models.ServerWeek(server_id=server_id, week_number=existing_weeks + 1)
-    db.add(new_week)
-    db.commit()
-    db.refresh(new_week)
+async def create_week(server_id: int, db: async_db_dependency, admin: current_user_dependency, access: server_access_dependency):
+    await access.require(admin.id, server_id, admin=True, detail="Not authorized")
 
-    # Add "absent" attendance for each member with access_level 0
-    members = db.query(models.ServerMember).filter_by(server_id=server_id, access_level=0).all()
-    for member in members:
-        attendance = models.Attendance(
-            user_id=member.user_id,
-            server_id=server_id,
-            date=datetime.now(),
-            status="absent",
-            week_id=new_week.id  # Use week_id instead of passing the entire object
-        )
-        db.add(attendance)
-    db.commit()
+    # Create the week and add "absent" attendance for each member with access_level 0
+    week_numbers, student_ids = await create_weeks(db, server_id, 1)
+    await db.commit()
+    await overview_snapshots.refresh_attendance(db, server_id, student_ids)
     
     # Broadcast the new week creation
     await websocket_manager.broadcast_server(server_id, "week_created")
 
-    return {"message": f"Week {new_week.week_number} created and attendance set to 'absent' for all members."}
+    return {"message": f"Week {week_numbers[0]} created and attendance set to 'absent' for all members."}
+
+class BulkWeekCreateRequest(BaseModel):
+    count: int = Field(..., ge=1, le=MAX_WEEKS_PER_REQUEST)
+
+# semester setup: create several weeks in one transaction
+@app.post("/api/server/{server_id}/weeks/bulk_create")
+async def bulk_create_weeks(server_id: int, request: BulkWeekCreateRequest, db: async_db_dependency, admin: current_user_dependency, access: server_access_dependency):
+    await access.require(admin.id, server_id, admin=True, detail="Not authorized")
+
+    week_numbers, student_ids = await create_weeks(db, server_id, request.count)
+    await db.commit()
+    await overview_snapshots.refresh_attendance(db, server_id, student_ids)
+
+    # One notification for the whole batch
+    await websocket_manager.broadcast_server(server_id, "week_created")
+
+    return {
+        "message": f"Weeks {week_numbers[0]}-{week_numbers[-1]} created and attendance set to 'absent' for all members.",
+        "week_numbers": week_numbers
+    }
 
 # TODO: Fix /weeks endpoint
 @app.get("/api/server/{server_id}/weeks")
-async def get_weeks(server_id: int, db: db_dependency, Authorization: Optional[str] = Header(None)):
-    # Token validation
-    if not Authorization or not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = Authorization.replace("Bearer ", "")
-    user = db.query(models.User).filter(models.User.token == token).first()
-    if not user or user.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-    # Authorization check
-    server = db.query(models.Server).filter(models.Server.id == server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-    server_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == user.id,
-        models.ServerMember.server_id == server.id
-    ).first()
-    if not server_member and server.owner_id != user.id:
-        raise HTTPException(status_code=403, detail="Not authorized")
+async def get_weeks(server_id: int, db: async_db_dependency, user: current_user_dependency, access: server_access_dependency):
+    await access.require(user.id, server_id, detail="Not authorized")
     # Fetch weeks
-    weeks = db.query(models.ServerWeek).filter_by(server_id=server_id).all()
+    weeks = (await db.scalars(select(models.ServerWeek).filter_by(server_id=server_id))).all()
     result = [{"id": week.id, "week_number": week.week_number} for week in weeks]
     return result
 
 
 
 @app.get("/api/server/{server_id}/week/{week_number}/attendance")
-async def get_attendance_for_week(server_id: int, week_number: int, db: db_dependency, Authorization: Optional[str] = Header(None)):
-    # Token check
-    if not Authorization or not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = Authorization.replace("Bearer ", "")
-    user = db.query(models.User).filter(models.User.token == token).first()
-    if not user or user.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-
+async def get_attendance_for_week(server_id: int, week_number: int, db: async_db_dependency, user: current_user_dependency, access: server_access_dependency):
     # Validate access
-    server = db.query(models.Server).filter_by(id=server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-    server_member = db.query(models.ServerMember).filter_by(server_id=server_id, user_id=user.id).first()
-    if not server_member and server.owner_id != user.id:
-        raise HTTPException(status_code=403, detail="Not authorized")
+    await access.require(user.id, server_id, detail="Not authorized")
 
     # Fetch week and attendance
-    week = db.query(models.ServerWeek).filter_by(server_id=server_id, week_number=week_number).first()
+    week = await db.scalar(select(models.ServerWeek).filter_by(server_id=server_id, week_number=week_number))
     if not week:
         raise HTTPException(status_code=404, detail="Week not found")
 
-    attendance_records = db.query(models.Attendance).filter_by(server_id=server_id, week_id=week.id).all()
+    attendance_records = (await db.scalars(
+        select(models.Attendance)
+        .options(joinedload(models.Attendance.user))
+        .filter_by(server_id=server_id, week_id=week.id)
+    )).all()
 
-    for a in attendance_records:
-        # Count total attendances ('present' + 'excused') for the user in the given server
-        a.total = db.query(models.Attendance).filter(
-            models.Attendance.server_id == server_id,
-            models.Attendance.user_id == a.user_id,
-            models.Attendance.status.in_(["present", "excused"])
-        ).count()
+    # Total attendances ('present' + 'excused') per user in the given server, one grouped query (cached)
+    totals = await attendance_totals.get(db, server_id)
 
     # Prepare the response
     result = [{
@@ -1763,47 +1622,28 @@ async def get_attendance_for_week(server_id: int, week_number: int, db: db_depen
         "status": a.status,
         "date": a.date,
         "attendance_id": a.id,
-        "total": a.total if hasattr(a, 'total') else 0
+        "total": totals.get(a.user_id, 0)
     } for a in attendance_records]
 
     return {"week": week_number, "attendance": result}
 
 @app.get("/api/server/{server_id}/weeks")
-async def list_weeks(server_id: int, db: db_dependency, Authorization: Optional[str] = Header(None)):
-    token = Authorization.replace("Bearer ", "") if Authorization else None
-    user = db.query(models.User).filter(models.User.token == token).first()
-    if not user or user.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
+async def list_weeks(server_id: int, db: async_db_dependency, user: current_user_dependency, access: server_access_dependency):
+    await access.require(user.id, server_id, detail="Not authorized")
 
-    server = db.query(models.Server).filter_by(id=server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-    
-    is_member = db.query(models.ServerMember).filter_by(server_id=server_id, user_id=user.id).first()
-    if not is_member and server.owner_id != user.id:
-        raise HTTPException(status_code=403, detail="Not authorized")
-
-    weeks = db.query(models.ServerWeek).filter_by(server_id=server_id).all()
+    weeks = (await db.scalars(select(models.ServerWeek).filter_by(server_id=server_id))).all()
     return [{"id": w.id, "week_number": w.week_number} for w in weeks]
 
 @app.get("/api/server/{server_id}/user/{user_id}/attendance")
-async def user_attendance(server_id: int, user_id: int, db: db_dependency, Authorization: Optional[str] = Header(None)):
-    token = Authorization.replace("Bearer ", "") if Authorization else None
-    requester = db.query(models.User).filter(models.User.token == token).first()
-    if not requester or requester.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-
-    server = db.query(models.Server).filter_by(id=server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-
-    if requester.id != user_id:
-        # Admin check
-        server_member = db.query(models.ServerMember).filter_by(server_id=server_id, user_id=requester.id).first()
-        if not server_member or server_member.access_level <= 0 and server.owner_id != requester.id:
-            raise HTTPException(status_code=403, detail="Not authorized")
-
-    attendance = db.query(models.Attendance).filter_by(server_id=server_id, user_id=user_id).all()
+async def user_attendance(server_id: int, user_id: int, db: async_db_dependency, requester: current_user_dependency, access: server_access_dependency):
+    # Users can read their own attendance, admins can read anyone's
+    await access.require(requester.id, server_id, admin=requester.id != user_id, detail="Not authorized")
+
+    attendance = (await db.scalars(
+        select(models.Attendance)
+        .options(selectinload(models.Attendance.week))
+        .filter_by(server_id=server_id, user_id=user_id)
+    )).all()
     return [{
         "week_number": a.week.week_number if a.week else None,
         "date": a.date,
@@ -1814,108 +1654,73 @@ class BulkAttendanceEditRequest(BaseModel):
     updates: List[AttendanceEditRequest]  # attendance_id + status
 
 @app.put("/api/server/{server_id}/week/{week_number}/attendance/bulk_edit")
-async def bulk_edit_attendance(server_id: int, week_number: int, request: BulkAttendanceEditRequest, db: db_dependency, Authorization: Optional[str] = Header(None)):
-    token = Authorization.replace("Bearer ", "") if Authorization else None
-    db_user = db.query(models.User).filter(models.User.token == token).first()
-    if not db_user or db_user.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-    server = db.query(models.Server).filter_by(id=server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-    member = db.query(models.ServerMember).filter_by(server_id=server_id, user_id=db_user.id).first()
-    if member and member.access_level <= 0 or server.owner_id != db_user.id:
-        raise HTTPException(status_code=403, detail="Not authorized")
+async def bulk_edit_attendance(server_id: int, week_number: int, request: BulkAttendanceEditRequest, db: async_db_dependency, db_user: current_user_dependency, access: server_access_dependency):
+    await access.require(db_user.id, server_id, admin=True, detail="Not authorized")
 
+    edited_user_ids = []
     for edit in request.updates:
-        record = db.query(models.Attendance).filter_by(id=edit.attendance_id, server_id=server_id).first()
+        record = await db.scalar(select(models.Attendance).filter_by(id=edit.attendance_id, server_id=server_id))
         if record:
             record.status = edit.status
             record.date = datetime.now()  # Update date to now
-    db.commit()
+            edited_user_ids.append(record.user_id)
+    await db.commit()
+    await websocket_manager.invalidate_cache("attendance_totals", server_id=server_id)
+    await overview_snapshots.refresh_attendance(db, server_id, edited_user_ids)
     await websocket_manager.broadcast_server(server_id, "bulk_attendance_updated")
     return {"message": "Attendance updated."}
 
 from fastapi.responses import StreamingResponse
-import csv
-import io
 
 @app.get("/api/server/{server_id}/attendance/export")
-async def export_attendance(server_id: int, db: db_dependency, Authorization: Optional[str] = Header(None)):
-    token = Authorization.replace("Bearer ", "") if Authorization else None
-    admin = db.query(models.User).filter(models.User.token == token).first()
-    if not admin or admin.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
+async def export_attendance(server_id: int, admin: current_user_dependency, access: server_access_dependency, format: str = "csv"):
+    await access.require(admin.id, server_id, admin=True, detail="Not authorized")
 
-    server = db.query(models.Server).filter_by(id=server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-
-    member = db.query(models.ServerMember).filter_by(server_id=server_id, user_id=admin.id).first()
-    if not member or member.access_level <= 0 and server.owner_id != admin.id:
-        raise HTTPException(status_code=403, detail="Not authorized")
-
-    records = db.query(models.Attendance).filter_by(server_id=server_id).all()
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported export format, expected one of: {', '.join(EXPORT_FORMATS)}")
+    if format == "parquet" and not parquet_available():
+        raise HTTPException(status_code=501, detail="Parquet export is not available on this server")
 
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["User ID", "Week Number", "Date", "Status"])
-    for rec in records:
-        writer.writerow([rec.user_id, rec.week.week_number if rec.week else "", rec.date, rec.status])
-
-    output.seek(0)
-    return StreamingResponse(output, media_type="text/csv", headers={"Content-Disposition": "attachment; filename=attendance.csv"})
+    # rows are streamed from a server-side cursor, see attendance_export.py
+    media_type, filename = EXPORT_FORMATS[format]
+    return StreamingResponse(EXPORTERS[format](server_id), media_type=media_type, headers={"Content-Disposition": f"attachment; filename={filename}"})
 
 @app.delete("/api/server/{server_id}/week/{week_number}")
-async def delete_week(server_id: int, week_number: int, db: db_dependency, Authorization: Optional[str] = Header(None)):
-    token = Authorization.replace("Bearer ", "") if Authorization else None
-    admin = db.query(models.User).filter(models.User.token == token).first()
-    if not admin or admin.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
+async def delete_week(server_id: int, week_number: int, db: async_db_dependency, admin: current_user_dependency, access: server_access_dependency):
+    await access.require(admin.id, server_id, admin=True, detail="Not authorized")
 
-    server = db.query(models.Server).filter_by(id=server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-
-    if admin.id != server.owner_id:
-        member = db.query(models.ServerMember).filter_by(server_id=server_id, user_id=admin.id).first()
-        if not member or member.access_level <= 0:
-            raise HTTPException(status_code=403, detail="Not authorized")
-
-    week = db.query(models.ServerWeek).filter_by(server_id=server_id, week_number=week_number).first()
+    week = await db.scalar(select(models.ServerWeek).filter_by(server_id=server_id, week_number=week_number))
     if not week:
         raise HTTPException(status_code=404, detail="Week not found")
 
     # Delete all related attendance first (cascading isn't configured here)
-    db.query(models.Attendance).filter_by(server_id=server_id).filter(models.Attendance.week == week).delete()
-    db.delete(week)
-    db.commit()
+    await db.execute(delete(models.Attendance).filter_by(server_id=server_id, week_id=week.id))
+    await db.delete(week)
+    await db.commit()
+    await websocket_manager.invalidate_cache("attendance_totals", server_id=server_id)
+    await overview_snapshots.refresh_attendance(db, server_id)
 
     return {"message": f"Week {week_number} and related attendance deleted."}
 
 @app.get("/api/server/{server_id}/attendance/full")
-async def full_attendance(server_id: int, db: db_dependency, Authorization: Optional[str] = Header(None)):
-    token = Authorization.replace("Bearer ", "") if Authorization else None
-    admin = db.query(models.User).filter(models.User.token == token).first()
-    if not admin or admin.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-
-    server = db.query(models.Server).filter_by(id=server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-
-    member = db.query(models.ServerMember).filter_by(server_id=server_id, user_id=admin.id).first()
-    if not member or member.access_level <= 0 and server.owner_id != admin.id:
-        raise HTTPException(status_code=403, detail="Not authorized")
+async def full_attendance(server_id: int, db: async_db_dependency, admin: current_user_dependency, access: server_access_dependency):
+    await access.require(admin.id, server_id, admin=True, detail="Not authorized")
 
     # Get all users in the server
-    users = db.query(models.User.id, models.User.username).join(models.ServerMember, models.User.id == models.ServerMember.user_id)\
-            .filter(models.ServerMember.server_id == server_id).all()
+    users = (await db.execute(
+        select(models.User.id, models.User.name).join(models.ServerMember, models.User.id == models.ServerMember.user_id)
+        .where(models.ServerMember.server_id == server_id)
+    )).all()
 
     # Get all weeks
-    weeks = db.query(models.ServerWeek).filter_by(server_id=server_id).order_by(models.ServerWeek.week_number).all()
+    weeks = (await db.scalars(select(models.ServerWeek).filter_by(server_id=server_id).order_by(models.ServerWeek.week_number))).all()
 
     # Get all attendance records
-    attendance_records = db.query(models.Attendance).filter_by(server_id=server_id).all()
+    attendance_records = (await db.scalars(
+        select(models.Attendance)
+        .options(selectinload(models.Attendance.week))
+        .filter_by(server_id=server_id)
+    )).all()
 
     # Build mapping (user_id -> week_number -> status)
     attendance_map = {}
@@ -1935,7 +1740,7 @@ async def full_attendance(server_id: int, db: db_dependency, Authorization: Opti
     for user in users:
         user_attendance = {
             "id": user.id,
-            "name": user.username,
+            "name": user.name,
             "attendance": {},  # week_number -> status
             "attendance_ids": {}  # week_number -> attendance_id
         }
@@ -1951,6 +1756,16 @@ async def full_attendance(server_id: int, db: db_dependency, Authorization: Opti
     return response
 
 
+# compact users x weeks status matrix for attendance spreadsheets, paged by user id
+@app.get("/api/server/{server_id}/attendance/matrix")
+async def attendance_matrix_endpoint(server_id: int, db: async_db_dependency, admin: current_user_dependency, access: server_access_dependency, after_user_id: int = 0, limit: int = MATRIX_PAGE_SIZE):
+    await access.require(admin.id, server_id, admin=True, detail="Not authorized")
+
+    if not 1 <= limit <= MAX_MATRIX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_MATRIX_PAGE_SIZE}")
+    return await attendance_matrix(db, server_id, after_user_id, limit)
+
+
 
 ################### STUDENT GRADES ####################
 class AddGradeRequest(BaseModel):
@@ -1964,243 +1779,155 @@ class EditGradeRequest(BaseModel):
     date: Optional[datetime] = None
 
 @app.post("/api/server/{server_id}/admin/grade", response_model=List[dict])
-async def add_student_grade(server_id: int, grade_request: AddGradeRequest, db: db_dependency, Authorization: Optional[str] = Header(None)):
-    if not Authorization or not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = Authorization.replace("Bearer ", "")
-    user = db.query(models.User).filter(models.User.token == token).first()
-    if not user or user.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
+async def add_student_grade(server_id: int, grade_request: AddGradeRequest, db: async_db_dependency, user: current_user_dependency, access: server_access_dependency):
+    await access.require(user.id, server_id, admin=True, detail="User is not authorized to add grades for this student")
 
-    server = db.query(models.Server).filter(models.Server.id == server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-
-    server_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == user.id,
-        models.ServerMember.server_id == server.id
-    ).first()
-    if not server.owner_id == user.id and (not server_member or server_member.access_level <= 0):
-        raise HTTPException(status_code=403, detail="User is not authorized to add grades for this student")
-
-    student_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == grade_request.user_id,
-        models.ServerMember.server_id == server_id
-    ).first()
-    if not student_member:
+    student = await access.get(grade_request.user_id, server_id)
+    if not student or not student.is_member:
         raise HTTPException(status_code=404, detail="Student not found in the server")
 
-    grades = {}
-    if student_member.grades:
-        try:
-            grades = json.loads(student_member.grades)
-        except json.JSONDecodeError:
-            raise HTTPException(status_code=500, detail="Invalid grades format in server member data")
-
-    grades[str(datetime.now())] = {
-        "assignment_id": None,
-        "room_id": None,
-        "grade": grade_request.grade,
-        "date": datetime.now().isoformat()
-    }
-    student_member.grades = json.dumps(grades)
-    db.commit()
-    db.refresh(student_member)
+    db.add(models.Grade(
+        server_id=server_id,
+        user_id=grade_request.user_id,
+        grade=grade_request.grade,
+        date=datetime.now()
+    ))
+    await db.commit()
+    await overview_snapshots.refresh_member_grades(db, server_id, [grade_request.user_id])
 
     return [{"user_id": grade_request.user_id, "grade": grade_request.grade}]
 
 @app.put("/api/server/{server_id}/admin/grade", response_model=List[dict])
-async def update_student_grade(server_id: int, grade_request: EditGradeRequest, db: db_dependency, Authorization: Optional[str] = Header(None)):
-    if not Authorization or not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = Authorization.replace("Bearer ", "")
-    user = db.query(models.User).filter(models.User.token == token).first()
-    if not user or user.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-
-    server = db.query(models.Server).filter(models.Server.id == server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-
-    server_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == user.id,
-        models.ServerMember.server_id == server.id
-    ).first()
-    if not server.owner_id == user.id and (not server_member or server_member.access_level <= 0):
-        raise HTTPException(status_code=403, detail="User is not authorized to update grades for this student")
+async def update_student_grade(server_id: int, grade_request: EditGradeRequest, db: async_db_dependency, user: current_user_dependency, access: server_access_dependency):
+    await access.require(user.id, server_id, admin=True, detail="User is not authorized to update grades for this student")
 
-    student_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == grade_request.user_id,
-        models.ServerMember.server_id == server_id
-    ).first()
-    if not student_member:
+    student = await access.get(grade_request.user_id, server_id)
+    if not student or not student.is_member:
         raise HTTPException(status_code=404, detail="Student not found in the server")
 
-    grades = {}
-    if student_member.grades:
-        try:
-            grades = json.loads(student_member.grades)
-        except json.JSONDecodeError:
-            raise HTTPException(status_code=500, detail="Invalid grades format in server member data")
-
     if grade_request.date:
-        for key, value in list(grades.items()):  # Iterate over a copy of the dictionary's items
-            if value.get("date") == grade_request.date.isoformat():
-                if grade_request.grade == 0:
-                    grades.pop(key)  # Remove the specific grade entry with 0
-                else:
-                    value["grade"] = grade_request.grade
-                break
+        grade_filter = (
+            models.Grade.server_id == server_id,
+            models.Grade.user_id == grade_request.user_id,
+            models.Grade.date == grade_request.date,
+        )
+        if grade_request.grade == 0:
+            result = await db.execute(delete(models.Grade).where(*grade_filter))  # Remove the specific grade entry with 0
         else:
+            result = await db.execute(update(models.Grade).where(*grade_filter).values(grade=grade_request.grade))
+        if result.rowcount == 0:
             raise HTTPException(status_code=404, detail="Grade entry not found for the provided date")
 
     elif grade_request.assignment_id:
-        collection_name = f"server_{server_id}_assignments_{grade_request.assignment_id}"
-        assignment = await mongo_db[collection_name].find_one({
+        collection = await mongo_collections.assignments(server_id, grade_request.assignment_id)
+        assignment = await collection.find_one({
             "user_id": grade_request.user_id,
             "grade": {"$exists": True}
         })
         if not assignment:
             raise HTTPException(status_code=404, detail="Assignment not found")
 
-        await mongo_db[collection_name].update_one(
+        before = await collection.find_one_and_update(
             {"_id": ObjectId(grade_request.assignment_id)},
             {"$set": {"grade": grade_request.grade}}
         )
+        if before is not None:
+            await overview_snapshots.submissions_changed(db, server_id, [
+                (grade_request.assignment_id, before, {**before, "grade": grade_request.grade})
+            ])
 
     else:
         raise HTTPException(status_code=400, detail="Either assignment_id or date must be provided to update the grade")
 
-    student_member.grades = json.dumps(grades)
-    db.commit()
-    db.refresh(student_member)
+    await db.commit()
+    if grade_request.date:
+        await overview_snapshots.refresh_member_grades(db, server_id, [grade_request.user_id])
 
     return [{"user_id": grade_request.user_id, "grade": grade_request.grade}]
 
 @app.get("/api/server/{server_id}/user/{user_id}/grades")
-async def get_student_grades(server_id: int, user_id: int, db: db_dependency, Authorization: Optional[str] = Header(None)):
-    if not Authorization or not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = Authorization.replace("Bearer ", "")
-    user = db.query(models.User).filter(models.User.token == token).first()
-    if not user or user.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-
-    server = db.query(models.Server).filter(models.Server.id == server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-
-    server_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == user.id, 
-        models.ServerMember.server_id == server.id
-    ).first()
-    if not server.owner_id == user.id and (not server_member or server_member.access_level <= 0):
-        raise HTTPException(status_code=403, detail="User is not authorized to view grades for this student")
+async def get_student_grades(server_id: int, user_id: int, db: async_db_dependency, user: current_user_dependency, access: server_access_dependency):
+    await access.require(user.id, server_id, admin=True, detail="User is not authorized to view grades for this student")
 
     grades = []
-    for collection_name in mongo_db.list_collection_names():
-        if collection_name.startswith(f"server_{server_id}_assignments_"):
-            assignments = await mongo_db[collection_name].find({"user_id": user_id}).to_list(length=None)
-            for assignment in assignments:
-                grades.append({
-                    "assignment_id": str(assignment["_id"]),
-                    "room_id": int(collection_name.split("_")[-1]),
-                    "grade": assignment.get("grade", None),
-                    "date": None,
-                })
-
-    student_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == user_id,
-        models.ServerMember.server_id == server_id
-    ).first()
+    for room_id, collection_name in await mongo_collections.server_collections(server_id, "assignments"):
+        assignments = await mongo_db[collection_name].find({"user_id": user_id}).to_list(length=None)
+        for assignment in assignments:
+            grades.append({
+                "assignment_id": str(assignment["_id"]),
+                "room_id": room_id,
+                "grade": assignment.get("grade", None),
+                "date": None,
+            })
 
-    if student_member and student_member.grades:
-        try:
-            grades_json = json.loads(student_member.grades)
-            for _, grade in grades_json.items():
-                grades.append({
-                    "assignment_id": None,
-                    "room_id": None,
-                    "grade": grade['grade'],
-                    "date": grade.get('date', None),
-                })
-        except json.JSONDecodeError:
-            raise HTTPException(status_code=500, detail="Invalid grades format in server member data")
+    student_grades = await db.execute(
+        select(models.Grade.grade, models.Grade.date)
+        .where(models.Grade.server_id == server_id, models.Grade.user_id == user_id)
+        .order_by(models.Grade.date)
+    )
+    for grade, date in student_grades:
+        grades.append({
+            "assignment_id": None,
+            "room_id": None,
+            "grade": grade,
+            "date": date.isoformat(),
+        })
 
     return grades
 
 @app.get("/api/server/{server_id}/grades")
-async def get_all_grades(server_id: int, db: db_dependency, Authorization: Optional[str] = Header(None)):
-    if not Authorization or not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = Authorization.replace("Bearer ", "")
-    user = db.query(models.User).filter(models.User.token == token).first()
-    if not user or user.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-
-    server = db.query(models.Server).filter(models.Server.id == server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-
-    server_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == user.id, 
-        models.ServerMember.server_id == server.id
-    ).first()
-    if not server.owner_id == user.id and (not server_member or server_member.access_level <= 0):
-        raise HTTPException(status_code=403, detail="User is not authorized to view grades")
-
-    grouped_grades: Dict[int, str, List[dict]] = {}
-    members = db.query(models.ServerMember)\
-        .filter(
+async def get_all_grades(server_id: int, db: async_db_dependency, user: current_user_dependency, access: server_access_dependency):
+    server_access = await access.require(user.id, server_id, admin=True, detail="User is not authorized to view grades")
+
+    grouped_grades: Dict[int, Dict] = {}
+    students = await db.execute(
+        select(models.ServerMember.user_id, models.User.name)
+        .join(models.User, models.User.id == models.ServerMember.user_id)
+        .where(
             models.ServerMember.server_id == server_id,
             models.ServerMember.access_level == 0,  # Only students
-            models.ServerMember.user_id != server.owner_id  # Exclude server owner
-            ).all()
-    for member in members:
-        grouped_grades[member.user_id] = {"name": None, "grades": []}
-        user = db.query(models.User).filter(models.User.id == member.user_id).first()
-        grouped_grades[member.user_id]["name"] = user.name
-        if member.grades:
-            try:
-                grades_json = json.loads(member.grades)
-                for _, grade in grades_json.items():
-                    grouped_grades[member.user_id]["grades"].append({
-                        "assignment_id": None,
-                        "room_id": None,
-                        "grade": grade.get("grade"),
-                        "date": grade.get("date")
-                    })
-            except json.JSONDecodeError:
-                continue
+            models.ServerMember.user_id != server_access.owner_id  # Exclude server owner
+            )
+    )
+    for uid, name in students:
+        grouped_grades[uid] = {"name": name, "grades": []}
+
+    # professor-entered grades of the whole class, one indexed query
+    class_grades = await db.execute(
+        select(models.Grade.user_id, models.Grade.grade, models.Grade.date)
+        .where(models.Grade.server_id == server_id)
+        .order_by(models.Grade.date)
+    )
+    for uid, grade, date in class_grades:
+        if uid in grouped_grades:
+            grouped_grades[uid]["grades"].append({
+                "assignment_id": None,
+                "room_id": None,
+                "grade": grade,
+                "date": date.isoformat()
+            })
 
-    for collection_name in await mongo_db.list_collection_names():
-        if collection_name.startswith(f"server_{server_id}_assignments_"):
-            room_id = int(collection_name.split("_")[-1])
-            assignments = await mongo_db[collection_name].find({}).sort("grade", -1).to_list(length=None)
-            seen_users = set()
-            for assignment in assignments:
-                uid = assignment.get("user_id")
-                # check to make sure user is not the server owner or has access_level > 0
-                if uid is None or uid == server.owner_id:
-                    continue
-                server_member = db.query(models.ServerMember).filter(
-                    models.ServerMember.user_id == uid, 
-                    models.ServerMember.server_id == server_id
-                ).first()
-                if not server_member or server_member.access_level > 0:
-                    continue
-                if uid not in seen_users:
-                    seen_users.add(uid)
-                    if uid not in grouped_grades:
-                        grouped_grades[uid] = {"name": None, "grades": []}
-                        user = db.query(models.User).filter(models.User.id == uid).first()
-                        grouped_grades[uid]["name"] = user.name if user else None
-                    grouped_grades[uid]["grades"].append({
-                        "assignment_id": str(assignment.get("_id")),
-                        "room_id": room_id,
-                        "grade": assignment.get("grade"),
-                        "date": None
-                    })
+    # best submission of every student per assignment room, all rooms in one pipeline
+    sources = [
+        (collection_name, {"room_id": room_id})
+        for room_id, collection_name in await mongo_collections.server_collections(server_id, "assignments")
+    ]
+    best_submissions = await mongo_collections.aggregate_across(
+        sources,
+        [
+            {"$match": {"user_id": {"$in": list(grouped_grades)}}},
+            {"$sort": {"grade": -1}},
+            {"$group": {"_id": "$user_id", "assignment_id": {"$first": "$_id"}, "grade": {"$first": "$grade"}}},
+        ],
+        tail=[{"$sort": {"room_id": 1, "grade": -1}}]
+    )
+    for submission in best_submissions:
+        grouped_grades[submission["_id"]]["grades"].append({
+            "assignment_id": str(submission["assignment_id"]),
+            "room_id": submission["room_id"],
+            "grade": submission.get("grade"),
+            "date": None
+        })
 
     return [{"user_id": uid, "name": data["name"], "grades": data["grades"]} for uid, data in grouped_grades.items()]
 
@@ -2218,229 +1945,141 @@ class BulkGradeUpdateRequest(BaseModel):
 async def bulk_edit_grades(
     server_id: int,
     request: BulkGradeUpdateRequest,
-    db: db_dependency,
-    Authorization: Optional[str] = Header(None)
+    db: async_db_dependency,
+    user: current_user_dependency,
+    access: server_access_dependency
 ):
-    if not Authorization or not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = Authorization.replace("Bearer ", "")
-    user = db.query(models.User).filter(models.User.token == token).first()
-    if not user or user.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-
-    server = db.query(models.Server).filter(models.Server.id == server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-
-    server_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == user.id, 
-        models.ServerMember.server_id == server.id
-    ).first()
-    if not server.owner_id == user.id and (not server_member or server_member.access_level <= 0):
-        raise HTTPException(status_code=403, detail="User is not authorized to update grades")
-
-    results = []
-
-    for update in request.updates:
-        student_member = db.query(models.ServerMember).filter_by(
-            user_id=update.user_id,
-            server_id=server_id
-        ).first()
-
-        if not student_member:
-            continue
-
-        if update.assignment_id and update.room_id is not None:
-            # MongoDB update
-            collection_name = f"server_{server_id}_assignments_{update.room_id}"
-            await mongo_db[collection_name].update_one(
+    await access.require(user.id, server_id, admin=True, detail="User is not authorized to update grades")
+
+    updates = request.updates
+    errors: Dict[int, str] = {}  # index in request.updates -> error
+
+    # every affected member in one query
+    user_ids = {grade_update.user_id for grade_update in updates}
+    member_ids = set((await db.scalars(
+        select(models.ServerMember.user_id)
+        .where(models.ServerMember.server_id == server_id, models.ServerMember.user_id.in_(user_ids))
+    )).all())
+
+    # professor-entered grades of those members, keyed by (user_id, date)
+    grade_rows = {}
+    if any(grade_update.date and not grade_update.assignment_id for grade_update in updates):
+        for grade_row in (await db.scalars(
+            select(models.Grade)
+            .where(models.Grade.server_id == server_id, models.Grade.user_id.in_(member_ids))
+        )).all():
+            grade_rows[(grade_row.user_id, grade_row.date)] = grade_row
+
+    mongo_batches: Dict[int, List[tuple]] = {}  # room_id -> [(index, UpdateOne)]
+    for index, grade_update in enumerate(updates):
+        if grade_update.user_id not in member_ids:
+            errors[index] = "Student not found in the server"
+        elif grade_update.assignment_id and grade_update.room_id is not None:
+            # MongoDB update, batched per assignment collection
+            if not ObjectId.is_valid(grade_update.assignment_id):
+                errors[index] = "Invalid assignment_id"
+                continue
+            mongo_batches.setdefault(grade_update.room_id, []).append((index, UpdateOne(
                 {
-                    "user_id": update.user_id,
-                    "_id": ObjectId(update.assignment_id)
+                    "user_id": grade_update.user_id,
+                    "_id": ObjectId(grade_update.assignment_id)
                 },
-                {"$set": {"grade": update.grade}},
+                {"$set": {"grade": grade_update.grade}},
                 upsert=True
-            )
-        elif update.date:
-            # SQL update (JSON field)
-            grades = {}
-            if student_member.grades:
-                try:
-                    grades = json.loads(student_member.grades)
-                except json.JSONDecodeError:
-                    continue
-
-            updated = False
-            for key, entry in grades.items():
-                if entry.get("date") == update.date.isoformat():
-                    entry["grade"] = update.grade
-                    updated = True
-                    break
-
-            if updated:
-                student_member.grades = json.dumps(grades)
-                db.add(student_member)
+            )))
+        elif grade_update.date:
+            # SQL update (grade row), flushed with the commit below
+            grade_row = grade_rows.get((grade_update.user_id, grade_update.date))
+            if grade_row is None:
+                errors[index] = "Grade entry not found for the provided date"
+                continue
+            grade_row.grade = grade_update.grade
         else:
-            continue  # Skip invalid updates
+            errors[index] = "Either assignment_id and room_id or date must be provided"
 
-        results.append({
-            "user_id": update.user_id,
-            "grade": update.grade,
-            "assignment_id": update.assignment_id,
-            "date": update.date
-        })
+    submission_changes = []  # (room_id, document before, document after) for the overview snapshots
 
-    db.commit()
+    async def write_batch(room_id: int, batch: List[tuple]):
+        collection = await mongo_collections.assignments(server_id, room_id)
+        try:
+            previous = {
+                document["_id"]: document
+                async for document in collection.find(
+                    {"_id": {"$in": [ObjectId(updates[index].assignment_id) for index, _ in batch]}},
+                    {"user_id": 1, "grade": 1, "date": 1}
+                )
+            }
+            await collection.bulk_write([operation for _, operation in batch], ordered=False)
+        except BulkWriteError as e:
+            # unordered: the other operations of the batch were still applied
+            for write_error in e.details.get("writeErrors", []):
+                errors[batch[write_error["index"]][0]] = write_error.get("errmsg", "Failed to update grade")
+        except Exception as e:
+            logger.error(f"Bulk grade update failed for server_id={server_id}, room_id={room_id}: {e}")
+            for index, _ in batch:
+                errors[index] = "Failed to update grade"
+            return
+        for index, _ in batch:
+            if index in errors:
+                continue
+            grade_update = updates[index]
+            before = previous.get(ObjectId(grade_update.assignment_id))
+            if before is not None and before.get("user_id") != grade_update.user_id:
+                before = None
+            after = {**(before or {"_id": ObjectId(grade_update.assignment_id), "user_id": grade_update.user_id}), "grade": grade_update.grade}
+            submission_changes.append((room_id, before, after))
+
+    await asyncio.gather(*(write_batch(room_id, batch) for room_id, batch in mongo_batches.items()))
+    await db.commit()
+
+    results = []
+    for index, grade_update in enumerate(updates):
+        result = {
+            "user_id": grade_update.user_id,
+            "grade": grade_update.grade,
+            "assignment_id": grade_update.assignment_id,
+            "date": grade_update.date
+        }
+        if index in errors:
+            result["error"] = errors[index]
+        results.append(result)
+
+    await overview_snapshots.submissions_changed(db, server_id, submission_changes)
+    await overview_snapshots.refresh_member_grades(db, server_id, list({
+        result["user_id"] for result in results if "error" not in result and not result["assignment_id"]
+    }))
     return results
 
 @app.get("/api/server/{server_id}/overview")
-async def get_server_overview(server_id: int, db: db_dependency, Authorization: Optional[str] = Header(None)):
-    if not Authorization or not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = Authorization.replace("Bearer ", "")
-    user = db.query(models.User).filter(models.User.token == token).first()
-    if not user or user.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-    server = db.query(models.Server).filter(models.Server.id == server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-    server_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == user.id,
-        models.ServerMember.server_id == server.id
-    ).first()
-    if not server_member and server.owner_id != user.id:
-        raise HTTPException(status_code=403, detail="Not authorized")
-    # Fetch all grades of current user (including from mongoDB)
-    grades = {}
-    if server_member and server_member.grades:
-        try:
-            grades = json.loads(server_member.grades)
-        except json.JSONDecodeError:
-            raise HTTPException(status_code=500, detail="Invalid grades format in server member data")
-    # add MongoDB grades
-    for collection_name in await mongo_db.list_collection_names():
-        if collection_name.startswith(f"server_{server_id}_assignments_"):
-            assignments = await mongo_db[collection_name].find({"user_id": user.id}).to_list(length=None)
-            for assignment in assignments:
-                if "grade" in assignment:
-                    grades[str(assignment["_id"])] = {
-                        "assignment_id": str(assignment["_id"]),
-                        "room_id": int(collection_name.split("_")[-1]),
-                        "grade": assignment["grade"],
-                        "date": assignment.get("date", None)
-                    }
+async def get_server_overview(server_id: int, db: async_db_dependency, user: current_user_dependency, access: server_access_dependency):
+    await access.require(user.id, server_id, detail="Not authorized")
 
-    # Filter out grades with grade 0 or no grade
-    grades = {k: v for k, v in grades.items() if v.get("grade") not in [0, None]}
-    # If no grades found, return empty list
-    if not grades:
-        grades = []
-
-    # Fetch attendance
-    attendance = db.query(models.Attendance).filter_by(server_id=server_id, user_id=user.id).all()
-    attendance_summary = {}
-    for record in attendance:
-        week_number = record.week.week_number if record.week else 0
-        if week_number not in attendance_summary:
-            attendance_summary[week_number] = {"present": 0, "absent": 0, "excused": 0}
-        attendance_summary[week_number][record.status] += 1
-    
-    # Assignments summary
-    assignments_summary = {}
-    # Get all assignment rooms for this server from PostgreSQL
-    assignment_rooms = db.query(models.ServerRoom).filter(
-        models.ServerRoom.server_id == server_id,
-        models.ServerRoom.type.like("assignments%")
-    ).all()
-
-    for room in assignment_rooms:
-      # Extract due date from room type string: "assignment YYYY-MM-DD HH:MM"
-      try:
-        due_date_str = room.type.split(" ", 1)[1]
-        due_date = datetime.strptime(due_date_str, "%Y-%m-%d %H:%M")
-      except Exception:
-        due_date = None
-
-      # Only include assignments with due_date in the future (or no due_date)
-      if due_date is not None and due_date < datetime.now():
-        continue
-
-      collection_name = f"server_{server_id}_assignments_{room.id}"
-      assignments = await mongo_db[collection_name].find({"user_id": user.id}).to_list(length=None)
-      # If user has assignments, add them as before
-      if assignments:
-        for assignment in assignments:
-          if "grade" in assignment:
-            if room.id not in assignments_summary:
-              assignments_summary[room.id] = []
-            assignments_summary[room.id].append({
-              "assignment_id": str(assignment["_id"]),
-              "grade": assignment["grade"],
-              "date": assignment.get("date", None),
-              "due_date": due_date
-            })
-      else:
-        # User did not submit any assignment for this room, add an empty entry
-        if room.id not in assignments_summary:
-          assignments_summary[room.id] = []
-        assignments_summary[room.id].append({
-          "assignment_id": None,
-          "grade": None,
-          "date": None,
-          "due_date": due_date
-        })
-
-        
-    # Prepare the overview response
-    overview = {
-        "server_name": server.name,
-        "grades": grades,
-        "attendance_summary": attendance_summary,
-        "assignments_summary": assignments_summary,
-    }
+    # grades, attendance and assignments of the current user come from the precomputed snapshot
+    snapshots = await overview_snapshots.get(db, user.id, [server_id])
+    if server_id not in snapshots:
+        raise HTTPException(status_code=403, detail="Not authorized")
 
-    return overview
+    return server_overview_entry(snapshots[server_id])
 
 
 @app.get("/api/server/{server_id}/user/{user_id}/access_level")
 async def get_user_access_level(
     server_id: int,
     user_id: int,
-    db: db_dependency,
-    Authorization: Optional[str] = Header(None)
+    user: current_user_dependency,
+    access: server_access_dependency
 ):
-    if not Authorization or not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = Authorization.replace("Bearer ", "")
-    user = db.query(models.User).filter(models.User.token == token).first()
-    if not user or user.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-
-    server = db.query(models.Server).filter(models.Server.id == server_id).first()
-    if not server:
+    target_access = await access.get(user_id, server_id)
+    if target_access is None:
         raise HTTPException(status_code=404, detail="Server not found")
 
-    server_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == user_id, 
-        models.ServerMember.server_id == server.id
-    ).first()
-
-    if not server_member and server.owner_id != user_id:
+    if not target_access.has_access:
         raise HTTPException(status_code=404, detail="User not found in the server")
-    
-
-    target_member = db.query(models.ServerMember).filter_by(
-        user_id=user_id,
-        server_id=server_id
-    ).first()
 
-    if server.owner_id == user_id:
+    if target_access.is_owner:
         return {"user_id": user_id, "access_level": 3}
 
-    if not target_member:
-        raise HTTPException(status_code=404, detail="User not found in the server")
-
-    return {"user_id": user_id, "access_level": target_member.access_level}
+    return {"user_id": user_id, "access_level": target_access.member_level}
 
 
 
@@ -2455,15 +2094,8 @@ async def update_user_access_level(
     user_id: int,
     request: UpdateAccessLevelRequest,
     db: db_dependency,
-    Authorization: Optional[str] = Header(None)
+    user: current_user_dependency
 ):
-    if not Authorization or not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = Authorization.replace("Bearer ", "")
-    user = db.query(models.User).filter(models.User.token == token).first()
-    if not user or user.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-
     server = db.query(models.Server).filter(models.Server.id == server_id).first()
     if not server:
         raise HTTPException(status_code=404, detail="Server not found")
@@ -2481,6 +2113,8 @@ async def update_user_access_level(
 
     target_member.access_level = request.access_level  # Extract the integer value
     db.commit()
+    await websocket_manager.invalidate_cache("access", user_id=user_id, server_id=server_id)
+    await overview_snapshots.invalidate(server_id=server_id)
     
     return {"user_id": user_id, "access_level": request.access_level}
     
@@ -2489,39 +2123,26 @@ async def update_user_access_level(
 async def delete_user_from_server(
     server_id: int,
     user_id: int,
-    db: db_dependency,
-    Authorization: Optional[str] = Header(None)
+    db: async_db_dependency,
+    user: current_user_dependency,
+    access: server_access_dependency
 ):
-    if not Authorization or not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = Authorization.replace("Bearer ", "")
-    user = db.query(models.User).filter(models.User.token == token).first()
-    if not user or user.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-
-    server = db.query(models.Server).filter(models.Server.id == server_id).first()
-    if not server:
-        raise HTTPException(status_code=404, detail="Server not found")
-    
     # check if current user is at least access_level 1
-    server_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == user.id,
-        models.ServerMember.server_id == server_id
-    ).first()
+    await access.require(user.id, server_id, admin=True, detail="Not authorized to remove users from the server")
 
-    if not (server.owner_id == user.id or (server_member and server_member.access_level > 0)):
-        raise HTTPException(status_code=403, detail="Not authorized to remove users from the server")
-
-    target_member = db.query(models.ServerMember).filter_by(
-        user_id=user_id,
-        server_id=server_id
-    ).first()
+    target_member = await db.scalar(select(models.ServerMember).where(
+        models.ServerMember.user_id == user_id,
+        models.ServerMember.server_id == server_id
+    ))
 
     if not target_member:
         raise HTTPException(status_code=404, detail="User not found in the server")
 
-    db.delete(target_member)
-    db.commit()
+    await db.delete(target_member)
+    await db.commit()
+    await websocket_manager.invalidate_cache("access", user_id=user_id, server_id=server_id)
+    await websocket_manager.invalidate_cache("membership", user_id=user_id)
+    await overview_snapshots.invalidate(server_id=server_id)
 
     return {"message": f"User {user_id} removed from server {server_id}"}
 
@@ -2538,183 +2159,13 @@ class ServerOverview(BaseModel):
 
 @app.get("/api/user/overview/")
 async def get_user_servers_overview(
-    db: db_dependency,
-    Authorization: Optional[str] = Header(None)
+    db: async_db_dependency,
+    user: current_user_dependency
 ):
-    logger.info(f"Received GET request for /api/user/overview, Authorization: {Authorization}")
-    
-    if not Authorization or not Authorization.startswith("Bearer "):
-        logger.error("Missing or invalid Authorization header")
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    
-    token = Authorization.replace("Bearer ", "")
-    user = db.query(models.User).filter(models.User.token == token).first()
-    if not user or user.token_expiry < datetime.now():
-        logger.error(f"Invalid or expired token for user_id={user.id if user else 'unknown'}")
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-
-    # Fetch all servers the user is a member of or owns
-    server_members = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == user.id
-    ).all()
-    owned_servers = db.query(models.Server).filter(
-        models.Server.owner_id == user.id
-    ).all()
-
-    # Combine and deduplicate servers
-    server_ids = set([sm.server_id for sm in server_members] + [s.id for s in owned_servers])
-    servers = db.query(models.Server).filter(models.Server.id.in_(server_ids)).all()
-    logger.info(f"Found {len(servers)} servers for user_id={user.id}: {server_ids}")
-    
-    overview = []
-    try:
-        tz = ZoneInfo("Europe/Bucharest")
-    except Exception:
-        tz = None
-    now = datetime.now(tz) if tz else datetime.now()  # EEST timezone fallback
-    for server in servers:
-        logger.info(f"Processing server_id={server.id}, server_name={server.name}")
-        
-        # Get user's access level
-        server_member = db.query(models.ServerMember).filter(
-            models.ServerMember.user_id == user.id,
-            models.ServerMember.server_id == server.id
-        ).first()
-        access_level = server_member.access_level if server_member else (3 if server.owner_id == user.id else 0)
-        logger.info(f"User access_level={access_level} for server_id={server.id}")
-
-        # Fetch grades
-        grades = {}
-        if server_member and server_member.grades:
-            try:
-                grades = json.loads(server_member.grades)
-                logger.info(f"Loaded grades from ServerMember for server_id={server.id}: {len(grades)} entries")
-            except json.JSONDecodeError as e:
-                logger.error(f"Invalid grades format for user_id={user.id}, server_id={server.id}: {e}")
-                grades = {}
-
-        # Add MongoDB grades
-        for collection_name in await mongo_db.list_collection_names():
-            if collection_name.startswith(f"server_{server.id}_assignments_"):
-                assignments = await mongo_db[collection_name].find({"user_id": user.id}).to_list(length=None)
-                logger.info(f"Found {len(assignments)} assignments in {collection_name}")
-                messages_collection = f"server_{server.id}_messages_{collection_name.split('_')[-1]}"
-                for assignment in assignments:
-                    if "grade" in assignment:
-                      # Only add if user didn't send any messages in the collection
-                      message_count = 0
-                      if messages_collection in await mongo_db.list_collection_names():
-                        message_count = await mongo_db[messages_collection].count_documents({"user_id": user.id, "assignment_id": str(assignment["_id"])})
-                      if message_count == 0:
-                        grades[str(assignment["_id"])] = {
-                            "assignment_id": str(assignment["_id"]),
-                            "room_id": int(collection_name.split("_")[-1]),
-                            "grade": assignment["grade"],
-                            "date": assignment.get("date", None)
-                        }
-                        logger.info(f"Added grade for assignment_id={assignment['_id']} in server_id={server.id}")
-
-        # Filter out grades with grade 0 or None
-        grades = [v for k, v in grades.items() if v.get("grade") not in [0, None]]
-        logger.info(f"Filtered grades for server_id={server.id}: {len(grades)} valid grades")
-
-        # Fetch attendance
-        attendance = db.query(models.Attendance).filter_by(server_id=server.id, user_id=user.id).all()
-        attendance_summary = {}
-        for record in attendance:
-            week_number = record.week.week_number if record.week else 0
-            if week_number not in attendance_summary:
-                attendance_summary[week_number] = {"present": 0, "absent": 0, "excused": 0}
-            attendance_summary[week_number][record.status] += 1
-        logger.info(f"Attendance summary for server_id={server.id}: {len(attendance_summary)} weeks")
-
-        # Assignments summary
-        assignments_summary = {}
-        assignment_rooms = db.query(models.ServerRoom).filter(
-            models.ServerRoom.server_id == server.id,
-            models.ServerRoom.type.like("assignments%")
-        ).all()
-        logger.info(f"Found {len(assignment_rooms)} assignment rooms for server_id={server.id}")
-
-        for room in assignment_rooms:
-            try:
-                due_date_str = room.type.split(" ", 1)[1]
-                try:
-                    due_date = datetime.strptime(due_date_str, "%Y-%m-%d %H:%M").replace(tzinfo=tz)
-                    due_date_iso = due_date.isoformat()
-                except Exception as e:
-                    logger.error(f"Failed to set timezone for due_date in room_id={room.id}, server_id={server.id}: {e}")
-                    due_date = datetime.strptime(due_date_str, "%Y-%m-%d %H:%M")
-                    due_date_iso = due_date.isoformat()
-            except Exception as e:
-                logger.error(f"Invalid due_date format for room_id={room.id}, server_id={server.id}: {e}")
-                due_date = None
-                due_date_iso = None
-
-            collection_name = f"server_{server.id}_assignments_{room.id}"
-            assignments = await mongo_db[collection_name].find({"user_id": user.id}).to_list(length=None)
-            logger.info(f"Found {len(assignments)} assignments in {collection_name}")
-            # If the user has not sent any assignments in this room, add the collection_name to assignments_summary with an empty list
-            if not assignments:
-              assignments_summary[room.id] = []
-              assignments_summary[room.id].append({
-                "assignment_name": str(room.name),
-                "server_id": server.id,
-                "assignment_id": room.id,
-                "grade": assignment["grade"],
-                "date": assignment.get("date", None),
-                "due_date": due_date_iso
-              })
-            else:
-              for assignment in assignments:
-                assignments_summary[room.id] = []
-
-
-        logger.info(f"Assignments summary for server_id={server.id}: {len(assignments_summary)} rooms with assignments")
-
-        # Professor stats (for access_level > 0)
-        professor_stats = None
-        if access_level > 0:
-            member_count = db.query(models.ServerMember).filter(
-                models.ServerMember.server_id == server.id
-            ).count()
-            ungraded_assignments = 0
-            for collection_name in await mongo_db.list_collection_names():
-                if collection_name.startswith(f"server_{server.id}_assignments_"):
-                    # Get all ungraded assignments
-                    ungraded = await mongo_db[collection_name].find({
-                        "$or": [{"grade": None}, {"grade": {"$exists": False}}]
-                    }).to_list(length=None)
-                    # Exclude professor messages (access_level > 0 or owner)
-                    filtered_ungraded = []
-                    for assignment in ungraded:
-                        uid = assignment.get("user_id")
-                        # Check if user is owner or has access_level > 0
-                        if uid == server.owner_id:
-                            continue
-                        member = db.query(models.ServerMember).filter(
-                            models.ServerMember.user_id == uid,
-                            models.ServerMember.server_id == server.id
-                        ).first()
-                        if member and member.access_level > 0:
-                            continue
-                        filtered_ungraded.append(assignment)
-                    ungraded_assignments += len(filtered_ungraded)
-            professor_stats = {
-                "member_count": member_count,
-                "ungraded_assignments": ungraded_assignments
-            }
-            logger.info(f"Professor stats for server_id={server.id}: {professor_stats}")
-
-        overview.append({
-            "server_id": server.id,
-            "server_name": server.name,
-            "access_level": access_level,
-            "grades": grades,
-            "attendance_summary": attendance_summary,
-            "assignments_summary": assignments_summary,
-            "professor_stats": professor_stats
-        })
+    logger.info(f"Received GET request for /api/user/overview, user_id={user.id}")
+
+    server_ids = await membership_index.servers_for(user.id)
+    overview = await build_user_overview(db, overview_snapshots, user.id, server_ids)
 
     logger.info(f"Returning overview for user_id={user.id} with {len(overview)} servers")
     return overview
@@ -2726,36 +2177,27 @@ async def delete_message(
     server_id: int,
     room_id: int,
     message_id: str,
-    db: db_dependency,
-    Authorization: Optional[str] = Header(None)
+    user: current_user_dependency,
+    access: server_access_dependency
 ):
-    if not Authorization or not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = Authorization.replace("Bearer ", "")
-    user = db.query(models.User).filter(models.User.token == token).first()
-    if not user or user.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-    server = db.query(models.Server).filter(models.Server.id == server_id).first()
-    if not server:
+    server_access = await access.get(user.id, server_id)
+    if not server_access:
         raise HTTPException(status_code=404, detail="Server not found")
-    server_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == user.id,
-        models.ServerMember.server_id == server.id
-    ).first()
     # Allow: server owner, access_level > 0, or message author
-    collection_name = f"server_{server_id}_room_{room_id}"
-    if collection_name not in await mongo_db.list_collection_names():
+    if not await mongo_collections.exists(server_id, "room", room_id):
         raise HTTPException(status_code=404, detail="Room not found")
-    message = await mongo_db[collection_name].find_one({"_id": ObjectId(message_id)})
+    collection = await mongo_collections.room(server_id, room_id)
+    message = await collection.find_one({"_id": ObjectId(message_id)})
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
-    is_admin = server.owner_id == user.id or (server_member and server_member.access_level > 0)
+    is_admin = server_access.is_admin
     is_author = message.get("user_id") == user.id
     if not (is_admin or is_author):
         raise HTTPException(status_code=403, detail="User is not authorized to delete this message")
-    result = await mongo_db[collection_name].delete_one({"_id": ObjectId(message_id)})
+    result = await collection.delete_one({"_id": ObjectId(message_id)})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Message not found or you are not the author")
+    await attachment_store.release(attachment_owner(collection.name, message_id))
     
     await websocket_manager.broadcast_textroom(room_id, "message_deleted")
 
@@ -2767,42 +2209,33 @@ async def delete_assignment_message(
     server_id: int,
     assignment_id: str,
     message_id: str,
-    db: db_dependency,
-    Authorization: Optional[str] = Header(None)
+    db: async_db_dependency,
+    user: current_user_dependency,
+    access: server_access_dependency
 ):
-    if not Authorization or not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = Authorization.replace("Bearer ", "")
-    user = db.query(models.User).filter(models.User.token == token).first()
-    if not user or user.token_expiry < datetime.now():
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-    
-    server = db.query(models.Server).filter(models.Server.id == server_id).first()
-    if not server:
+    server_access = await access.get(user.id, server_id)
+    if not server_access:
         raise HTTPException(status_code=404, detail="Server not found")
     
-    collection_name = f"server_{server_id}_assignments_{assignment_id}"
-    if collection_name not in await mongo_db.list_collection_names():
+    if not assignment_id.isdigit() or not await mongo_collections.exists(server_id, "assignments", int(assignment_id)):
         raise HTTPException(status_code=404, detail="Assignment not found")
+    collection = await mongo_collections.assignments(server_id, int(assignment_id))
     
-    message = await mongo_db[collection_name].find_one({"_id": ObjectId(message_id)})
+    message = await collection.find_one({"_id": ObjectId(message_id)})
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
     
-    server_member = db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == user.id,
-        models.ServerMember.server_id == server.id
-    ).first()
-    
-    is_admin = server.owner_id == user.id or (server_member and server_member.access_level > 0)
+    is_admin = server_access.is_admin
     is_author = message.get("user_id") == user.id
     
     if not (is_admin or is_author):
         raise HTTPException(status_code=403, detail="User is not authorized to delete this message")
     
-    result = await mongo_db[collection_name].delete_one({"_id": ObjectId(message_id)})
+    result = await collection.delete_one({"_id": ObjectId(message_id)})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Message not found or you are not the author")
+    await attachment_store.release(attachment_owner(collection.name, message_id))
+    await overview_snapshots.submissions_changed(db, server_id, [(int(assignment_id), message, None)])
     
     await websocket_manager.broadcast_textroom(int(assignment_id), "message_deleted")
     
@@ -2835,7 +2268,9 @@ async def create_test_user(request: TestUserRequest, db: Session = Depends(get_d
             refresh_token_expiry=datetime.now() + timedelta(days=7)
         )
         db.add(user)
+        old_token = None
     else:
+        old_token = user.token
         user.token = generate_token()
         user.refresh_token = generate_refresh_token()
         user.token_expiry = datetime.now() + timedelta(days=1)
@@ -2843,6 +2278,7 @@ async def create_test_user(request: TestUserRequest, db: Session = Depends(get_d
     
     db.commit()
     db.refresh(user)
+    await invalidate_token(old_token)    # old token must not keep resolving from the auth cache
     
     return {
         "id": user.id,
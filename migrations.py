@@ -0,0 +1,114 @@
+# One-shot data migrations, run from the repository folder:
+#
+#   python migrations.py grades               # move ServerMember.grades JSON into the grade table
+#   python migrations.py attendance           # SMALLINT status, (user, week) unique key, composite indexes
+#   python migrations.py attendance-plans 42  # EXPLAIN the hot attendance queries of server 42
+import argparse
+import json
+from datetime import datetime
+
+from sqlalchemy import SmallInteger, inspect, select, text
+
+from attendance import indexed_queries
+from database import engine, SessionLocal
+import models
+
+
+def migrate_grades():
+    """Copy every JSON grade into the grade table and clear the JSON, except malformed entries (safe to re-run)."""
+    models.Base.metadata.create_all(bind=engine, tables=[models.Grade.__table__])
+    db = SessionLocal()
+    try:
+        members = db.query(models.ServerMember).filter(models.ServerMember.grades.isnot(None), models.ServerMember.grades != "").all()
+        moved, skipped, bad_entries = 0, 0, 0
+        for member in members:
+            try:
+                grades = json.loads(member.grades)
+            except json.JSONDecodeError:
+                print(f"Skipping invalid grades JSON for user_id={member.user_id}, server_id={member.server_id}")
+                skipped += 1
+                continue
+            rows, kept = [], {}
+            for key, entry in grades.items():
+                try:
+                    if entry.get("grade") is None:
+                        continue
+                    # entries without a date fall back to their key, which is str(datetime.now()) at creation
+                    date = datetime.fromisoformat(entry.get("date") or key)
+                except (AttributeError, TypeError, ValueError) as e:
+                    # left in the JSON column so nothing is lost, a re-run only retries these
+                    print(f"Skipping grade {key!r} of user_id={member.user_id}, server_id={member.server_id}: {e}")
+                    kept[key] = entry
+                    continue
+                rows.append({
+                    "server_id": member.server_id,
+                    "user_id": member.user_id,
+                    "grade": entry["grade"],
+                    "date": date,
+                })
+            if rows:
+                db.execute(models.Grade.__table__.insert(), rows)
+            member.grades = json.dumps(kept) if kept else ""
+            moved += len(rows)
+            bad_entries += len(kept)
+        db.commit()
+        print(f"Moved {moved} grades from {len(members) - skipped} members ({skipped} members skipped, {bad_entries} malformed grades left in place)")
+    finally:
+        db.close()
+
+
+def migrate_attendance():
+    """Postgres only, every step is skipped when already applied."""
+    inspector = inspect(engine)
+    status_type = next(column["type"] for column in inspector.get_columns("attendance") if column["name"] == "status")
+    constraints = {constraint["name"] for constraint in inspector.get_unique_constraints("attendance")}
+    status_case = " ".join(f"WHEN '{status}' THEN {code}" for status, code in models.ATTENDANCE_STATUS_CODES.items())
+
+    with engine.begin() as conn:
+        if not isinstance(status_type, SmallInteger):
+            # unknown free-form statuses become "absent"
+            conn.execute(text(f"ALTER TABLE attendance ALTER COLUMN status TYPE SMALLINT USING (CASE status {status_case} ELSE 0 END)"))
+            print("attendance.status converted to SMALLINT")
+        if "uq_attendance_user_week" not in constraints:
+            # keep the most recent record of duplicated (user, week) pairs
+            deleted = conn.execute(text(
+                "DELETE FROM attendance a USING attendance b "
+                "WHERE a.user_id = b.user_id AND a.week_id = b.week_id AND a.id < b.id"
+            )).rowcount
+            conn.execute(text("ALTER TABLE attendance ADD CONSTRAINT uq_attendance_user_week UNIQUE (user_id, week_id)"))
+            print(f"Added uq_attendance_user_week ({deleted} duplicate records removed)")
+        for index in models.Attendance.__table__.indexes:
+            index.create(conn, checkfirst=True)
+    print("Attendance schema is up to date")
+
+
+def explain_attendance(server_id: int):
+    """Prints the query plans of the hot attendance queries, they should use the composite indexes."""
+    db = SessionLocal()
+    try:
+        week_id = db.scalar(select(models.ServerWeek.id).filter_by(server_id=server_id).order_by(models.ServerWeek.week_number))
+        user_id = db.scalar(select(models.Attendance.user_id).filter_by(server_id=server_id))
+        for name, (query, indexes) in indexed_queries(server_id, week_id, user_id).items():
+            sql = query.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True})
+            print(f"--- {name} (expects {' or '.join(indexes)})")
+            for line, in db.execute(text(f"EXPLAIN {sql}")):
+                print(line)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="UniVerse data migrations")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("grades", help="move ServerMember.grades JSON into the grade table")
+    commands.add_parser("attendance", help="upgrade the attendance table (status codes, unique key, indexes)")
+    plans = commands.add_parser("attendance-plans", help="EXPLAIN the hot attendance queries")
+    plans.add_argument("server_id", type=int)
+    args = parser.parse_args()
+
+    if args.command == "grades":
+        migrate_grades()
+    elif args.command == "attendance":
+        migrate_attendance()
+    elif args.command == "attendance-plans":
+        explain_attendance(args.server_id)
@@ -1,7 +1,37 @@
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, String, LargeBinary
+from sqlalchemy import Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, SmallInteger, String, LargeBinary, UniqueConstraint
 from sqlalchemy.orm import relationship
+from sqlalchemy.types import TypeDecorator
 from database import Base
 
+# Attendance statuses, stored as small integers
+ATTENDANCE_STATUS_CODES = {"absent": 0, "present": 1, "excused": 2}
+ATTENDANCE_STATUSES = {code: status for status, code in ATTENDANCE_STATUS_CODES.items()}
+
+
+class AttendanceStatus(TypeDecorator):
+    """"absent"/"present"/"excused" in Python, SMALLINT in the database."""
+    impl = SmallInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if value not in ATTENDANCE_STATUS_CODES:
+            raise ValueError(f"Unknown attendance status: {value!r}")
+        return ATTENDANCE_STATUS_CODES[value]
+
+    def process_literal_param(self, value, dialect):
+        return str(self.process_bind_param(value, dialect))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            # VARCHAR column not converted yet (python migrations.py attendance), same mapping as the migration
+            return value if value in ATTENDANCE_STATUS_CODES else "absent"
+        return ATTENDANCE_STATUSES[value]
+
+
 # User Model
 class User(Base):
     __tablename__ = "user"
@@ -61,12 +91,19 @@ class Attendance(Base):
     user_id = Column(Integer, ForeignKey("user.id"))
     server_id = Column(Integer, ForeignKey("server.id"))
     date = Column(DateTime)
-    status = Column(String)  # e.g., "present", "absent", "excused"
+    status = Column(AttendanceStatus)  # "present", "absent" or "excused"
     week_id = Column(Integer, ForeignKey("server_week.id"))
     week = relationship("ServerWeek", back_populates="attendances")
     user = relationship("User")
     server = relationship("Server")
 
+    # existing databases get these through `python migrations.py attendance`
+    __table_args__ = (
+        UniqueConstraint("user_id", "week_id", name="uq_attendance_user_week"),
+        Index("ix_attendance_server_week", "server_id", "week_id"),
+        Index("ix_attendance_server_user", "server_id", "user_id"),
+    )
+
 class ServerWeek(Base):
     __tablename__ = "server_week"
 
@@ -85,7 +122,22 @@ class ServerMember(Base):
     access_level = Column(Integer, default=0)
     user = relationship("User", back_populates="memberships")
     server = relationship("Server", back_populates="members")
-    grades = Column(String, default="")  # Store grades as JSON
+    grades = Column(String, default="")  # Legacy JSON grades, moved to Grade by `python migrations.py grades`
+
+# Grade Model (grades given directly by the professor, assignment grades live in MongoDB)
+class Grade(Base):
+    __tablename__ = "grade"
+
+    id = Column(Integer, primary_key=True, index=True)
+    server_id = Column(Integer, ForeignKey("server.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    grade = Column(Float, nullable=False)
+    date = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_grade_server_user", "server_id", "user_id"),
+        Index("ix_grade_server_date", "server_id", "date"),
+    )
 
 
 
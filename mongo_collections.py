@@ -0,0 +1,198 @@
+# Per-room MongoDB collections (server_{id}_room_{rid} / server_{id}_assignments_{rid})
+import logging
+import re
+from typing import Dict, Iterable, List, Sequence, Set, Tuple
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+ROOM_COLLECTION = re.compile(r"^server_(\d+)_room_(\d+)$")
+ASSIGNMENTS_COLLECTION = re.compile(r"^server_(\d+)_assignments_(\d+)$")
+
+# Metadata collection listing every room/assignment collection: {_id: name, server_id, room_id, kind}
+REGISTRY_COLLECTION = "room_collections"
+# Other workers may register collections for a server, so cached lists are refreshed periodically
+REGISTRY_CACHE_TTL = 60  # seconds
+
+# (timestamp, _id) also serves plain timestamp sorts and the paginated history endpoint
+ROOM_INDEXES = [
+    IndexModel([("timestamp", ASCENDING), ("_id", ASCENDING)], name="timestamp_id"),
+    IndexModel([("user_id", ASCENDING), ("timestamp", ASCENDING)], name="user_id_timestamp"),
+    IndexModel([("reply_to", ASCENDING)], name="reply_to"),
+]
+ASSIGNMENT_INDEXES = ROOM_INDEXES + [
+    IndexModel([("grade", DESCENDING)], name="grade"),
+]
+
+
+def parse_collection_name(collection_name: str):
+    """Returns (kind, server_id, room_id) for room/assignment collections, None otherwise."""
+    for kind, pattern in (("room", ROOM_COLLECTION), ("assignments", ASSIGNMENTS_COLLECTION)):
+        match = pattern.match(collection_name)
+        if match:
+            return kind, int(match.group(1)), int(match.group(2))
+    return None
+
+
+def room_collection_name(server_id: int, room_id: int) -> str:
+    return f"server_{server_id}_room_{room_id}"
+
+
+def assignments_collection_name(server_id: int, room_id: int) -> str:
+    return f"server_{server_id}_assignments_{room_id}"
+
+
+def kind_collection_name(kind: str, server_id: int, room_id: int) -> str:
+    return room_collection_name(server_id, room_id) if kind == "room" else assignments_collection_name(server_id, room_id)
+
+
+class MongoCollections:
+    """
+    Hands out room and assignment collections, creating their indexes the first
+    time each one is used by this process.
+
+    Also keeps a registry of which collections exist per server (REGISTRY_COLLECTION,
+    cached in-process) so endpoints never have to call list_collection_names().
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.registry = db[REGISTRY_COLLECTION]
+        self._provisioned: Set[str] = set()
+        # server_id -> {kind: {room_id: collection_name}}
+        self._servers = TTLCache(maxsize=10000, ttl=REGISTRY_CACHE_TTL)
+        # set once backfill_indexes() registered every existing collection, until then
+        # server lookups also list the collections by name
+        self._registry_complete = False
+
+    async def ensure_indexes(self, collection_name: str):
+        if collection_name in self._provisioned:
+            return
+        parsed = parse_collection_name(collection_name)
+        if parsed is None:
+            return
+        kind, server_id, room_id = parsed
+        # create_indexes is a no-op for indexes that already exist
+        await self.db[collection_name].create_indexes(ASSIGNMENT_INDEXES if kind == "assignments" else ROOM_INDEXES)
+        await self.registry.update_one(
+            {"_id": collection_name},
+            {"$set": {"server_id": server_id, "room_id": room_id, "kind": kind}},
+            upsert=True
+        )
+        self._provisioned.add(collection_name)
+        cached = self._servers.get(server_id)
+        if cached is not None:
+            cached.setdefault(kind, {})[room_id] = collection_name
+
+    async def room(self, server_id: int, room_id: int):
+        name = room_collection_name(server_id, room_id)
+        await self.ensure_indexes(name)
+        return self.db[name]
+
+    async def assignments(self, server_id: int, room_id: int):
+        name = assignments_collection_name(server_id, room_id)
+        await self.ensure_indexes(name)
+        return self.db[name]
+
+    async def _load_entries(self, server_ids: List[int]) -> Dict[int, Dict[str, Dict[int, str]]]:
+        entries: Dict[int, Dict[str, Dict[int, str]]] = {server_id: {} for server_id in server_ids}
+        async for doc in self.registry.find({"server_id": {"$in": server_ids}}):
+            entries[doc["server_id"]].setdefault(doc["kind"], {})[doc["room_id"]] = doc["_id"]
+        if not self._registry_complete:
+            # legacy collections the backfill has not registered (yet, or because it failed for them)
+            pattern = f"^server_({'|'.join(map(str, server_ids))})_"
+            for name in await self.db.list_collection_names(filter={"name": {"$regex": pattern}}):
+                parsed = parse_collection_name(name)
+                if parsed is None:
+                    continue
+                kind, server_id, room_id = parsed
+                if room_id in entries[server_id].get(kind, {}):
+                    continue
+                entries[server_id].setdefault(kind, {})[room_id] = name
+                try:
+                    await self.ensure_indexes(name)
+                except Exception as e:
+                    logger.error(f"Failed to create indexes for {name}: {e}")
+        for server_id, entry in entries.items():
+            self._servers.set(server_id, entry)
+        return entries
+
+    async def _server_entry(self, server_id: int) -> Dict[str, Dict[int, str]]:
+        entry = self._servers.get(server_id)
+        if entry is None:
+            entry = (await self._load_entries([server_id]))[server_id]
+        return entry
+
+    async def server_collections(self, server_id: int, kind: str) -> List[Tuple[int, str]]:
+        """(room_id, collection_name) of every `kind` ("room"/"assignments") collection of a server."""
+        entry = await self._server_entry(server_id)
+        return sorted(entry.get(kind, {}).items())
+
+    async def server_collections_many(self, server_ids: Iterable[int], kind: str) -> Dict[int, List[Tuple[int, str]]]:
+        """server_collections() for several servers, loading uncached servers with a single query."""
+        server_ids = list(server_ids)
+        entries = {server_id: self._servers.get(server_id) for server_id in server_ids}
+        missing = [server_id for server_id, entry in entries.items() if entry is None]
+        if missing:
+            entries.update(await self._load_entries(missing))
+        return {server_id: sorted(entry.get(kind, {}).items()) for server_id, entry in entries.items()}
+
+    async def aggregate_across(self, sources: Sequence[Tuple[str, dict]], pipeline: List[dict], tail: List[dict] = ()) -> List[dict]:
+        """
+        Runs `pipeline` on every collection in `sources` ((collection_name, fields) pairs,
+        `fields` are added to each output document) and concatenates the results with
+        $unionWith, so any number of collections costs a single round trip. `tail` runs
+        on the combined stream.
+        """
+        if not sources:
+            return []
+
+        def branch(fields: dict) -> List[dict]:
+            return list(pipeline) + [{"$addFields": {key: {"$literal": value} for key, value in fields.items()}}]
+
+        (first_name, first_fields), rest = sources[0], sources[1:]
+        stages = branch(first_fields)
+        stages += [{"$unionWith": {"coll": name, "pipeline": branch(fields)}} for name, fields in rest]
+        stages += list(tail)
+        return await self.db[first_name].aggregate(stages).to_list(length=None)
+
+    async def exists(self, server_id: int, kind: str, room_id: int) -> bool:
+        entry = await self._server_entry(server_id)
+        if room_id in entry.get(kind, {}):
+            return True
+        # the cached entry may predate a collection registered by another worker,
+        # and collections the backfill has not reached yet are not registered at all
+        name = kind_collection_name(kind, server_id, room_id)
+        if not await self.registry.find_one({"_id": name}, {"_id": 1}):
+            if not await self.db.list_collection_names(filter={"name": name}):
+                return False
+        await self.ensure_indexes(name)  # registers it, and adds it to the cached entry
+        entry.setdefault(kind, {})[room_id] = name
+        return True
+
+    async def drop(self, server_id: int, kind: str, room_id: int):
+        name = kind_collection_name(kind, server_id, room_id)
+        await self.db.drop_collection(name)
+        await self.registry.delete_one({"_id": name})
+        self._provisioned.discard(name)
+        entry = self._servers.get(server_id)
+        if entry is not None:
+            entry.get(kind, {}).pop(room_id, None)
+
+    async def backfill_indexes(self):
+        """Provision indexes for every existing room/assignment collection (and register them)."""
+        await self.registry.create_index([("server_id", ASCENDING)])
+        count, failed = 0, 0
+        for collection_name in await self.db.list_collection_names():
+            if collection_name in self._provisioned:
+                continue
+            try:
+                await self.ensure_indexes(collection_name)
+                count += collection_name in self._provisioned
+            except Exception as e:
+                logger.error(f"Failed to create indexes for {collection_name}: {e}")
+                failed += 1
+        self._registry_complete = not failed
+        logger.info(f"Mongo index backfill done, {count} collections provisioned")
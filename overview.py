@@ -0,0 +1,452 @@
+# Dashboard overviews (/api/user/overview/ and /api/server/{server_id}/overview)
+#
+# Both endpoints read per-(user, server) snapshots kept in the overview_snapshots
+# Mongo collection. A snapshot is built with a fixed number of batched queries the
+# first time it is needed, and afterwards only the section touched by a write
+# (attendance, grades) is recomputed, for just the users involved. Submission
+# writes patch the submitter's snapshot and $inc the ungraded counter of the staff
+# snapshots, the aggregation over every assignment collection only runs on builds.
+# Structural changes (membership, rooms, server name) drop the snapshots of the
+# server so they are rebuilt on the next read.
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+from pymongo import UpdateOne
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from access import OWNER_ACCESS_LEVEL
+from mongo_collections import MongoCollections, assignments_collection_name
+import models
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_COLLECTION = "overview_snapshots"
+# Safety net for changes made outside the API (manual edits, migrations)
+SNAPSHOT_MAX_AGE = timedelta(hours=6)
+ATTENDANCE_STATUSES = ("present", "absent", "excused")
+
+Pair = Tuple[int, int]  # (user_id, server_id)
+# (room_id, document before, document after) of one assignment submission, None when absent
+SubmissionChange = Tuple[int, Optional[Dict], Optional[Dict]]
+
+
+def overview_timezone():
+    try:
+        return ZoneInfo("Europe/Bucharest")
+    except Exception:
+        return None
+
+
+def parse_due_date(room_type: str) -> Optional[datetime]:
+    """Assignment rooms carry their due date in the type: "assignments YYYY-MM-DD HH:MM"."""
+    try:
+        return datetime.strptime(room_type.split(" ", 1)[1], "%Y-%m-%d %H:%M")
+    except Exception:
+        return None
+
+
+def snapshot_id(user_id: int, server_id: int) -> str:
+    return f"{user_id}:{server_id}"
+
+
+def submission_entry(document: Dict) -> Dict:
+    """How an assignment submission is stored in the snapshot's "submissions" section."""
+    submission = {"assignment_id": str(document["_id"]), "date": document.get("date", None)}
+    if "grade" in document:
+        submission["grade"] = document["grade"]
+    return submission
+
+
+def is_ungraded(document: Optional[Dict]) -> bool:
+    return document is not None and document.get("grade") is None
+
+
+########### SECTION QUERIES (batched over users and servers) ###########
+
+async def load_memberships(db: AsyncSession, user_id: int, server_ids: Optional[Iterable[int]] = None) -> Dict[int, Dict]:
+    """Servers the user owns or is a member of: name, owner and access level."""
+    query = (
+        select(models.Server.id, models.Server.name, models.Server.owner_id, models.ServerMember.user_id, models.ServerMember.access_level)
+        .outerjoin(models.ServerMember, and_(
+            models.ServerMember.server_id == models.Server.id,
+            models.ServerMember.user_id == user_id
+        ))
+        .where(or_(models.Server.owner_id == user_id, models.ServerMember.user_id.isnot(None)))
+    )
+    if server_ids is not None:
+        query = query.where(models.Server.id.in_(list(server_ids)))
+    servers = {}
+    for server_id, name, owner_id, member_user_id, member_level in await db.execute(query):
+        servers[server_id] = {
+            "server_name": name,
+            "owner_id": owner_id,
+            "access_level": (member_level or 0) if member_user_id is not None else OWNER_ACCESS_LEVEL,
+        }
+    return servers
+
+
+async def load_attendance(db: AsyncSession, user_ids: List[int], server_ids: List[int]) -> Dict[Pair, Dict]:
+    week_number = func.coalesce(models.ServerWeek.week_number, 0)
+    rows = await db.execute(
+        select(models.Attendance.user_id, models.Attendance.server_id, week_number, models.Attendance.status, func.count())
+        .outerjoin(models.ServerWeek, models.Attendance.week_id == models.ServerWeek.id)
+        .where(models.Attendance.user_id.in_(user_ids), models.Attendance.server_id.in_(server_ids))
+        .group_by(models.Attendance.user_id, models.Attendance.server_id, week_number, models.Attendance.status)
+    )
+    summaries: Dict[Pair, Dict] = {}
+    for user_id, server_id, week, status, count in rows:
+        summary = summaries.setdefault((user_id, server_id), {}).setdefault(str(week), dict.fromkeys(ATTENDANCE_STATUSES, 0))
+        summary[status] = summary.get(status, 0) + count
+    return summaries
+
+
+async def load_member_grades(db: AsyncSession, user_ids: List[int], server_ids: List[int]) -> Dict[Pair, List[Dict]]:
+    """
+    Professor-entered grades (Grade table), as a list of {"key", "entry"} pairs
+    (the keys are timestamps, which may not be used as Mongo field names).
+    """
+    rows = await db.execute(
+        select(models.Grade.user_id, models.Grade.server_id, models.Grade.grade, models.Grade.date)
+        .where(models.Grade.server_id.in_(server_ids), models.Grade.user_id.in_(user_ids))
+        .order_by(models.Grade.date)
+    )
+    grades: Dict[Pair, List[Dict]] = {}
+    for user_id, server_id, grade, date in rows:
+        grades.setdefault((user_id, server_id), []).append({
+            "key": str(date),
+            "entry": {"assignment_id": None, "room_id": None, "grade": grade, "date": date.isoformat()},
+        })
+    return grades
+
+
+async def load_assignment_rooms(db: AsyncSession, server_ids: List[int]) -> Dict[int, List[Dict]]:
+    rooms = await db.execute(
+        select(models.ServerRoom.server_id, models.ServerRoom.id, models.ServerRoom.name, models.ServerRoom.type)
+        .where(models.ServerRoom.server_id.in_(server_ids), models.ServerRoom.type.like("assignments%"))
+        .order_by(models.ServerRoom.id)
+    )
+    by_server: Dict[int, List[Dict]] = {server_id: [] for server_id in server_ids}
+    for server_id, room_id, name, room_type in rooms:
+        by_server[server_id].append({"room_id": room_id, "name": name, "type": room_type})
+    return by_server
+
+
+async def assignment_sources(collections: MongoCollections, server_ids: List[int], rooms: Dict[int, List[Dict]]) -> List[Tuple[str, Dict]]:
+    """Every assignment collection of the servers: registered ones plus the assignment rooms."""
+    sources = {}
+    for server_id, server_collections in (await collections.server_collections_many(server_ids, "assignments")).items():
+        for room_id, collection_name in server_collections:
+            sources[collection_name] = {"server_id": server_id, "room_id": room_id}
+    for server_id, server_rooms in rooms.items():
+        for room in server_rooms:
+            sources.setdefault(assignments_collection_name(server_id, room["room_id"]), {"server_id": server_id, "room_id": room["room_id"]})
+    return list(sources.items())
+
+
+async def load_submissions(collections: MongoCollections, user_ids: List[int], sources: List[Tuple[str, Dict]]) -> Dict[Pair, Dict]:
+    """Assignment submissions per (user, server), grouped by room: {room_id: [{assignment_id, grade?, date}]}."""
+    documents = await collections.aggregate_across(
+        sources,
+        [{"$match": {"user_id": {"$in": user_ids}}}, {"$project": {"user_id": 1, "grade": 1, "date": 1}}]
+    )
+    submissions: Dict[Pair, Dict] = {}
+    for document in documents:
+        rooms = submissions.setdefault((document["user_id"], document["server_id"]), {})
+        rooms.setdefault(str(document["room_id"]), []).append(submission_entry(document))
+    return submissions
+
+
+async def load_staff(db: AsyncSession, server_ids: List[int], user_ids: Optional[Iterable[int]] = None) -> Dict[int, set]:
+    """Owner and members with access level > 0 per server (among `user_ids` if given)."""
+    server_query = select(models.Server.id, models.Server.owner_id).where(models.Server.id.in_(server_ids))
+    member_query = (
+        select(models.ServerMember.server_id, models.ServerMember.user_id)
+        .where(models.ServerMember.server_id.in_(server_ids), models.ServerMember.access_level > 0)
+    )
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        server_query = server_query.where(models.Server.owner_id.in_(user_ids))
+        member_query = member_query.where(models.ServerMember.user_id.in_(user_ids))
+    staff = {server_id: set() for server_id in server_ids}
+    for server_id, user_id in list(await db.execute(server_query)) + list(await db.execute(member_query)):
+        staff[server_id].add(user_id)
+    return staff
+
+
+async def load_professor_stats(db: AsyncSession, collections: MongoCollections, server_ids: List[int], sources: List[Tuple[str, Dict]]) -> Dict[int, Dict]:
+    """Member count and number of ungraded student submissions per server."""
+    if not server_ids:
+        return {}
+    member_counts = dict((await db.execute(
+        select(models.ServerMember.server_id, func.count())
+        .where(models.ServerMember.server_id.in_(server_ids))
+        .group_by(models.ServerMember.server_id)
+    )).all())
+    staff = await load_staff(db, server_ids)
+
+    ungraded = dict.fromkeys(server_ids, 0)
+    counts = await collections.aggregate_across(
+        [(name, fields) for name, fields in sources if fields["server_id"] in ungraded],
+        [
+            {"$match": {"$or": [{"grade": None}, {"grade": {"$exists": False}}]}},
+            {"$group": {"_id": "$user_id", "count": {"$sum": 1}}},
+        ],
+        [{"$group": {"_id": {"server_id": "$server_id", "user_id": "$_id"}, "count": {"$sum": "$count"}}}]
+    )
+    for row in counts:
+        server_id, user_id = row["_id"]["server_id"], row["_id"]["user_id"]
+        if user_id not in staff.get(server_id, ()):
+            ungraded[server_id] += row["count"]
+
+    return {
+        server_id: {"member_count": member_counts.get(server_id, 0), "ungraded_assignments": ungraded[server_id]}
+        for server_id in server_ids
+    }
+
+
+########### SNAPSHOTS ###########
+
+class OverviewSnapshots:
+    def __init__(self, mongo_db, collections: MongoCollections):
+        self.snapshots = mongo_db[SNAPSHOT_COLLECTION]
+        self.collections = collections
+
+    async def ensure_indexes(self):
+        await self.snapshots.create_index([("server_id", 1), ("user_id", 1)])
+
+    async def build(self, db: AsyncSession, user_id: int, server_ids: Optional[Iterable[int]] = None) -> Dict[int, Dict]:
+        """Compute and store the snapshots of one user (all their servers, or `server_ids`)."""
+        memberships = await load_memberships(db, user_id, server_ids)
+        if not memberships:
+            return {}
+        ids = list(memberships)
+        admin_ids = [server_id for server_id, membership in memberships.items() if membership["access_level"] > 0]
+
+        rooms = await load_assignment_rooms(db, ids)
+        sources = await assignment_sources(self.collections, ids, rooms)
+        attendance = await load_attendance(db, [user_id], ids)
+        member_grades = await load_member_grades(db, [user_id], ids)
+        submissions = await load_submissions(self.collections, [user_id], sources)
+        professor_stats = await load_professor_stats(db, self.collections, admin_ids, sources)
+
+        built_at = datetime.now()
+        snapshots = {}
+        for server_id, membership in memberships.items():
+            snapshots[server_id] = {
+                "_id": snapshot_id(user_id, server_id),
+                "user_id": user_id,
+                "server_id": server_id,
+                **membership,
+                "built_at": built_at,
+                "member_grades": member_grades.get((user_id, server_id), []),
+                "attendance_summary": attendance.get((user_id, server_id), {}),
+                "assignment_rooms": rooms[server_id],
+                "submissions": submissions.get((user_id, server_id), {}),
+                "professor_stats": professor_stats.get(server_id),
+            }
+        await self.snapshots.bulk_write(
+            [UpdateOne({"_id": snapshot["_id"]}, {"$set": snapshot}, upsert=True) for snapshot in snapshots.values()],
+            ordered=False
+        )
+        logger.info(f"Built {len(snapshots)} overview snapshots for user_id={user_id}")
+        return snapshots
+
+    async def get(self, db: AsyncSession, user_id: int, server_ids: Iterable[int]) -> Dict[int, Dict]:
+        """Snapshots of the user for `server_ids`, building the missing or expired ones."""
+        server_ids = list(server_ids)
+        if not server_ids:
+            return {}
+        fresh_after = datetime.now() - SNAPSHOT_MAX_AGE
+        snapshots = {}
+        async for snapshot in self.snapshots.find({"_id": {"$in": [snapshot_id(user_id, server_id) for server_id in server_ids]}}):
+            if snapshot["built_at"] >= fresh_after:
+                snapshots[snapshot["server_id"]] = snapshot
+        missing = [server_id for server_id in server_ids if server_id not in snapshots]
+        if missing:
+            snapshots.update(await self.build(db, user_id, missing))
+        return snapshots
+
+    async def _holders(self, server_id: int, user_ids: Optional[Iterable[int]]) -> List[int]:
+        """Users that have a snapshot for the server (only those need updating)."""
+        query = {"server_id": server_id}
+        if user_ids is not None:
+            query["user_id"] = {"$in": list(set(user_ids))}
+        return await self.snapshots.distinct("user_id", query)
+
+    async def _set_sections(self, server_id: int, sections: Dict[int, Dict]):
+        if sections:
+            await self.snapshots.bulk_write(
+                [UpdateOne({"_id": snapshot_id(user_id, server_id)}, {"$set": fields}) for user_id, fields in sections.items()],
+                ordered=False
+            )
+
+    async def refresh_attendance(self, db: AsyncSession, server_id: int, user_ids: Optional[Iterable[int]] = None):
+        """After attendance changes for `user_ids` (None = everyone) on a server."""
+        try:
+            holders = await self._holders(server_id, user_ids)
+            if not holders:
+                return
+            attendance = await load_attendance(db, holders, [server_id])
+            await self._set_sections(server_id, {
+                user_id: {"attendance_summary": attendance.get((user_id, server_id), {})} for user_id in holders
+            })
+        except Exception as e:
+            await self._recover(server_id, e)
+
+    async def refresh_member_grades(self, db: AsyncSession, server_id: int, user_ids: Iterable[int]):
+        """After professor-entered grades (Grade table) of `user_ids` change on a server."""
+        try:
+            holders = await self._holders(server_id, user_ids)
+            if not holders:
+                return
+            member_grades = await load_member_grades(db, holders, [server_id])
+            await self._set_sections(server_id, {
+                user_id: {"member_grades": member_grades.get((user_id, server_id), [])} for user_id in holders
+            })
+        except Exception as e:
+            await self._recover(server_id, e)
+
+    async def submissions_changed(self, db: AsyncSession, server_id: int, changes: Iterable[SubmissionChange]):
+        """
+        After assignment submissions are added (before None), graded or deleted (after None):
+        patches the submitters' snapshots and moves the staff's ungraded counter by the
+        difference, without aggregating the server's assignment collections again.
+        """
+        try:
+            patches = []
+            ungraded: Dict[int, int] = {}  # user_id -> change of their ungraded submissions
+            for room_id, before, after in changes:
+                document = after or before
+                _id, section = snapshot_id(document["user_id"], server_id), f"submissions.{room_id}"
+                if before is None:
+                    patches.append(UpdateOne({"_id": _id}, {"$push": {section: submission_entry(after)}}))
+                elif after is None:
+                    patches.append(UpdateOne({"_id": _id}, {"$pull": {section: {"assignment_id": str(before["_id"])}}}))
+                else:
+                    patches.append(UpdateOne(
+                        {"_id": _id, f"{section}.assignment_id": str(after["_id"])},
+                        {"$set": {f"{section}.$": submission_entry(after)}}
+                    ))
+                delta = is_ungraded(after) - is_ungraded(before)
+                if delta:
+                    ungraded[document["user_id"]] = ungraded.get(document["user_id"], 0) + delta
+            if patches:
+                await self.snapshots.bulk_write(patches, ordered=False)
+
+            # submissions of staff members are not counted as ungraded
+            if any(ungraded.values()):
+                staff = (await load_staff(db, [server_id], ungraded))[server_id]
+                delta = sum(count for user_id, count in ungraded.items() if user_id not in staff)
+                if delta:
+                    await self.snapshots.update_many(
+                        {"server_id": server_id, "access_level": {"$gt": 0}, "professor_stats": {"$ne": None}},
+                        {"$inc": {"professor_stats.ungraded_assignments": delta}}
+                    )
+        except Exception as e:
+            await self._recover(server_id, e)
+
+    async def _recover(self, server_id: int, error: Exception):
+        # a failed refresh must not fail the write that triggered it, drop the snapshots instead
+        logger.error(f"Overview snapshot refresh failed for server_id={server_id}, invalidating: {error}")
+        try:
+            await self.invalidate(server_id=server_id)
+        except Exception as e:
+            logger.error(f"Failed to invalidate overview snapshots for server_id={server_id}: {e}")
+
+    async def invalidate(self, server_id: Optional[int] = None, user_id: Optional[int] = None):
+        query = {}
+        if server_id is not None:
+            query["server_id"] = server_id
+        if user_id is not None:
+            query["user_id"] = user_id
+        if query:
+            await self.snapshots.delete_many(query)
+
+
+########### RESPONSES ###########
+
+def graded(snapshot: Dict) -> Dict[str, Dict]:
+    """Member grades plus graded assignment submissions, keyed like the old per-request code."""
+    grades = {item["key"]: item["entry"] for item in snapshot["member_grades"]}
+    for room_id, submissions in snapshot["submissions"].items():
+        for submission in submissions:
+            if "grade" in submission:
+                grades[submission["assignment_id"]] = {
+                    "assignment_id": submission["assignment_id"],
+                    "room_id": int(room_id),
+                    "grade": submission["grade"],
+                    "date": submission["date"]
+                }
+    return {key: entry for key, entry in grades.items() if entry.get("grade") not in [0, None]}
+
+
+def user_overview_entry(snapshot: Dict, tz) -> Dict:
+    assignments_summary = {}
+    for room in snapshot["assignment_rooms"]:
+        room_id = room["room_id"]
+        assignments_summary[room_id] = []
+        # Only list assignments the user has not submitted yet
+        if not snapshot["submissions"].get(str(room_id)):
+            due_date = parse_due_date(room["type"])
+            if due_date is not None:
+                due_date = (due_date.replace(tzinfo=tz) if tz else due_date).isoformat()
+            assignments_summary[room_id].append({
+                "assignment_name": str(room["name"]),
+                "server_id": snapshot["server_id"],
+                "assignment_id": room_id,
+                "grade": None,
+                "date": None,
+                "due_date": due_date
+            })
+    return {
+        "server_id": snapshot["server_id"],
+        "server_name": snapshot["server_name"],
+        "access_level": snapshot["access_level"],
+        "grades": list(graded(snapshot).values()),
+        "attendance_summary": snapshot["attendance_summary"],
+        "assignments_summary": assignments_summary,
+        "professor_stats": snapshot["professor_stats"],
+    }
+
+
+def server_overview_entry(snapshot: Dict) -> Dict:
+    assignments_summary = {}
+    now = datetime.now()
+    for room in snapshot["assignment_rooms"]:
+        room_id = room["room_id"]
+        due_date = parse_due_date(room["type"])
+        # Only include assignments with due_date in the future (or no due_date)
+        if due_date is not None and due_date < now:
+            continue
+        submissions = snapshot["submissions"].get(str(room_id), [])
+        if submissions:
+            for submission in submissions:
+                if "grade" in submission:
+                    assignments_summary.setdefault(room_id, []).append({
+                        "assignment_id": submission["assignment_id"],
+                        "grade": submission["grade"],
+                        "date": submission["date"],
+                        "due_date": due_date
+                    })
+        else:
+            # User did not submit any assignment for this room, add an empty entry
+            assignments_summary[room_id] = [{
+                "assignment_id": None,
+                "grade": None,
+                "date": None,
+                "due_date": due_date
+            }]
+    return {
+        "server_name": snapshot["server_name"],
+        "grades": graded(snapshot) or [],
+        "attendance_summary": snapshot["attendance_summary"],
+        "assignments_summary": assignments_summary,
+    }
+
+
+async def build_user_overview(db: AsyncSession, snapshots: OverviewSnapshots, user_id: int, server_ids: Iterable[int]) -> List[Dict]:
+    tz = overview_timezone()
+    by_server = await snapshots.get(db, user_id, server_ids)
+    return [user_overview_entry(by_server[server_id], tz) for server_id in sorted(by_server)]
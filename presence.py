@@ -0,0 +1,133 @@
+# Presence shared between worker processes
+#
+# Each worker owns the presence of the sockets it holds: the users with a main
+# socket ("online") and, per audio/video room, the users in the call, with their
+# camera on or sharing their screen. Changes are published on the backplane
+# (PRESENCE_CHANNEL) and every worker keeps a replica of the other workers' state.
+#
+# Workers also publish a full snapshot every PRESENCE_HEARTBEAT seconds and when
+# another worker asks for one (startup, backplane reconnect), so missed updates
+# heal; a worker not heard from for PRESENCE_EXPIRY seconds is dropped, so the
+# users of a crashed worker do not stay online.
+import asyncio
+import logging
+import time
+import uuid
+from typing import Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_CHANNEL = "presence"
+PRESENCE_HEARTBEAT = 15  # seconds
+PRESENCE_EXPIRY = 3 * PRESENCE_HEARTBEAT
+ROOM_STATES = ("voice", "camera", "sharingscreen")
+
+
+class WorkerPresence:
+    """Presence of the sockets held by one worker."""
+
+    def __init__(self):
+        self.online: Set[int] = set()
+        self.rooms: Dict[str, Dict[int, Set[int]]] = {state: {} for state in ROOM_STATES}
+        self.seen = time.monotonic()
+
+    def update(self, state: str, room_id: Optional[int], user_id: int, present: bool):
+        users = self.online if state == "online" else self.rooms[state].setdefault(room_id, set())
+        if present:
+            users.add(user_id)
+        else:
+            users.discard(user_id)
+            if state != "online" and not users:
+                del self.rooms[state][room_id]
+
+    def snapshot(self) -> dict:
+        return {
+            "online": list(self.online),
+            # JSON object keys are strings, rooms are sent as [room_id, [user ids]] pairs
+            "rooms": {state: [[room_id, list(users)] for room_id, users in rooms.items() if users] for state, rooms in self.rooms.items()},
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot: dict) -> "WorkerPresence":
+        presence = cls()
+        presence.online = set(snapshot["online"])
+        for state, rooms in snapshot["rooms"].items():
+            presence.rooms[state] = {room_id: set(users) for room_id, users in rooms}
+        return presence
+
+
+class ClusterPresence:
+    """Replicas of the other workers' presence, kept current through the backplane."""
+
+    def __init__(self, backplane, local_snapshot: Callable[[], dict]):
+        self.backplane = backplane
+        self.worker_id = uuid.uuid4().hex
+        self.local_snapshot = local_snapshot
+        self.remote: Dict[str, WorkerPresence] = {}
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._pending: Set[asyncio.Task] = set()
+
+    async def start(self):
+        self._heartbeat = asyncio.create_task(self._run_heartbeat())
+        await self.request_snapshots()
+
+    async def stop(self):
+        if self._heartbeat:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        await self._publish({"type": "gone"})
+
+    async def _publish(self, event: dict):
+        await self.backplane.publish(PRESENCE_CHANNEL, None, {"worker": self.worker_id, **event})
+
+    def publish_update(self, state: str, room_id: Optional[int], user_id: int, present: bool):
+        """Publish a change of the local presence, callable from sync code (socket cleanup)."""
+        task = asyncio.create_task(self._publish({"type": "update", "state": state, "room_id": room_id, "user_id": user_id, "present": present}))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def publish_snapshot(self):
+        await self._publish({"type": "snapshot", "state": self.local_snapshot()})
+
+    async def request_snapshots(self):
+        await self._publish({"type": "sync"})
+
+    async def _run_heartbeat(self):
+        while True:
+            await asyncio.sleep(PRESENCE_HEARTBEAT)
+            try:
+                await self.publish_snapshot()
+            except Exception as e:
+                logger.error(f"Failed to publish presence snapshot: {e}")
+            expired = time.monotonic() - PRESENCE_EXPIRY
+            for worker_id in [worker_id for worker_id, presence in self.remote.items() if presence.seen < expired]:
+                del self.remote[worker_id]
+
+    async def handle(self, event: dict):
+        """A PRESENCE_CHANNEL event from the backplane."""
+        worker_id = event["worker"]
+        if worker_id == self.worker_id:
+            return
+        kind = event["type"]
+        if kind == "gone":
+            self.remote.pop(worker_id, None)
+        elif kind == "sync":
+            await self.publish_snapshot()
+        elif kind == "snapshot":
+            self.remote[worker_id] = WorkerPresence.from_snapshot(event["state"])
+        elif kind == "update":
+            presence = self.remote.setdefault(worker_id, WorkerPresence())
+            presence.update(event["state"], event["room_id"], event["user_id"], event["present"])
+            presence.seen = time.monotonic()
+
+    def online_user_ids(self) -> Set[int]:
+        users: Set[int] = set()
+        for presence in self.remote.values():
+            users |= presence.online
+        return users
+
+    def room_users(self, state: str, room_id: int) -> Set[int]:
+        users: Set[int] = set()
+        for presence in self.remote.values():
+            users |= presence.rooms[state].get(room_id, set())
+        return users
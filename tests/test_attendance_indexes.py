@@ -0,0 +1,63 @@
+# The hot attendance queries are planned with the composite indexes (Postgres only).
+# TEST_DATABASE_URL must point at an empty database, the tables are created and
+# dropped by the test.
+import os
+from datetime import datetime
+
+import pytest
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+if not TEST_DATABASE_URL:
+    pytest.skip("TEST_DATABASE_URL is not set", allow_module_level=True)
+
+from sqlalchemy import create_engine, insert, select, text
+
+from attendance import indexed_queries
+import models
+
+SERVERS = 3
+STUDENTS = 200
+WEEKS = 14
+
+
+@pytest.fixture(scope="module")
+def connection():
+    engine = create_engine(TEST_DATABASE_URL)
+    models.Base.metadata.create_all(engine)
+    try:
+        with engine.connect() as connection:
+            seed(connection)
+            # the planner picks sequential scans for small tables, only the index choice is tested
+            connection.execute(text("SET enable_seqscan = off"))
+            yield connection
+    finally:
+        models.Base.metadata.drop_all(engine)
+        engine.dispose()
+
+
+def seed(connection):
+    now = datetime.now()
+    connection.execute(insert(models.User), [{"id": user_id, "email": f"{user_id}@test"} for user_id in range(1, STUDENTS + 1)])
+    connection.execute(insert(models.Server), [{"id": server_id, "owner_id": 1} for server_id in range(1, SERVERS + 1)])
+    connection.execute(insert(models.ServerWeek), [
+        {"server_id": server_id, "week_number": week_number}
+        for server_id in range(1, SERVERS + 1)
+        for week_number in range(1, WEEKS + 1)
+    ])
+    weeks = connection.execute(select(models.ServerWeek.id, models.ServerWeek.server_id)).all()
+    connection.execute(insert(models.Attendance), [
+        {"user_id": user_id, "server_id": server_id, "week_id": week_id, "date": now, "status": ("absent", "present", "excused")[user_id % 3]}
+        for week_id, server_id in weeks
+        for user_id in range(1, STUDENTS + 1)
+    ])
+    connection.commit()
+    connection.execute(text("ANALYZE"))
+
+
+@pytest.mark.parametrize("name", list(indexed_queries(0, 0, 0)))
+def test_attendance_query_uses_index(connection, name):
+    week_id = connection.scalar(select(models.ServerWeek.id).filter_by(server_id=2, week_number=3))
+    query, indexes = indexed_queries(2, week_id, 17)[name]
+    sql = query.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True})
+    plan = "\n".join(line for line, in connection.execute(text(f"EXPLAIN {sql}")))
+    assert any(index in plan for index in indexes), plan
@@ -0,0 +1,268 @@
+# RedisBackplane against a local fake Redis server (pub/sub subset of RESP2),
+# two backplanes stand for two uvicorn workers.
+import asyncio
+from typing import Dict, List, Set
+
+import pytest
+
+pytest.importorskip("redis")
+
+from backplane import ALL_CACHES, CACHE_CHANNEL, RedisBackplane
+
+
+class FakeRedisServer:
+    """Understands SUBSCRIBE, UNSUBSCRIBE and PUBLISH, answers +OK to anything else."""
+
+    def __init__(self):
+        self.subscribers: Dict[str, Set[asyncio.StreamWriter]] = {}
+        self.connections: Set[asyncio.StreamWriter] = set()
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.disconnect_all()
+        self.server.close()
+        await self.server.wait_closed()
+
+    @property
+    def url(self) -> str:
+        return f"redis://127.0.0.1:{self.port}/0"
+
+    def subscriber_count(self, channel: str) -> int:
+        return len(self.subscribers.get(channel, ()))
+
+    def disconnect_all(self):
+        for writer in list(self.connections):
+            writer.close()
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(FakeRedisServer._encode(item) for item in value)
+        data = value if isinstance(value, bytes) else value.encode()
+        return b"$%d\r\n%s\r\n" % (len(data), data)
+
+    @staticmethod
+    async def _read_command(reader: asyncio.StreamReader) -> List[bytes]:
+        header = await reader.readline()
+        if not header:
+            raise ConnectionError("client disconnected")
+        arguments = []
+        for _ in range(int(header[1:])):
+            length = int((await reader.readline())[1:])
+            arguments.append((await reader.readexactly(length + 2))[:-2])
+        return arguments
+
+    def _unsubscribe(self, writer: asyncio.StreamWriter, channel: str):
+        self.subscribers.get(channel, set()).discard(writer)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections.add(writer)
+        subscribed: Set[str] = set()
+        try:
+            while True:
+                command, *arguments = await self._read_command(reader)
+                command = command.upper()
+                if command == b"SUBSCRIBE":
+                    for channel in arguments:
+                        channel = channel.decode()
+                        subscribed.add(channel)
+                        self.subscribers.setdefault(channel, set()).add(writer)
+                        writer.write(self._encode([b"subscribe", channel, len(subscribed)]))
+                elif command == b"UNSUBSCRIBE":
+                    channels = [channel.decode() for channel in arguments] or sorted(subscribed)
+                    for channel in channels:
+                        subscribed.discard(channel)
+                        self._unsubscribe(writer, channel)
+                        writer.write(self._encode([b"unsubscribe", channel, len(subscribed)]))
+                    if not channels:
+                        writer.write(b"*3\r\n$11\r\nunsubscribe\r\n$-1\r\n:0\r\n")
+                elif command == b"PUBLISH":
+                    channel, message = arguments[0].decode(), arguments[1]
+                    receivers = list(self.subscribers.get(channel, ()))
+                    for receiver in receivers:
+                        receiver.write(self._encode([b"message", channel, message]))
+                    writer.write(self._encode(len(receivers)))
+                else:
+                    writer.write(b"+OK\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for channel in subscribed:
+                self._unsubscribe(writer, channel)
+            self.connections.discard(writer)
+            writer.close()
+
+
+class Worker:
+    """One backplane and the events it delivered to its local sockets."""
+
+    def __init__(self, url: str):
+        self.backplane = RedisBackplane(url, channel="test:ws")
+        self.events = []
+        self.received = asyncio.Event()
+
+    async def deliver(self, channel, key, message):
+        self.events.append((channel, key, message))
+        self.received.set()
+
+    async def wait_for(self, count: int, timeout: float = 5):
+        async with asyncio.timeout(timeout):
+            while len(self.events) < count:
+                self.received.clear()
+                await self.received.wait()
+
+
+async def wait_until(condition, timeout: float = 5):
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+
+async def start_workers(server: FakeRedisServer, count: int = 2) -> List[Worker]:
+    workers = [Worker(server.url) for _ in range(count)]
+    for worker in workers:
+        await worker.backplane.start(worker.deliver)
+    await wait_until(lambda: server.subscriber_count("test:ws") == count)
+    return workers
+
+
+def run(test):
+    async def main():
+        server = FakeRedisServer()
+        await server.start()
+        try:
+            await test(server)
+        finally:
+            await server.stop()
+    asyncio.run(main())
+
+
+def test_events_reach_other_workers_once():
+    async def test(server):
+        first, second = await start_workers(server)
+        try:
+            await first.backplane.publish("server", 7, "7: joined")
+            await second.wait_for(1)
+            await first.backplane.publish(CACHE_CHANNEL, None, {"cache": "access", "user_id": 3, "server_id": 7})
+            await second.wait_for(2)
+            await asyncio.sleep(0.1)  # the publishing worker's own events come back from redis too
+
+            expected = [("server", 7, "7: joined"), (CACHE_CHANNEL, None, {"cache": "access", "user_id": 3, "server_id": 7})]
+            assert first.events == expected
+            assert second.events == expected
+        finally:
+            for worker in (first, second):
+                await worker.backplane.stop()
+    run(test)
+
+
+def test_listener_resubscribes_and_drops_caches_after_disconnect():
+    async def test(server):
+        first, second = await start_workers(server)
+        pubsubs = []
+        create_pubsub = second.backplane.redis.pubsub
+        second.backplane.redis.pubsub = lambda: pubsubs.append(create_pubsub()) or pubsubs[-1]
+        try:
+            server.disconnect_all()
+            await second.wait_for(1)
+            assert second.events == [(CACHE_CHANNEL, None, {"cache": ALL_CACHES})]
+            await wait_until(lambda: server.subscriber_count("test:ws") == 2)
+
+            await first.backplane.publish("textroom", 1, "hello")
+            await second.wait_for(2)
+            assert second.events[-1] == ("textroom", 1, "hello")
+
+            # every reconnect closes the pubsub it replaces
+            server.disconnect_all()
+            await second.wait_for(3)
+            assert len(pubsubs) == 2
+            assert pubsubs[0].connection is None
+            assert pubsubs[1].connection is not None
+        finally:
+            for worker in (first, second):
+                await worker.backplane.stop()
+    run(test)
+
+
+def test_cache_invalidation_runs_on_every_worker():
+    pytest.importorskip("fastapi")
+    from websocket import WebSocketManager
+
+    async def test(server):
+        managers = [WebSocketManager(RedisBackplane(server.url, channel="test:ws")) for _ in range(2)]
+        invalidated = [[], []]
+        for manager, events in zip(managers, invalidated):
+            manager.on_cache_event("access", events.append)
+            await manager.start()
+        try:
+            await wait_until(lambda: server.subscriber_count("test:ws") == 2)
+            await managers[0].invalidate_cache("access", user_id=3, server_id=7)
+            await wait_until(lambda: invalidated[1])
+            assert invalidated == [[{"cache": "access", "user_id": 3, "server_id": 7}]] * 2
+        finally:
+            for manager in managers:
+                await manager.stop()
+    run(test)
+
+
+class FakeWebSocket:
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def send_json(self, message):
+        self.sent.append(message)
+
+    async def send_text(self, message):
+        self.sent.append(message)
+
+    async def close(self, code=None):
+        pass
+
+
+def test_presence_and_relay_span_workers():
+    pytest.importorskip("fastapi")
+    from websocket import WebSocketManager
+
+    async def test(server):
+        first = WebSocketManager(RedisBackplane(server.url, channel="test:ws"))
+        await first.start()
+        await wait_until(lambda: server.subscriber_count("test:ws") == 1)
+        # presence that exists before the second worker starts reaches it through a snapshot
+        await first.connect_main(FakeWebSocket(1))
+        first.set_room_state("voice", 5, 1, True)
+
+        second = WebSocketManager(RedisBackplane(server.url, channel="test:ws"))
+        await second.start()
+        try:
+            await wait_until(lambda: second.room_users("voice", 5) == {1})
+            assert second.online_user_ids() == {1}
+
+            peer = FakeWebSocket(2)
+            await second.connect_audiovideo(peer, 5, 2)
+            second.set_room_state("camera", 5, 2, True)
+            await wait_until(lambda: first.room_users("camera", 5) == {2})
+
+            await first.relay_webrtc_signal(5, 2, {"type": "offer"})
+            await wait_until(lambda: {"type": "offer"} in peer.sent)
+
+            second.disconnect_audiovideo(peer, 5, 2)
+            await wait_until(lambda: not first.room_users("camera", 5))
+
+            # a stopped worker's users are dropped by the others right away
+            await second.stop()
+            await wait_until(lambda: not first.presence.remote)
+        finally:
+            await first.stop()
+    run(test)
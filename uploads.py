@@ -0,0 +1,223 @@
+# Resumable uploads for large assignment submissions
+#
+#   POST /api/uploads                         {filename, size}  -> upload id and chunk size
+#   PUT  /api/uploads/{id}/chunks/{index}     raw chunk bytes, any order, re-sending is fine
+#   GET  /api/uploads/{id}                    which chunks the server already has
+#   POST /api/uploads/{id}/complete           hash the file and move it into the attachment store
+#
+# Chunks are written straight to their offset in one preallocated file, so
+# completing an upload needs no reassembly. Completing claims the upload first
+# (state "open" -> "completing", only while no chunk is being written), so
+# chunks and a second completion arriving meanwhile get a 409. A completed upload holds a reference
+# ("upload:{id}") in the attachment store until the message it is attached to
+# (upload_ids of /api/assignment) is stored; uploads that are never used expire.
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, List
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+
+from attachments import MAX_ATTACHMENT_SIZE, TMP_DIR, AttachmentStore, StoredAttachment, remove_file, too_large_error
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_COLLECTION = "resumable_uploads"
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 8 MiB
+UPLOAD_EXPIRY = timedelta(hours=24)
+UPLOAD_CLEANUP_INTERVAL = 3600  # seconds
+# Upload states, uploads created before states were added have none and count as open
+OPEN, COMPLETING, COMPLETED = "open", "completing", "completed"
+
+
+def upload_owner(upload_id: str) -> str:
+    return f"upload:{upload_id}"
+
+
+def upload_path(upload_id: str) -> str:
+    return os.path.join(TMP_DIR, f"{upload_id}.upload")
+
+
+def total_chunks(upload: Dict) -> int:
+    return max(1, -(-upload["size"] // upload["chunk_size"]))
+
+
+def chunk_length(upload: Dict, index: int) -> int:
+    return min(upload["chunk_size"], upload["size"] - index * upload["chunk_size"])
+
+
+def upload_status(upload: Dict) -> Dict:
+    count = total_chunks(upload)
+    received = sorted(upload["received"])
+    return {
+        "upload_id": upload["_id"],
+        "filename": upload["filename"],
+        "size": upload["size"],
+        "chunk_size": upload["chunk_size"],
+        "total_chunks": count,
+        "received": received,
+        "missing": sorted(set(range(count)) - set(received)),
+        "completed": upload.get("digest") is not None,
+        "expires_at": upload["expires_at"],
+    }
+
+
+def _preallocate(path: str, size: int):
+    with open(path, "wb") as out:
+        out.truncate(size)
+
+
+def _open_at(path: str, offset: int):
+    out = open(path, "r+b")
+    out.seek(offset)
+    return out
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        while chunk := source.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResumableUploads:
+    def __init__(self, db, store: AttachmentStore):
+        self.uploads = db[UPLOAD_COLLECTION]
+        self.store = store
+
+    async def ensure_indexes(self):
+        await self.uploads.create_index("expires_at")
+
+    async def _get(self, upload_id: str, user_id: int) -> Dict:
+        upload = await self.uploads.find_one({"_id": upload_id})
+        if not upload or upload["expires_at"] < datetime.now():
+            raise HTTPException(status_code=404, detail="Upload not found")
+        if upload["user_id"] != user_id:
+            raise HTTPException(status_code=403, detail="Not authorized to access this upload")
+        return upload
+
+    async def create(self, user_id: int, filename: str, size: int) -> Dict:
+        filename = os.path.basename(filename or "attachment")
+        if size > MAX_ATTACHMENT_SIZE:
+            raise too_large_error(filename)
+        upload = {
+            "_id": uuid.uuid4().hex,
+            "user_id": user_id,
+            "filename": filename,
+            "size": size,
+            "chunk_size": UPLOAD_CHUNK_SIZE,
+            "received": [],
+            "digest": None,
+            "state": OPEN,
+            "writing": 0,  # chunks being written right now
+            "created_at": datetime.now(),
+            "expires_at": datetime.now() + UPLOAD_EXPIRY,
+        }
+        await asyncio.to_thread(_preallocate, upload_path(upload["_id"]), size)
+        await self.uploads.insert_one(upload)
+        return upload_status(upload)
+
+    async def status(self, upload_id: str, user_id: int) -> Dict:
+        return upload_status(await self._get(upload_id, user_id))
+
+    async def put_chunk(self, upload_id: str, user_id: int, index: int, body: AsyncIterator[bytes]) -> Dict:
+        upload = await self._get(upload_id, user_id)
+        if not 0 <= index < total_chunks(upload):
+            raise HTTPException(status_code=400, detail="Chunk index out of range")
+        # counted as being written, so the upload cannot be completed until the chunk is in place
+        if not await self.uploads.find_one_and_update(
+            {"_id": upload_id, "digest": None, "state": {"$ne": COMPLETING}},
+            {"$inc": {"writing": 1}}
+        ):
+            raise HTTPException(status_code=409, detail="Upload is completed or being completed")
+
+        expected = chunk_length(upload, index)
+        written = 0
+        update = {"$inc": {"writing": -1}}
+        try:
+            out = await asyncio.to_thread(_open_at, upload_path(upload_id), index * upload["chunk_size"])
+            try:
+                async for data in body:
+                    written += len(data)
+                    if written > expected:
+                        raise HTTPException(status_code=400, detail=f"Chunk {index} must be {expected} bytes")
+                    await asyncio.to_thread(out.write, data)
+            finally:
+                await asyncio.to_thread(out.close)
+            if written != expected:
+                raise HTTPException(status_code=400, detail=f"Chunk {index} must be {expected} bytes")
+            update["$addToSet"] = {"received": index}
+        finally:
+            upload = await self.uploads.find_one_and_update({"_id": upload_id}, update, return_document=ReturnDocument.AFTER)
+        if upload is None:
+            raise HTTPException(status_code=404, detail="Upload not found")
+        return upload_status(upload)
+
+    async def complete(self, upload_id: str, user_id: int) -> Dict:
+        upload = await self._get(upload_id, user_id)
+        if upload["digest"] is not None:
+            return upload_status(upload)
+        missing = upload_status(upload)["missing"]
+        if missing:
+            raise HTTPException(status_code=400, detail=f"Upload is missing {len(missing)} chunks")
+
+        # the upload file must not change while it is hashed and moved into the store
+        upload = await self.uploads.find_one_and_update(
+            {"_id": upload_id, "digest": None, "state": {"$ne": COMPLETING}, "writing": {"$not": {"$gt": 0}}},
+            {"$set": {"state": COMPLETING}},
+            return_document=ReturnDocument.AFTER
+        )
+        if upload is None:
+            raise HTTPException(status_code=409, detail="Upload is being completed or still receiving chunks")
+        try:
+            digest = await asyncio.to_thread(_hash_file, upload_path(upload_id))
+            await self.store.adopt(upload_path(upload_id), digest, upload["size"], upload_owner(upload_id))
+        except Exception:
+            await self.uploads.update_one({"_id": upload_id}, {"$set": {"state": OPEN}})
+            raise
+        upload = await self.uploads.find_one_and_update(
+            {"_id": upload_id},
+            {"$set": {"digest": digest, "state": COMPLETED}},
+            return_document=ReturnDocument.AFTER
+        )
+        return upload_status(upload)
+
+    async def attach(self, upload_ids: List[str], user_id: int, owner: str) -> List[StoredAttachment]:
+        """
+        Reference completed uploads from the message `owner`. The uploads are left as
+        they are: call consume() once the message is stored, or release `owner` if it is not.
+        """
+        uploads = [await self._get(upload_id, user_id) for upload_id in upload_ids]
+        if any(upload["digest"] is None for upload in uploads):
+            raise HTTPException(status_code=400, detail="Upload is not completed")
+        attached = []
+        for upload in uploads:
+            await self.store.share(upload["digest"], owner)
+            attached.append(StoredAttachment(upload["digest"], upload["filename"], upload["size"]))
+        return attached
+
+    async def consume(self, upload_ids: List[str]):
+        """Drop uploads attached to a stored message, their files stay referenced by the message."""
+        for upload_id in upload_ids:
+            await self.store.release(upload_owner(upload_id))
+            await self.uploads.delete_one({"_id": upload_id})
+
+    async def cleanup_expired(self):
+        async for upload in self.uploads.find({"expires_at": {"$lt": datetime.now()}}):
+            if upload["digest"] is None:
+                await asyncio.to_thread(remove_file, upload_path(upload["_id"]))
+            else:
+                await self.store.release(upload_owner(upload["_id"]))
+            await self.uploads.delete_one({"_id": upload["_id"]})
+
+    async def run_cleanup(self):
+        while True:
+            try:
+                await self.cleanup_expired()
+            except Exception as e:
+                logger.error(f"Expired upload cleanup failed: {e}")
+            await asyncio.sleep(UPLOAD_CLEANUP_INTERVAL)
@@ -1,112 +1,318 @@
 # WebSocket Connections Manager
-from typing import Annotated, Dict, List
-from fastapi import Depends, FastAPI, WebSocket, WebSocketDisconnect
-from requests import Session
-from database import engine, SessionLocal
+import asyncio
+import json
+import logging
+import os
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
+from fastapi import WebSocket
 
-import models
+from backplane import ALL_CACHES, CACHE_CHANNEL, InMemoryBackplane
+from presence import PRESENCE_CHANNEL, ROOM_STATES, ClusterPresence
+
+logger = logging.getLogger(__name__)
+
+# Outbound messages buffered per connection before the overflow policy kicks in
+SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# "drop_oldest": discard the oldest queued message, "disconnect": close the slow client
+SEND_QUEUE_POLICY = os.getenv("WS_SEND_QUEUE_POLICY", "drop_oldest")
+SLOW_CLIENT_CLOSE_CODE = 1013  # "Try Again Later"
+RELAY_CHANNEL = "relay"  # WebRTC signals for one user of an audio/video room, key: room_id
+
+
+class ClientConnection:
+    """
+    Wraps a WebSocket with a bounded outbound queue drained by its own writer task,
+    so broadcasting never waits on a slow client.
+    """
+
+    def __init__(self, websocket: WebSocket, maxsize: int = SEND_QUEUE_SIZE, policy: str = SEND_QUEUE_POLICY):
+        self.websocket = websocket
+        self.policy = policy
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.closed = False
+        self.dropped = 0
+        self.writer = asyncio.create_task(self._write_loop())
+
+    def send(self, message: Union[str, dict]) -> bool:
+        """Queue a message without blocking, returns False if it was not queued."""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        if self.policy == "disconnect":
+            logger.warning(f"Closing slow websocket client user_id={getattr(self.websocket, 'user_id', None)}")
+            self.close(code=SLOW_CLIENT_CLOSE_CODE)
+            return False
+
+        # drop_oldest
+        self.queue.get_nowait()
+        self.dropped += 1
+        self.queue.put_nowait(message)
+        return True
+
+    async def _write_loop(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                if isinstance(message, dict):
+                    await self.websocket.send_json(message)
+                else:
+                    await self.websocket.send_text(message)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # the receive loop of the endpoint will notice the disconnect and clean up
+            logger.info(f"Websocket writer stopped: {e}")
+            self.closed = True
+
+    def close(self, code: int = None):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.cancel()
+        if code is not None:
+            asyncio.create_task(self._close_socket(code))
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
 
 
 class WebSocketManager:
-    def __init__(self):
-        self.main_connections: List[WebSocket] = []
-        self.server_connections: Dict[int, List[WebSocket]] = {}  # server_id to list of WebSockets
-        self.textroom_connections: Dict[int, Dict[int, List[WebSocket]]] = {}  # server_id to room_id to list of WebSockets
+    """
+    Connection registry. Every channel is a dict of key -> set of sockets, and
+    `subscriptions` is the reverse index (socket -> channel keys) so a socket can
+    be removed from every map in O(1) when it disconnects.
+
+    broadcast_* go through the backplane, which delivers them to the sockets
+    of every worker process (see backplane.py). The backplane also carries
+    cache invalidations ("cache" channel), so a per-process cache dropped on
+    one worker is dropped on all of them, and presence: online users and call
+    states are merged with the other workers' (see presence.py).
+    """
+
+    def __init__(self, backplane=None):
+        self.backplane = backplane or InMemoryBackplane()
+        self.main_connections: Set[WebSocket] = set()
+        self.user_connections: Dict[int, Set[WebSocket]] = {}  # user_id -> main sockets of that user
+        self.server_connections: Dict[int, Set[WebSocket]] = {}
+        self.textroom_connections: Dict[int, Set[WebSocket]] = {}
+        self.audiovideo_connections: Dict[int, Set[WebSocket]] = {}
+        self.audiovideo_voice_users: Dict[int, Set[int]] = {}
+        self.audiovideo_sharingscreen_users: Dict[int, Set[int]] = {}
+        self.audiovideo_camera_users: Dict[int, Set[int]] = {}
+        self.clients: Dict[WebSocket, ClientConnection] = {}
+        self.subscriptions: Dict[WebSocket, Set[Tuple[str, int]]] = {}
+        self.cache_handlers: Dict[str, Callable[[dict], None]] = {}  # cache name -> invalidation handler
+        self._channels: Dict[str, Dict[int, Set[WebSocket]]] = {
+            "user": self.user_connections,
+            "server": self.server_connections,
+            "textroom": self.textroom_connections,
+            "audiovideo": self.audiovideo_connections,
+        }
+        # call states of this worker's audio/video sockets, room_id -> user ids
+        self._room_states: Dict[str, Dict[int, Set[int]]] = {
+            "voice": self.audiovideo_voice_users,
+            "camera": self.audiovideo_camera_users,
+            "sharingscreen": self.audiovideo_sharingscreen_users,
+        }
+        self.presence = ClusterPresence(self.backplane, self._presence_snapshot)
+
+    async def start(self):
+        await self.backplane.start(self._deliver)
+        await self.presence.start()
+
+    async def stop(self):
+        await self.presence.stop()
+        await self.backplane.stop()
+
+    async def _deliver(self, channel: str, key: Optional[int], message: Union[str, dict]):
+        """Send a backplane event to the sockets held by this process."""
+        if channel == "main":
+            self._fanout(self.main_connections, message)
+        elif channel in self._channels:
+            self._fanout(self._channels[channel].get(key, ()), message)
+        elif channel == RELAY_CHANNEL:
+            for websocket in list(self.audiovideo_connections.get(key, ())):
+                if getattr(websocket, "user_id", None) == message["to"]:
+                    self._send(websocket, message["message"])
+        elif channel == PRESENCE_CHANNEL:
+            await self.presence.handle(message)
+        elif channel == CACHE_CHANNEL:
+            self._invalidate_cache(message)
+            if message["cache"] == ALL_CACHES:
+                # presence updates may have been missed as well
+                await self.presence.request_snapshots()
+
+    # --- CACHE INVALIDATION ---
+    def on_cache_event(self, cache: str, handler: Callable[[dict], None]):
+        """Register the handler dropping entries of `cache`, it receives the keys passed to invalidate_cache."""
+        self.cache_handlers[cache] = handler
+
+    async def invalidate_cache(self, cache: str, **keys):
+        """Run the `cache` handler on every worker process, this one included."""
+        await self.backplane.publish(CACHE_CHANNEL, None, {"cache": cache, **keys})
+
+    def _invalidate_cache(self, event: dict):
+        # ALL_CACHES: events may have been missed (backplane reconnected), drop everything
+        names = self.cache_handlers if event["cache"] == ALL_CACHES else [event["cache"]]
+        for name in names:
+            handler = self.cache_handlers.get(name)
+            if handler is None:
+                continue
+            try:
+                handler(event)
+            except Exception as e:
+                logger.error(f"Failed to invalidate cache {name}: {e}")
 
-    # Handle connections for the main server
+    # --- REGISTRY ---
+    def _register(self, websocket: WebSocket):
+        self.clients[websocket] = ClientConnection(websocket)
+
+    def _subscribe(self, websocket: WebSocket, channel: str, key: int):
+        self._channels[channel].setdefault(key, set()).add(websocket)
+        self.subscriptions.setdefault(websocket, set()).add((channel, key))
+
+    def _unregister(self, websocket: WebSocket):
+        client = self.clients.pop(websocket, None)
+        if client:
+            client.close()
+        self.main_connections.discard(websocket)
+        for channel, key in self.subscriptions.pop(websocket, ()):
+            sockets = self._channels[channel].get(key)
+            if sockets is None:
+                continue
+            sockets.discard(websocket)
+            if not sockets:
+                del self._channels[channel][key]
+                if channel == "user":
+                    self.presence.publish_update("online", None, key, False)
+
+    def _send(self, websocket: WebSocket, message: Union[str, dict]) -> bool:
+        client = self.clients.get(websocket)
+        return client.send(message) if client else False
+
+    def _fanout(self, connections, message: Union[str, dict]):
+        # iterate over a copy, a slow client may be closed (and removed) mid-loop
+        for websocket in list(connections):
+            self._send(websocket, message)
+
+    def online_user_ids(self) -> Set[int]:
+        """Users with at least one open main socket, on any worker."""
+        return set(self.user_connections) | self.presence.online_user_ids()
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self.user_connections or user_id in self.presence.online_user_ids()
+
+    def room_users(self, state: str, room_id: int) -> Set[int]:
+        """Users of an audio/video room in a call state ("voice", "camera", "sharingscreen"), on any worker."""
+        return set(self._room_states[state].get(room_id, ())) | self.presence.room_users(state, room_id)
+
+    def set_room_state(self, state: str, room_id: int, user_id: int, active: bool):
+        users = self._room_states[state].setdefault(room_id, set())
+        if active == (user_id in users):
+            return
+        if active:
+            users.add(user_id)
+        else:
+            users.discard(user_id)
+        self.presence.publish_update(state, room_id, user_id, active)
+
+    def _presence_snapshot(self) -> dict:
+        return {
+            "online": list(self.user_connections),
+            "rooms": {state: [[room_id, list(users)] for room_id, users in self._room_states[state].items() if users] for state in ROOM_STATES},
+        }
+
+    # --- MAIN SOCKET ---
     async def connect_main(self, websocket: WebSocket):
         await websocket.accept()
-        self.main_connections.append(websocket)
+        self._register(websocket)
+        self.main_connections.add(websocket)
+        was_online = websocket.user_id in self.user_connections
+        self._subscribe(websocket, "user", websocket.user_id)
+        if not was_online:
+            self.presence.publish_update("online", None, websocket.user_id, True)
 
     def disconnect_main(self, websocket: WebSocket):
-        self.main_connections.remove(websocket)
+        self._unregister(websocket)
 
     async def broadcast_main(self, message: str):
-        for connection in self.main_connections:
-            await connection.send_text(message)
+        await self.backplane.publish("main", None, message)
 
-    # Handle connections for specific servers
+    # --- SERVER SOCKET ---
     async def connect_server(self, websocket: WebSocket, server_id: int):
         await websocket.accept()
-        if server_id not in self.server_connections:
-            self.server_connections[server_id] = []
-        self.server_connections[server_id].append(websocket)
+        self._register(websocket)
+        self._subscribe(websocket, "server", server_id)
 
     def disconnect_server(self, websocket: WebSocket, server_id: int):
-        if server_id in self.server_connections:
-            self.server_connections[server_id].remove(websocket)
+        self._unregister(websocket)
 
     async def broadcast_server(self, server_id: int, message: str):
-        if server_id in self.server_connections:
-            for connection in self.server_connections[server_id]:
-                await connection.send_text(message)
+        await self.backplane.publish("server", server_id, message)
 
-    # Handle connections for text rooms
+    # --- TEXT ROOM SOCKET ---
     async def connect_textroom(self, websocket: WebSocket, room_id: int):
         await websocket.accept()
-        if room_id not in self.textroom_connections:
-            self.textroom_connections[room_id] = []
-        self.textroom_connections[room_id].append(websocket)
+        self._register(websocket)
+        self._subscribe(websocket, "textroom", room_id)
 
     def disconnect_textroom(self, websocket: WebSocket, room_id: int):
-        if room_id in self.textroom_connections:
-            self.textroom_connections[room_id].remove(websocket)
-            if not self.textroom_connections[room_id]:
-                del self.textroom_connections[room_id]
+        self._unregister(websocket)
 
     async def broadcast_textroom(self, room_id: int, message: str):
-        if room_id in self.textroom_connections:
-            for connection in self.textroom_connections[room_id]:
-                await connection.send_text(message)
-
-    # async def broadcastConnections(self, update_message: str, user_id: int, servers: List[int], friends: List[int] = None):
-    #     # Broadcast to friends on the main server
-    #     if friends:
-    #         for connection in self.main_connections:
-    #             if connection.user_id in friends:
-    #                 try:
-    #                     await connection.send_text(f"{user_id}: {update_message}")
-    #                 except WebSocketDisconnect:
-    #                     # Log and remove disconnected connection
-    #                     print(f"Friend {connection.user_id} disconnected")
-    #                     self.main_connections.remove(connection)
-    #                 except Exception as e:
-    #                     # Catch other exceptions
-    #                     print(f"Error sending message to friend {connection.user_id}: {e}")
-
-    #     # Broadcast to users in the same servers
-    #     for server_id in servers:
-    #         try:
-    #             if server_id in self.server_connections:
-    #                 for connection in self.server_connections[server_id]:
-    #                     try:
-    #                         await connection.send_text(f"{user_id}: {update_message}")
-    #                     except WebSocketDisconnect:
-    #                         # Log and remove disconnected connection
-    #                         print(f"User {connection.user_id} in server {server_id} disconnected")
-    #                         self.server_connections[server_id].remove(connection)
-    #                     except Exception as e:
-    #                         # Catch other exceptions
-    #                         print(f"Error sending message to server {server_id}, user {connection.user_id}: {e}")
-    #         except Exception as e:
-    #             print(f"Error processing server {server_id}: {e}")
-
-    
+        await self.backplane.publish("textroom", room_id, message)
+
+    ########### AUDIO/VIDEO ROOM WEB SOCKET (SIGNALING) ###########
+
+
+    async def connect_audiovideo(self, websocket: WebSocket, room_id: int, user_id: int):
+
+        websocket.user_id = user_id
+        await websocket.accept()
+        self._register(websocket)
+        # Add the connection even if the user hasn't joined voice
+        self._subscribe(websocket, "audiovideo", room_id)
+        self.audiovideo_voice_users.setdefault(room_id, set())
+        self.audiovideo_camera_users.setdefault(room_id, set())
+        self.audiovideo_sharingscreen_users.setdefault(room_id, set())
+
+        # Notify all (including sender) about the user joining (optional: skip if not "connected")
+        await self.broadcast_audiovideo(
+            room_id,
+            json.dumps({"type": "user-joined", "user_id": user_id}),
+        )
+
+    def disconnect_audiovideo(self, websocket: WebSocket, room_id: int, user_id: int):
+        self._unregister(websocket)
+        for state in ROOM_STATES:
+            self.set_room_state(state, room_id, user_id, False)
+        if room_id not in self.audiovideo_connections:
+            for users in self._room_states.values():
+                users.pop(room_id, None)
+
+    async def broadcast_audiovideo(self, room_id: int, message: str):
+        await self.backplane.publish("audiovideo", room_id, message)
+
+
+    async def relay_webrtc_signal(self, room_id: int, to_user_id: int, message: dict):
+        # the peer may be connected to another worker
+        await self.backplane.publish(RELAY_CHANNEL, room_id, {"to": to_user_id, "message": message})
+
     async def broadcastConnections(self,update_message:str, user_id: int, servers: List[int], friends: List[int] = None):
+        message = f"{user_id}: {update_message}"
         # Broadcast to friends on the main server
-        try:
-            if friends:
-                for connection in self.main_connections:
-                    if connection.user_id in friends:
-                        await connection.send_text(f"{user_id}: {update_message}")
-
-            # Broadcast to users in the same servers
-            for server_id in servers:
-                if server_id in self.server_connections:
-                    for connection in self.server_connections[server_id]:
-                        await connection.send_text(f"{user_id}: {update_message}")
-        except Exception as e:
-            print(f"Error broadcasting connections: {e}")
-            pass
-
+        if friends:
+            for friend_id in friends:
+                await self.backplane.publish("user", friend_id, message)
 
+        # Broadcast to users in the same servers
+        for server_id in servers:
+            await self.backplane.publish("server", server_id, message)